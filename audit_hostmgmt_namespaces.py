@@ -0,0 +1,333 @@
+#! /usr/bin/env python3
+
+__version__ = "1.0.0"
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+import ldap
+from ldap import SCOPE_SUBTREE
+from ldap.controls import SimplePagedResultsControl
+
+import hostmgmt_callbacks
+from hostmgmt_callbacks import (NamespacePolicy, dn_key, namespace_of, parse_dn, policy_registry)
+
+# NOTE: run on an IdM server, as root (SASL EXTERNAL over ldapi) or with --bind-dn;
+# violations are written to stdout as JSON lines, progress and the summary to stderr.
+#
+#   ./audit_hostmgmt_namespaces.py > violations.jsonl
+#   ./audit_hostmgmt_namespaces.py --incremental --state /var/lib/ipa/hostmgmt_audit.json
+
+PAGE_SIZE = 1000
+AUDIT_STATE = "/var/lib/ipa/hostmgmt_audit.json"
+
+MEMBER_FILTER = "(|(objectclass=ipahost)(objectclass=ipahostgroup))"
+TARGET_FILTER = "(objectclass=*)"
+TARGETS = (
+    # (target type, container, membership attribute)
+    ("hostgroup", "cn=hostgroups,cn=accounts", "member"),
+    ("hbacrule", "cn=hbac", "memberhost"),
+    ("sudorule", "cn=sudorules,cn=sudo", "memberhost"),
+)
+
+def paged_search(conn, base, filterstr, attrs, page_size=PAGE_SIZE):
+    """
+    Yields (dn, attrs) for every entry below base, one page at a time, so at
+    most page_size entries are held in memory. attrs maps lower case
+    attribute names to lists of str values.
+    """
+    control = SimplePagedResultsControl(True, size=page_size, cookie="")
+    while True:
+        msgid = conn.search_ext(base, SCOPE_SUBTREE, filterstr, attrs, serverctrls=[control])
+        rtype, rdata, rmsgid, serverctrls = conn.result3(msgid)
+        for dn, entry in rdata:
+            if dn is None: # search continuation reference
+                continue
+            yield dn, dict((name.lower(), [v.decode("utf-8") for v in values]) for name, values in entry.items())
+        cookies = [c.cookie for c in serverctrls if c.controlType == SimplePagedResultsControl.controlType]
+        if not cookies or not cookies[0]:
+            return
+        control.cookie = cookies[0]
+
+def entry_usn(attrs):
+    usns = attrs.get("entryusn", [])
+    return int(usns[0]) if len(usns) else 0
+
+class MemberDirectory(object):
+    """
+    userclasses of every host and hostgroup, filled from one paged search.
+    Keys are lower case DNs and values interned tuples, so the hosts of a
+    large directory share the few distinct userclass tuples. With since_usn
+    set, changed collects the keys of entries modified after that entryusn.
+    The memberOf plugin lists every enclosing hostgroup, nested or not, on
+    each host, so hosts_of is the effective host closure of every hostgroup
+    that transitive policies check; nested_changed holds the hostgroups
+    with a changed host anywhere below them.
+    """
+
+    def __init__(self, since_usn=None):
+        self.since_usn = since_usn
+        self.userclasses = {} # dn_key -> userclass tuple
+        self.tuples = {}
+        self.changed = set()
+        self.hosts_of = {} # hostgroup dn_key -> dn_keys of its direct and nested hosts
+        self.nested_changed = set()
+        self.highest_usn = 0
+
+    def add(self, dn, attrs):
+        key = dn_key(dn)
+        userclasses = tuple(attrs.get("userclass", ()))
+        self.userclasses[key] = self.tuples.setdefault(userclasses, userclasses)
+        usn = entry_usn(attrs)
+        self.highest_usn = max(self.highest_usn, usn)
+        changed = self.since_usn is not None and usn > self.since_usn
+        if changed:
+            self.changed.add(key)
+        if ",cn=computers," in key:
+            for group_dn in attrs.get("memberof", ()):
+                group_key = dn_key(group_dn)
+                if ",cn=hostgroups," in group_key:
+                    self.hosts_of.setdefault(group_key, []).append(key)
+                    if changed:
+                        self.nested_changed.add(group_key)
+
+    def load(self, entries):
+        for dn, attrs in entries:
+            self.add(dn, attrs)
+        return self
+
+    def get(self, key):
+        return self.userclasses.get(key)
+
+    def member_changed(self, key, nested=False):
+        return key in self.changed or (nested and key in self.nested_changed)
+
+class NamespaceAudit(object):
+    """
+    Checks the existing members of the hostgroups, HBAC rules and sudo rules
+    of one namespace with the NamespacePolicy the pre-callback enforces, and
+    hands every violation to emit() as soon as it is found. In incremental
+    mode (since_usn set) a target is only audited when it, or one of its
+    members, changed after since_usn; with nested_hostgroups = transitive
+    a change to a host nested in a member hostgroup counts too.
+    """
+
+    def __init__(self, namespace, members, emit, since_usn=None):
+        self.namespace = namespace
+        self.policy = policy_registry.get(namespace)
+        self.members = members
+        self.emit = emit
+        self.since_usn = since_usn
+        self.targets = 0
+        self.skipped = 0
+        self.violations = 0
+        self.highest_usn = 0
+
+    def audit_target(self, target_type, dn, attrs, member_attr):
+        names = attrs.get("cn", [])
+        tgt_name = names[0] if len(names) else None
+        if namespace_of(tgt_name) != self.namespace:
+            return
+        usn = entry_usn(attrs)
+        self.highest_usn = max(self.highest_usn, usn)
+        member_dns = attrs.get(member_attr.lower(), [])
+        nested = self.policy.transitive
+        if self.since_usn is not None and usn <= self.since_usn \
+                and not any(self.members.member_changed(dn_key(member_dn), nested) for member_dn in member_dns):
+            self.skipped += 1
+            return
+        self.targets += 1
+        for member_dn in member_dns:
+            verdict = self.member_verdict(member_dn)
+            if verdict in NamespacePolicy.DENIALS:
+                self.violations += 1
+                self.emit({
+                    "namespace": self.namespace,
+                    "target_type": target_type,
+                    "target": tgt_name,
+                    "target_dn": dn,
+                    "member": member_dn,
+                    "reason": verdict,
+                    "userclass": list(self.members.get(dn_key(member_dn)) or []),
+                })
+
+    def member_verdict(self, member_dn):
+        cand_name, attr = parse_dn(member_dn)
+        if cand_name is None: # not a host or hostgroup
+            return None
+        key = dn_key(member_dn)
+        is_hostgroup = ",cn=hostgroups," in key
+        verdict = self.policy.member_verdict(cand_name, is_hostgroup, self.members.get(key))
+        if is_hostgroup and self.policy.transitive and verdict not in NamespacePolicy.DENIALS:
+            for host_key in self.members.hosts_of.get(key, ()):
+                if self.policy.member_verdict(parse_dn(host_key)[0], False,
+                                              self.members.get(host_key)) in NamespacePolicy.DENIALS:
+                    return NamespacePolicy.NESTED_MISMATCH
+        return verdict
+
+    def summary(self):
+        return {
+            "namespace": self.namespace,
+            "targets": self.targets,
+            "skipped": self.skipped,
+            "violations": self.violations,
+            "highest_usn": self.highest_usn,
+        }
+
+class AuditWorker(object):
+    """
+    Per-process state of the audit. The parent loads the MemberDirectory
+    before the pool forks, so the workers share it copy-on-write; each
+    worker opens its own LDAP connection.
+    """
+
+    def __init__(self, settings, members, since_usn, lock):
+        self.settings = settings
+        self.members = members
+        self.since_usn = since_usn
+        self.lock = lock
+        self.conn = None
+
+    def emit(self, violation):
+        line = json.dumps(violation, sort_keys=True)
+        with self.lock:
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+
+    def audit_namespace(self, namespace):
+        if self.conn is None:
+            self.conn = connect(self.settings)
+        audit = NamespaceAudit(namespace, self.members, self.emit, self.since_usn)
+        basedn = self.settings["basedn"]
+        for target_type, container, member_attr in TARGETS:
+            entries = paged_search(self.conn, f"{container},{basedn}", f"(cn={namespace}.*)",
+                                   ["cn", member_attr, "entryusn"], self.settings["page_size"])
+            for dn, attrs in entries:
+                audit.audit_target(target_type, dn, attrs, member_attr)
+        return audit.summary()
+
+worker = None
+
+def audit_namespace(namespace):
+    """Pool task; runs in a forked worker that inherited the module's worker."""
+    return worker.audit_namespace(namespace)
+
+def connect(settings):
+    conn = ldap.initialize(settings["uri"])
+    conn.set_option(ldap.OPT_REFERRALS, 0)
+    if settings["bind_dn"]:
+        password = ""
+        if settings["password_file"]:
+            with open(settings["password_file"]) as f:
+                password = f.read().strip()
+        conn.simple_bind_s(settings["bind_dn"], password)
+    elif settings["uri"].startswith("ldapi://"):
+        conn.sasl_external_bind_s()
+    return conn
+
+def target_namespaces(conn, settings):
+    """Streams the names of every target and returns the set of their namespaces."""
+    namespaces = set()
+    for target_type, container, member_attr in TARGETS:
+        entries = paged_search(conn, f"{container},{settings['basedn']}", TARGET_FILTER, ["cn"],
+                               settings["page_size"])
+        for dn, attrs in entries:
+            for name in attrs.get("cn", [])[:1]:
+                namespace = namespace_of(name)
+                if namespace is not None:
+                    namespaces.add(namespace)
+    return namespaces
+
+def load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as err:
+        logging.warning(f"no usable audit state in {path} ({err}), running a full audit")
+        return None
+
+def save_state(path, highest_usn, config_mtime):
+    state = {"version": __version__, "highest_usn": highest_usn, "config_mtime": config_mtime,
+             "finished": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+    tmp_path = f"{path}.{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
+
+def config_mtime():
+    try:
+        return os.stat(policy_registry.path).st_mtime
+    except OSError:
+        return None
+
+def main():
+    global worker
+    parser = argparse.ArgumentParser(description="Audit existing hostgroup, HBAC rule and sudo rule members "
+                                                 "against the namespace policy")
+    parser.add_argument("--uri", help="LDAP URI (default: the IPA server's ldap_uri)")
+    parser.add_argument("--basedn", help="directory suffix (default: the IPA basedn)")
+    parser.add_argument("--bind-dn", default="", help="simple bind DN (default: SASL EXTERNAL over ldapi)")
+    parser.add_argument("--password-file")
+    parser.add_argument("--config", default=hostmgmt_callbacks.HOSTMGMT_CONFIG, help="namespace policy file")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE)
+    parser.add_argument("--incremental", action="store_true",
+                        help="only re-audit targets and members whose entryusn changed since the last run")
+    parser.add_argument("--state", default=AUDIT_STATE, help="where the last audited entryusn is kept")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stderr)
+
+    settings = {"uri": args.uri, "basedn": args.basedn, "bind_dn": args.bind_dn,
+                "password_file": args.password_file, "page_size": args.page_size}
+    if not settings["uri"] or not settings["basedn"]:
+        from ipalib import api
+        if not api.isdone("bootstrap"):
+            api.bootstrap(context="hostmgmt_audit", in_server=True, log=None)
+        settings["uri"] = settings["uri"] or api.env.ldap_uri
+        settings["basedn"] = settings["basedn"] or str(api.env.basedn)
+    policy_registry.path = args.config
+
+    since_usn = None
+    if args.incremental:
+        state = load_state(args.state)
+        if state is not None and state.get("config_mtime") != config_mtime():
+            logging.warning(f"{args.config} changed since the last run, running a full audit")
+        elif state is not None:
+            since_usn = state["highest_usn"]
+
+    start = time.monotonic()
+    conn = connect(settings)
+    members = MemberDirectory(since_usn).load(
+        paged_search(conn, settings["basedn"], MEMBER_FILTER, ["userclass", "entryusn", "memberof"],
+                      args.page_size))
+    namespaces = sorted(target_namespaces(conn, settings))
+    conn.unbind_s()
+    logging.info(f"{len(members.userclasses)} hosts/hostgroups ({len(members.changed)} changed), "
+                 f"{len(namespaces)} namespaces loaded in {time.monotonic() - start:.1f}s")
+
+    worker = AuditWorker(settings, members, since_usn, multiprocessing.get_context("fork").Lock())
+    if args.processes > 1 and len(namespaces) > 1:
+        with multiprocessing.get_context("fork").Pool(min(args.processes, len(namespaces))) as pool:
+            summaries = list(pool.imap_unordered(audit_namespace, namespaces))
+    else:
+        summaries = [audit_namespace(namespace) for namespace in namespaces]
+
+    violations = sum(s["violations"] for s in summaries)
+    highest_usn = max([members.highest_usn] + [s["highest_usn"] for s in summaries])
+    for s in sorted(summaries, key=lambda s: s["namespace"]):
+        if s["violations"]:
+            logging.info(f"{s['namespace']:<20}{s['targets']:>8} targets{s['violations']:>8} violations")
+    logging.info(f"audited {sum(s['targets'] for s in summaries)} targets "
+                 f"(skipped {sum(s['skipped'] for s in summaries)} unchanged), "
+                 f"{violations} violations in {time.monotonic() - start:.1f}s")
+    save_state(args.state, highest_usn, config_mtime())
+    return 1 if violations else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,310 @@
+#! /usr/bin/env python3
+
+__version__ = "1.0.0"
+
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+from ldap import SCOPE_BASE, SCOPE_ONELEVEL
+from ipapython.dn import DN
+from ipalib.errors import NotFound
+
+import hostmgmt_callbacks
+
+# NOTE: runs offline on a host with the IPA server python packages installed;
+# no IdM instance is needed, the plugin talks to FakeLDAP2 below.
+#
+#   ./bench_hostmgmt_callbacks.py --hosts 100000 --save-baseline bench_baseline.json
+#   ./bench_hostmgmt_callbacks.py --hosts 100000 --baseline bench_baseline.json
+
+BASE_DN = "dc=bench-idm,dc=jpl,dc=nasa,dc=gov"
+COMPUTERS = f"cn=computers,cn=accounts,{BASE_DN}"
+HOSTGROUPS = f"cn=hostgroups,cn=accounts,{BASE_DN}"
+HBAC = f"cn=hbac,{BASE_DN}"
+SUDORULES = f"cn=sudorules,cn=sudo,{BASE_DN}"
+
+TARGET_TYPES = ("hostgroup", "hbacrule", "sudorule")
+BATCH_SIZES = (1, 100, 10000)
+
+FILTER_TERM = re.compile(r"\(([^()=|&!]+)=([^()]*)\)")
+
+class FakeEntry(dict):
+    """
+    Search result with the parts of ipaldap.LDAPEntry that entry_to_dict()
+    uses: attribute iteration, raw values and conn.get_attribute_type().
+    """
+
+    def __init__(self, conn, dn, attrs):
+        super().__init__(attrs)
+        self.conn = conn
+        self.dn = DN(dn)
+
+    @property
+    def raw(self):
+        return dict((attr, [v.encode("utf-8") for v in values]) for attr, values in self.items())
+
+class FakeLDAP2(object):
+    """
+    In-memory stand-in for the ldap2 surface the plugin uses: get_entry(),
+    get_entries() (SCOPE_BASE and SCOPE_ONELEVEL), make_filter_from_attr(),
+    combine_filters(), MATCH_ALL/MATCH_ANY and get_attribute_type(). Entries
+    are indexed by container and lower case RDN value so OR-filter searches
+    cost O(terms); memberof terms scan the container.
+    """
+
+    MATCH_ALL = "&"
+    MATCH_ANY = "|"
+
+    def __init__(self):
+        self.containers = {} # lower case container DN -> {lower case RDN value: (dn, attrs)}
+        self.searches = 0
+
+    def add(self, container, rdn_attr, rdn_value, attrs):
+        dn = f"{rdn_attr}={rdn_value},{container}"
+        self.containers.setdefault(container.lower(), {})[rdn_value.lower()] = (dn, attrs)
+        return dn
+
+    def remove(self, container, rdn_value):
+        records = self.containers.get(container.lower(), {})
+        return records.pop(rdn_value.lower(), None)
+
+    def find(self, container, rdn_value):
+        return self.containers.get(container.lower(), {}).get(rdn_value.lower())
+
+    def get_entry(self, dn, attrs_list=None):
+        return self.get_entries(dn, SCOPE_BASE, attrs_list=attrs_list)[0]
+
+    def matches(self, record, terms):
+        """OR of equality terms; memberof is compared against the entry's attribute values."""
+        dn, attrs = record
+        rdn_value = dn.split(",", 1)[0].split("=", 1)[1].lower()
+        memberof = set(v.lower() for v in attrs.get("memberof", []))
+        for attr, value in terms:
+            if (value.lower() in memberof) if attr.lower() == "memberof" else (value.lower() == rdn_value):
+                return True
+        return False
+
+    def combine_filters(self, filters, rules="|"):
+        return f"({rules}{''.join(filters)})"
+
+    def get_attribute_type(self, attr):
+        return str
+
+    def make_filter_from_attr(self, attr, value, rules="|", exact=True):
+        values = value if isinstance(value, (list, tuple)) else [value]
+        terms = "".join(f"({attr}={v})" for v in values)
+        return terms if len(values) == 1 else f"({rules}{terms})"
+
+    def get_entries(self, base_dn, scope=None, filter=None, attrs_list=None, size_limit=None,
+                    paged_search=False, **kwargs):
+        self.searches += 1
+        terms = FILTER_TERM.findall(filter or "")
+        if scope == SCOPE_BASE:
+            rdn, container = str(base_dn).split(",", 1)
+            values = [rdn.split("=", 1)[1]]
+        else:
+            container = str(base_dn)
+            values = [v for attr, v in terms]
+        records = self.containers.get(container.lower(), {})
+        if scope == SCOPE_ONELEVEL and values == ["*"]:
+            found = list(records.values())
+        elif scope == SCOPE_ONELEVEL and any(attr.lower() == "memberof" for attr, v in terms):
+            found = [record for record in records.values() if self.matches(record, terms)]
+        else:
+            found = [records[v.lower()] for v in values if v.lower() in records]
+        if not found:
+            raise NotFound(reason=f"{base_dn} not found")
+        wanted = None if attrs_list is None else set(a.lower() for a in attrs_list)
+        results = []
+        for dn, attrs in found:
+            if wanted is not None:
+                attrs = dict((a, v) for a, v in attrs.items() if a.lower() in wanted)
+            results.append(FakeEntry(self, dn, attrs))
+        return results
+
+def build_directory(num_hosts, num_namespaces, target_hosts):
+    """
+    Synthetic directory: the first target_hosts hosts belong to the first
+    namespace (the benchmark target), the rest are spread round-robin over
+    the others; every tenth host has no userclass. Each namespace has one
+    hostgroup, HBAC rule and sudo rule. Returns (ldap, hosts by namespace,
+    targets by namespace).
+    """
+    ldap = FakeLDAP2()
+    namespaces = [f"ns{i:03d}" for i in range(num_namespaces)]
+    hosts = dict((ns, []) for ns in namespaces)
+    targets = {}
+    for i in range(num_hosts):
+        ns = namespaces[0] if i < target_hosts else namespaces[i % num_namespaces]
+        fqdn = f"host{i:06d}.{ns}.jpl.nasa.gov"
+        attrs = {"fqdn": [fqdn]}
+        if i % 10:
+            attrs["userclass"] = [ns]
+        hosts[ns].append(ldap.add(COMPUTERS, "fqdn", fqdn, attrs))
+    for n, ns in enumerate(namespaces):
+        hostgroup = ldap.add(HOSTGROUPS, "cn", f"{ns}.hgroup", {"cn": [f"{ns}.hgroup"]})
+        hbacrule = ldap.add(HBAC, "ipaUniqueID", f"hbac-{n:06d}",
+                            {"cn": [f"{ns}.hbacrule"], "ipaUniqueID": [f"hbac-{n:06d}"]})
+        sudorule = ldap.add(SUDORULES, "ipaUniqueID", f"sudo-{n:06d}",
+                            {"cn": [f"{ns}.sudorule"], "ipaUniqueID": [f"sudo-{n:06d}"]})
+        targets[ns] = {"hostgroup": hostgroup, "hbacrule": hbacrule, "sudorule": sudorule}
+    return ldap, hosts, targets
+
+def member_add(ldap, tgt_dn, target_type, cand_dns):
+    """One pre-callback invocation; returns (seconds, searches, hosts kept)."""
+    key = "member" if target_type == "hostgroup" else "memberhost"
+    candidates = {key: {"host": list(cand_dns), "hostgroup": []}}
+    rejects = {key: {"host": [], "hostgroup": []}}
+    searches = ldap.searches
+    start = time.perf_counter()
+    hostmgmt_callbacks.deny_if_any_non_namespace_members(None, ldap, tgt_dn, candidates, rejects)
+    elapsed = time.perf_counter() - start
+    return (elapsed, ldap.searches - searches, len(candidates[key]["host"]))
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+def clear_caches():
+    hostmgmt_callbacks.userclass_cache.clear()
+    hostmgmt_callbacks.rule_name_cache.clear()
+    hostmgmt_callbacks.hostgroup_closure_cache.clear()
+
+def run_scenario(ldap, hosts, targets, target_type, batch_size, repeat, warm):
+    namespace = sorted(hosts)[0]
+    tgt_dn = DN(targets[namespace][target_type])
+    pool = hosts[namespace]
+    cand_dns = [DN(dn) for dn in (pool * (batch_size // len(pool) + 1))[:batch_size]]
+    latencies, searches = [], []
+    if warm:
+        member_add(ldap, tgt_dn, target_type, cand_dns)
+    for i in range(repeat):
+        if not warm:
+            clear_caches()
+        elapsed, count, kept = member_add(ldap, tgt_dn, target_type, cand_dns)
+        assert kept == len(cand_dns), f"{target_type} denied eligible members"
+        latencies.append(elapsed)
+        searches.append(count)
+    if not warm:
+        clear_caches()
+    tracemalloc.start()
+    member_add(ldap, tgt_dn, target_type, cand_dns)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "target": target_type,
+        "batch": batch_size,
+        "repeat": repeat,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies) * 1000,
+        "searches": max(searches),
+        "peak_kib": peak / 1024.0,
+        "bytes_per_member": peak / batch_size,
+    }
+
+def scenario_key(result):
+    return f"{result['target']}/{result['batch']}"
+
+def compare(results, baseline, tolerance):
+    """Returns the list of regressions against a saved baseline."""
+    regressions = []
+    previous = dict((scenario_key(r), r) for r in baseline["results"])
+    for result in results:
+        before = previous.get(scenario_key(result))
+        if before is None:
+            continue
+        for metric in ("p50_ms", "p95_ms", "searches", "peak_kib"):
+            limit = before[metric] * (1.0 + tolerance)
+            if result[metric] > limit and result[metric] - before[metric] > 0.5:
+                regressions.append(f"{scenario_key(result)} {metric}: {before[metric]:.2f} -> {result[metric]:.2f}")
+    return regressions
+
+def report(results):
+    logging.info(f"{'scenario':<18}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'searches':>10}"
+                 f"{'peak KiB':>12}{'B/member':>10}")
+    for r in results:
+        logging.info(f"{scenario_key(r):<18}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}"
+                     f"{r['max_ms']:>10.2f}{r['searches']:>10}{r['peak_kib']:>12.1f}"
+                     f"{r['peak_kib'] * 1024.0 / r['batch']:>10.0f}")
+
+def report_memory(results, baseline):
+    """Logs the peak memory of each scenario next to the baseline's."""
+    previous = dict((scenario_key(r), r) for r in baseline["results"])
+    for result in results:
+        before = previous.get(scenario_key(result))
+        if before is None or not before["peak_kib"]:
+            continue
+        change = (result["peak_kib"] - before["peak_kib"]) / before["peak_kib"] * 100
+        logging.info(f"{scenario_key(result):<18}peak {before['peak_kib']:>10.1f} -> {result['peak_kib']:>10.1f} KiB"
+                     f" ({change:+.1f}%)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of deny_if_any_non_namespace_members()")
+    parser.add_argument("--hosts", type=int, default=10000, help="hosts in the synthetic directory (10k-500k)")
+    parser.add_argument("--namespaces", type=int, default=50)
+    parser.add_argument("--batches", default=",".join(str(b) for b in BATCH_SIZES),
+                        help="comma separated member counts per add")
+    parser.add_argument("--repeat", type=int, default=0, help="adds per scenario (default scales with batch)")
+    parser.add_argument("--warm", action="store_true", help="keep plugin caches between adds")
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--baseline", metavar="PATH", help="compare against a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stdout)
+    logging.getLogger().handlers[0].addFilter(lambda record: not record.getMessage().startswith("jpl."))
+
+    # deterministic plugin settings: built-in policy defaults, no shared cache file, no index
+    hostmgmt_callbacks.policy_registry.path = os.devnull
+    hostmgmt_callbacks.shared_cache.enabled = False
+
+    start = time.perf_counter()
+    batch_sizes = [int(b) for b in args.batches.split(",")]
+    ldap, hosts, targets = build_directory(args.hosts, args.namespaces, min(max(batch_sizes), args.hosts))
+    logging.info(f"directory: {args.hosts} hosts, {args.namespaces} namespaces "
+                 f"({time.perf_counter() - start:.1f}s to build)")
+
+    results = []
+    for target_type in TARGET_TYPES:
+        for batch_size in batch_sizes:
+            repeat = args.repeat or max(3, min(200, 20000 // batch_size))
+            results.append(run_scenario(ldap, hosts, targets, target_type, batch_size, repeat, args.warm))
+    report(results)
+
+    document = {
+        "version": __version__,
+        "hosts": args.hosts,
+        "namespaces": args.namespaces,
+        "warm": args.warm,
+        "python": sys.version.split()[0],
+        "results": results,
+    }
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+        logging.info(f"baseline saved to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if (baseline["hosts"], baseline["namespaces"], baseline["warm"]) != (args.hosts, args.namespaces, args.warm):
+            logging.warning("baseline was recorded with a different directory size or cache mode")
+        report_memory(results, baseline)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            logging.warning(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        logging.info("no regressions against baseline")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,17 +1,1718 @@
 __version__ = "1.0.0"
 
+import configparser
+import cProfile
+import fcntl
+import hashlib
+import io
+import json
 import logging
-import re
+import mmap
+import os
+import pstats
+import queue
+import random
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from ldap import SCOPE_SUBTREE, SCOPE_ONELEVEL, SCOPE_BASE
+from ldap import LDAPError, TIMEOUT as LDAPTimeout
+from ldap.ldapobject import SimpleLDAPObject
+from ldap.syncrepl import SyncreplConsumer
 from ipapython.dn import DN
+from ipapython.ipaldap import LDAPClient
 
-from ipalib.errors import InternalError
+from ipalib import Command, Str, StrEnum, output, _
+from ipalib.errors import InternalError, NotFound
+from ipalib.plugable import Registry
+from ipalib.request import context
 
 from ipaserver.plugins.baseldap import entry_to_dict
-from ipaserver.plugins.hostgroup import hostgroup_add_member
-from ipaserver.plugins.hbacrule import (hbacrule_add_host)
-from ipaserver.plugins.sudorule import (sudorule_add_host)
+from ipaserver.plugins.host import (host_mod, host_del)
+from ipaserver.plugins.hostgroup import (hostgroup_add_member, hostgroup_remove_member, hostgroup_mod,
+                                         hostgroup_del)
+from ipaserver.plugins.hbacrule import (hbacrule_add_host, hbacrule_mod)
+from ipaserver.plugins.sudorule import (sudorule_add_host, sudorule_mod)
+
+# Maximum number of candidates named in a single OR-filter userclass search.
+# Keeps filters well under server filter-length limits on large member adds.
+USERCLASS_BATCH_SIZE = 100
+
+# Process-wide userclass cache settings. Entries younger than
+# USERCLASS_CACHE_FRESH seconds are used as-is; older entries are revalidated
+# with an entryusn check and dropped once they are USERCLASS_CACHE_TTL seconds
+# old. Set USERCLASS_CACHE_ENABLED to False to always read from LDAP.
+USERCLASS_CACHE_ENABLED = True
+USERCLASS_CACHE_SIZE = 10000
+USERCLASS_CACHE_FRESH = 30
+USERCLASS_CACHE_TTL = 600
+
+# HBAC/Sudo rule name cache settings. Rule names are looked up by ipaUniqueID;
+# with RULE_NAME_CACHE_WARM the first lookup in a rule container loads every
+# rule name in that container with one paged search.
+RULE_NAME_CACHE_ENABLED = True
+RULE_NAME_CACHE_TTL = 3600
+RULE_NAME_CACHE_WARM = True
+
+# Effective (transitive) host members of hostgroup candidates, used when the
+# policy sets nested_hostgroups = transitive. Like the userclass cache,
+# records younger than HOSTGROUP_CLOSURE_FRESH seconds are used as-is and
+# older ones are revalidated with an entryusn check of the nested hostgroups.
+HOSTGROUP_CLOSURE_CACHE_ENABLED = True
+HOSTGROUP_CLOSURE_CACHE_SIZE = 1000
+HOSTGROUP_CLOSURE_FRESH = 30
+HOSTGROUP_CLOSURE_TTL = 600
+
+# Namespace policy configuration. The [namespace_policy] section holds the
+# defaults and a [namespace:<name>] section overrides them for one namespace.
+# The file is optional; without it the built-in defaults below apply.
+HOSTMGMT_CONFIG = "/etc/ipa/hostmgmt_callbacks.conf"
+POLICY_DEFAULTS = {
+    "exempt_prefixes": "icam, ips",
+    "hostgroup_names": "exact, prefixed",
+    "userclass_match": "exact",
+    "evaluation": "fail_fast",
+    "enforcement": "all_or_nothing",
+    "nested_hostgroups": "direct",
+}
+
+# Background namespace index ([namespace_index] section of HOSTMGMT_CONFIG).
+# Disabled by default; it needs a bind identity that may read userclass,
+# for example a system account under cn=sysaccounts,cn=etc (bind_dn and
+# password_file; SASL EXTERNAL when bind_dn is empty, i.e. the ldapi peer
+# uid), and the 389-ds content synchronization plugin.
+INDEX_DEFAULTS = {
+    "enabled": "false",
+    "uri": "",
+    "basedn": "",
+    "bind_dn": "",
+    "password_file": "",
+    "max_lag": "30",
+    "poll": "5",
+}
+
+# Per-call instrumentation ([metrics] section of HOSTMGMT_CONFIG). When
+# enabled, each worker aggregates timings and counts in memory and rewrites
+# path (where {pid} is the worker pid) at most every interval seconds.
+METRICS_DEFAULTS = {
+    "enabled": "false",
+    "path": "/run/ipa/hostmgmt_callbacks.{pid}.prom",
+    "format": "prometheus",
+    "interval": "60",
+}
+
+# Structured allow/deny decision log ([decision_log] section of
+# HOSTMGMT_CONFIG). Records are queued in a bounded in-memory buffer and
+# appended by a background thread to one JSON-lines file shared by all
+# workers, rotated at max_bytes. mode = summary writes one record per call.
+DECISION_LOG_DEFAULTS = {
+    "enabled": "false",
+    "path": "/var/log/ipa/hostmgmt_decisions.log",
+    "mode": "decisions",
+    "buffer": "10000",
+    "max_bytes": "10485760",
+    "backups": "5",
+    "flush_interval": "1",
+}
+
+# Pool of read-only LDAP connections for the candidates that cannot be read
+# with a batched search ([lookup_pool] section of HOSTMGMT_CONFIG). Up to
+# concurrency candidates are read at the same time; while disabled they are
+# read one by one on the request's connection. The pool is shared by the
+# requests of every user, so it binds as a dedicated service identity
+# (bind_dn and password_file, both required) allowed to read userclass.
+LOOKUP_POOL_DEFAULTS = {
+    "enabled": "false",
+    "concurrency": "4",
+    "uri": "",
+    "bind_dn": "",
+    "password_file": "",
+}
+
+# On-demand profiling ([profiling] section of HOSTMGMT_CONFIG). While
+# enabled, rate of the calls run under cProfile and those taking threshold
+# seconds or more are written to spool, which keeps the newest max_files.
+PROFILING_DEFAULTS = {
+    "enabled": "false",
+    "threshold": "1.0",
+    "rate": "1.0",
+    "spool": "/var/log/ipa/hostmgmt_profiles",
+    "max_files": "50",
+    "top": "40",
+}
+
+# Cross-worker cache file shared by every IPA framework process on the server.
+# It has to live in a directory writable by the IPA API user (/run/ipa is
+# not), created at boot by hostmgmt_callbacks.tmpfiles; when it cannot be
+# opened the plugin logs a warning and uses only the in-process caches.
+SHARED_CACHE_ENABLED = True
+SHARED_CACHE_PATH = "/run/ipa/hostmgmt/hostmgmt_callbacks.cache"
+SHARED_CACHE_SLOTS = 65536
+
+class SharedNamespaceCache(object):
+    """
+    Memory-mapped hash table shared by all IPA worker processes.
+
+    The file holds a header and SHARED_CACHE_SLOTS fixed 128 byte records:
+
+        seq u32 | key digest 16s | kind u8 | pad | value length u16 |
+        generation u64 | entryusn u64 | stored_at u32 | value 84s
+
+    Keys are dn_key() strings (USERCLASS records, value is the userclass
+    list joined by newlines) or ipaUniqueID values (RULE_NAME records).
+    Readers never lock: each record is guarded by a sequence counter that
+    writers make odd while they update it, and a reader retries when it sees
+    an odd or changed counter. Writers serialize with flock(). A record is
+    only valid while its generation equals the header generation, so
+    invalidate_all() drops every record by bumping one counter. The file
+    outlives worker recycling, so a new worker starts with a warm cache.
+    """
+
+    USERCLASS, RULE_NAME = (1, 2)
+
+    MAGIC = b"HMCB"
+    VERSION = 1
+    HEADER = struct.Struct("<4sIIIQ") # magic, version, slots, slot size, generation
+    HEADER_SIZE = 64
+    GENERATION_OFFSET = 16
+    SLOT = struct.Struct("<I16sBxHQQI")
+    SLOT_SIZE = 128
+    VALUE_SIZE = SLOT_SIZE - SLOT.size
+    PROBES = 8
+    NO_USN = 0xFFFFFFFFFFFFFFFF
+
+    def __init__(self, path=SHARED_CACHE_PATH, slots=SHARED_CACHE_SLOTS, enabled=SHARED_CACHE_ENABLED):
+        self.path = path
+        self.slots = slots
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.fd = None
+        self.mm = None
+
+    def open(self):
+        """Maps the cache file on first use; returns False if it is unusable."""
+        if self.mm is not None:
+            return True
+        if not self.enabled:
+            return False
+        with self.lock:
+            if self.mm is not None:
+                return True
+            size = SharedNamespaceCache.HEADER_SIZE + self.slots * SharedNamespaceCache.SLOT_SIZE
+            try:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    if os.fstat(fd).st_size != size or not self.valid_header(os.pread(fd, 24, 0)):
+                        os.ftruncate(fd, 0)
+                        os.ftruncate(fd, size)
+                        header = SharedNamespaceCache.HEADER.pack(SharedNamespaceCache.MAGIC,
+                            SharedNamespaceCache.VERSION, self.slots, SharedNamespaceCache.SLOT_SIZE, 1)
+                        os.pwrite(fd, header, 0)
+                    self.mm = mmap.mmap(fd, size)
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                self.fd = fd
+            except OSError as err:
+                logging.warning(f"{DenyIneligibleMembers.log_prefix} shared cache {self.path} disabled - {err}")
+                self.enabled = False
+                return False
+        return True
+
+    def valid_header(self, data):
+        if len(data) < SharedNamespaceCache.HEADER.size:
+            return False
+        magic, version, slots, slot_size, generation = SharedNamespaceCache.HEADER.unpack(data)
+        return (magic == SharedNamespaceCache.MAGIC and version == SharedNamespaceCache.VERSION
+                and slots == self.slots and slot_size == SharedNamespaceCache.SLOT_SIZE)
+
+    def generation(self):
+        return struct.unpack_from("<Q", self.mm, SharedNamespaceCache.GENERATION_OFFSET)[0]
+
+    def digest(self, key):
+        return hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+
+    def slot_offsets(self, digest):
+        first = int.from_bytes(digest[:8], "little") % self.slots
+        for i in range(SharedNamespaceCache.PROBES):
+            yield SharedNamespaceCache.HEADER_SIZE + ((first + i) % self.slots) * SharedNamespaceCache.SLOT_SIZE
+
+    def read_slot(self, offset):
+        """Consistent snapshot of one record, or None if a writer kept it busy."""
+        for attempt in range(3):
+            data = self.mm[offset:offset + SharedNamespaceCache.SLOT_SIZE]
+            seq = struct.unpack_from("<I", data)[0]
+            if seq & 1:
+                continue
+            if struct.unpack_from("<I", self.mm, offset)[0] == seq:
+                return data
+        return None
+
+    def lookup(self, kind, key, now=None):
+        """
+        Returns (value, entryusn, age_secs) for key or None. USERCLASS
+        values are returned as a list, RULE_NAME values as a string.
+        """
+        if not self.open():
+            return None
+        now = time.time() if now is None else now
+        digest = self.digest(key)
+        generation = self.generation()
+        for offset in self.slot_offsets(digest):
+            data = self.read_slot(offset)
+            if data is None:
+                continue
+            seq, slot_digest, slot_kind, vlen, slot_gen, usn, stored_at = SharedNamespaceCache.SLOT.unpack_from(data)
+            if slot_digest != digest or slot_kind != kind or slot_gen != generation:
+                continue
+            value = data[SharedNamespaceCache.SLOT.size:SharedNamespaceCache.SLOT.size + vlen].decode("utf-8")
+            if kind == SharedNamespaceCache.USERCLASS:
+                value = value.split("\n") if value else []
+            usn = None if usn == SharedNamespaceCache.NO_USN else str(usn)
+            return (value, usn, max(now - stored_at, 0))
+        return None
+
+    def store(self, kind, key, value, usn=None, now=None):
+        """Returns False when the value was not stored (no file, or too long for a record)."""
+        if not self.open():
+            return False
+        if kind == SharedNamespaceCache.USERCLASS:
+            value = "\n".join(value)
+        encoded = value.encode("utf-8")
+        if len(encoded) > SharedNamespaceCache.VALUE_SIZE:
+            # does not fit a fixed record and stays in the in-process cache
+            # only; drop an older record of the key, or other workers keep
+            # reading the old value
+            self.invalidate(kind, key)
+            return False
+        try:
+            usn = int(usn) if usn is not None else SharedNamespaceCache.NO_USN
+        except ValueError:
+            usn = SharedNamespaceCache.NO_USN
+        now = int(time.time() if now is None else now)
+        digest = self.digest(key)
+        with self.write_lock():
+            generation = self.generation()
+            target, oldest = (None, None)
+            for offset in self.slot_offsets(digest):
+                seq, slot_digest, slot_kind, vlen, slot_gen, slot_usn, stored_at = \
+                    SharedNamespaceCache.SLOT.unpack_from(self.mm, offset)
+                if slot_gen != generation or slot_kind == 0 or (slot_digest == digest and slot_kind == kind):
+                    target = offset
+                    break
+                if oldest is None or stored_at < oldest[1]:
+                    oldest = (offset, stored_at)
+            target = oldest[0] if target is None else target
+            self.write_slot(target, digest, kind, encoded, generation, usn, now)
+        return True
+
+    def invalidate(self, kind, key):
+        if not self.open():
+            return
+        digest = self.digest(key)
+        with self.write_lock():
+            for offset in self.slot_offsets(digest):
+                slot_digest, slot_kind = struct.unpack_from("<16sB", self.mm, offset + 4)
+                if slot_digest == digest and slot_kind == kind:
+                    self.write_slot(offset, bytes(16), 0, b"", 0, SharedNamespaceCache.NO_USN, 0)
+
+    def invalidate_all(self):
+        """Drops every record by advancing the header generation."""
+        if not self.open():
+            return
+        with self.write_lock():
+            struct.pack_into("<Q", self.mm, SharedNamespaceCache.GENERATION_OFFSET, self.generation() + 1)
+
+    def write_slot(self, offset, digest, kind, encoded, generation, usn, stored_at):
+        seq = struct.unpack_from("<I", self.mm, offset)[0]
+        struct.pack_into("<I", self.mm, offset, (seq + 1) | 1) # odd: readers retry
+        SharedNamespaceCache.SLOT.pack_into(self.mm, offset, (seq + 1) | 1, digest, kind,
+                                            len(encoded), generation, usn, stored_at)
+        start = offset + SharedNamespaceCache.SLOT.size
+        self.mm[start:start + len(encoded)] = encoded
+        struct.pack_into("<I", self.mm, offset, ((seq + 1) | 1) + 1) # even: record complete
+
+    def write_lock(self):
+        return SharedCacheWriteLock(self)
+
+class SharedCacheWriteLock(object):
+    """Serializes SharedNamespaceCache writers across threads and processes."""
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def __enter__(self):
+        self.cache.lock.acquire()
+        fcntl.flock(self.cache.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self.cache.fd, fcntl.LOCK_UN)
+        self.cache.lock.release()
+        return False
+
+shared_cache = SharedNamespaceCache()
+
+class UserclassCache(object):
+    """
+    Bounded LRU cache of host/hostgroup userclass values keyed by dn_key().
+
+    Each record holds the userclass list, the entryusn it was read at and the
+    time it was stored. lookup() classifies a record as fresh (use it), stale
+    (confirm its entryusn before use) or missing/expired (read it from LDAP).
+    The cache is shared by all requests served by the process, so every
+    method takes the lock. When the cross-worker SharedNamespaceCache is
+    usable it is the source of truth, so an invalidation in one worker is
+    seen by all; writes go to both. A userclass list too long for a shared
+    record is kept in this cache only (local_only) and looked up here.
+    """
+
+    FRESH, STALE = ("fresh", "stale")
+
+    def __init__(self, max_entries=USERCLASS_CACHE_SIZE, fresh_secs=USERCLASS_CACHE_FRESH,
+                 ttl_secs=USERCLASS_CACHE_TTL, enabled=USERCLASS_CACHE_ENABLED, shared=None):
+        self.max_entries = max_entries
+        self.fresh_secs = fresh_secs
+        self.ttl_secs = ttl_secs
+        self.enabled = enabled
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # dn_key -> (userclasses, entryusn, stored_at)
+        self.values = {} # userclass tuple -> the one list shared by all records with it
+        self.local_only = set() # dn_keys whose userclasses do not fit a shared record
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+        self.revalidations = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def lookup(self, dn, now=None):
+        """
+        Returns (state, userclasses, entryusn) where state is FRESH, STALE or
+        None when the caller has to read the entry from LDAP.
+        """
+        if not self.enabled:
+            return (None, None, None)
+        now = time.monotonic() if now is None else now
+        if self.shared is not None and self.shared.open():
+            # the shared record is authoritative: any worker drops it when the
+            # host or hostgroup is modified or deleted
+            record = None
+            shared_record = self.shared.lookup(SharedNamespaceCache.USERCLASS, dn)
+            if shared_record is not None:
+                userclasses, usn, age = shared_record
+                record = (userclasses, usn, now - age)
+                with self.lock:
+                    self.shared_hits += 1
+            else:
+                with self.lock:
+                    if dn in self.local_only:
+                        record = self.entries.get(dn)
+        else:
+            with self.lock:
+                record = self.entries.get(dn)
+        with self.lock:
+            if record is None:
+                self.entries.pop(dn, None)
+                self.misses += 1
+                return (None, None, None)
+            userclasses, usn, stored_at = record
+            age = now - stored_at
+            if age >= self.ttl_secs or (age >= self.fresh_secs and usn is None):
+                self.entries.pop(dn, None) # expired, or stale and cannot be revalidated
+                self.misses += 1
+                return (None, None, None)
+            if dn in self.entries:
+                self.entries.move_to_end(dn)
+            if age < self.fresh_secs:
+                self.hits += 1
+                return (UserclassCache.FRESH, userclasses, usn)
+            return (UserclassCache.STALE, userclasses, usn)
+
+    def store(self, dn, userclasses, usn, now=None):
+        if not self.enabled:
+            return
+        now = time.monotonic() if now is None else now
+        userclasses = self.interned(userclasses)
+        with self.lock:
+            self.entries[dn] = (userclasses, usn, now)
+            self.entries.move_to_end(dn)
+            self.evict()
+        self.share(dn, userclasses, usn)
+
+    def share(self, dn, userclasses, usn):
+        if self.shared is not None:
+            stored = self.shared.store(SharedNamespaceCache.USERCLASS, dn, userclasses, usn)
+            with self.lock:
+                if stored:
+                    self.local_only.discard(dn)
+                else:
+                    self.local_only.add(dn)
+
+    def interned(self, userclasses):
+        """
+        Returns the interned copy of userclasses; a directory has few
+        distinct userclass lists, so records share them instead of holding
+        one copy each. Callers must not modify the lists they get back.
+        """
+        values = tuple(userclasses)
+        with self.lock:
+            value = self.values.get(values)
+            if value is None:
+                value = self.values[values] = list(values)
+        return value
+
+    def evict(self):
+        while len(self.entries) > self.max_entries:
+            dn, record = self.entries.popitem(last=False)
+            self.local_only.discard(dn)
+            self.evictions += 1
+
+    def revalidated(self, dn, userclasses, usn, now=None):
+        """Marks a stale record fresh again after its entryusn was confirmed."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if dn in self.entries:
+                self.entries[dn] = (userclasses, usn, now)
+            self.hits += 1
+            self.revalidations += 1
+        self.share(dn, userclasses, usn)
+
+    def invalidate(self, dn):
+        with self.lock:
+            if self.entries.pop(dn, None) is not None:
+                self.invalidations += 1
+            self.local_only.discard(dn)
+            self.misses += 1
+        if self.shared is not None:
+            self.shared.invalidate(SharedNamespaceCache.USERCLASS, dn)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.values.clear()
+            self.local_only.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "shared_hits": self.shared_hits,
+                "revalidations": self.revalidations,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions,
+            }
+
+userclass_cache = UserclassCache(shared=shared_cache)
+
+class HostgroupClosureCache(object):
+    """
+    Bounded LRU cache of the effective host members of hostgroups, keyed by
+    dn_key() of the hostgroup.
+
+    A record maps every host reachable through nested hostgroups (dn_key ->
+    DN) and holds the entryusn of the hostgroup and of each hostgroup nested
+    in it; a membership change anywhere in the tree changes one of them.
+    lookup() classifies records as fresh, stale or missing like
+    UserclassCache. invalidate() drops every record that contains the given
+    hostgroup or host, so the post-callbacks keep this worker exact; other
+    workers see the change at their next entryusn revalidation.
+    """
+
+    def __init__(self, max_entries=HOSTGROUP_CLOSURE_CACHE_SIZE, fresh_secs=HOSTGROUP_CLOSURE_FRESH,
+                 ttl_secs=HOSTGROUP_CLOSURE_TTL, enabled=HOSTGROUP_CLOSURE_CACHE_ENABLED):
+        self.max_entries = max_entries
+        self.fresh_secs = fresh_secs
+        self.ttl_secs = ttl_secs
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # dn_key -> (hosts, usns, stored_at)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def lookup(self, key, now=None):
+        """Returns (state, hosts, usns); state is FRESH, STALE or None."""
+        if not self.enabled:
+            return (None, None, None)
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            record = self.entries.get(key)
+            if record is None or now - record[2] >= self.ttl_secs:
+                self.entries.pop(key, None)
+                self.misses += 1
+                return (None, None, None)
+            self.entries.move_to_end(key)
+            hosts, usns, stored_at = record
+            if now - stored_at < self.fresh_secs:
+                self.hits += 1
+                return (UserclassCache.FRESH, hosts, usns)
+            return (UserclassCache.STALE, hosts, usns)
+
+    def store(self, key, hosts, usns, now=None):
+        if not self.enabled:
+            return
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.entries[key] = (hosts, usns, now)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def revalidated(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            record = self.entries.get(key)
+            if record is not None:
+                self.entries[key] = (record[0], record[1], now)
+            self.hits += 1
+
+    def invalidate(self, member_key):
+        with self.lock:
+            stale = [key for key, (hosts, usns, stored_at) in self.entries.items()
+                     if member_key in usns or member_key in hosts]
+            for key in stale:
+                del self.entries[key]
+            self.invalidations += len(stale)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+            }
+
+hostgroup_closure_cache = HostgroupClosureCache()
+
+class RuleNameCache(object):
+    """
+    Cache of HBAC/Sudo rule names keyed by ipaUniqueID.
+
+    Rule DNs are ipaUniqueID based, so resolving the namespace of a rule
+    target otherwise costs an extra search for its cn on every member add.
+    Names are filled lazily or a whole rule container at a time by warm(),
+    and a rule rename drops its record (see invalidate_renamed_rule()).
+    Names are also kept in the cross-worker SharedNamespaceCache so a rename
+    is seen by every worker.
+    """
+
+    def __init__(self, ttl_secs=RULE_NAME_CACHE_TTL, enabled=RULE_NAME_CACHE_ENABLED, shared=None):
+        self.ttl_secs = ttl_secs
+        self.enabled = enabled
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.names = {} # ipauniqueid (lower case) -> (rule name, stored_at)
+        self.warmed = set() # rule containers (lower case DN strings) already loaded
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, unique_id, now=None):
+        if not self.enabled:
+            return None
+        now = time.monotonic() if now is None else now
+        key = unique_id.lower()
+        with self.lock:
+            record = self.names.get(key)
+        if self.shared is not None:
+            # the shared record is authoritative: it is dropped on rename
+            shared_record = self.shared.lookup(SharedNamespaceCache.RULE_NAME, key)
+            if shared_record is not None:
+                name, usn, age = shared_record
+                record = (name, now - age)
+            elif record is not None and self.shared.enabled \
+                    and len(record[0].encode("utf-8")) <= SharedNamespaceCache.VALUE_SIZE:
+                record = None # renamed (or evicted) in another worker
+        with self.lock:
+            if record is not None and now - record[1] < self.ttl_secs:
+                self.names[key] = record
+                self.hits += 1
+                return record[0]
+            self.names.pop(key, None)
+            self.misses += 1
+            return None
+
+    def store(self, unique_id, name, now=None):
+        if not self.enabled:
+            return
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.names[unique_id.lower()] = (name, now)
+        if self.shared is not None:
+            self.shared.store(SharedNamespaceCache.RULE_NAME, unique_id.lower(), name)
+
+    def invalidate(self, unique_id):
+        with self.lock:
+            self.names.pop(unique_id.lower(), None)
+        if self.shared is not None:
+            self.shared.invalidate(SharedNamespaceCache.RULE_NAME, unique_id.lower())
+
+    def needs_warming(self, container):
+        return self.enabled and RULE_NAME_CACHE_WARM and str(container).lower() not in self.warmed
+
+    def warm(self, ldap, container):
+        """
+        Loads the names of every rule in container (cn=hbac or
+        cn=sudorules,cn=sudo) with one paged ONELEVEL search.
+        """
+        with self.lock:
+            self.warmed.add(str(container).lower())
+        try:
+            results = ldap.get_entries(
+                          container,
+                          scope=SCOPE_ONELEVEL,
+                          filter="(ipaUniqueID=*)",
+                          attrs_list=['ipaUniqueID', 'cn'],
+                          size_limit=-1, # paged search will get everything anyway
+                          paged_search=True)
+        except NotFound:
+            results = []
+        except Exception as err:
+            logging.warning(f"{DenyIneligibleMembers.log_prefix} rule name cache warm-up of {container} failed - {err}")
+            results = []
+        now = time.monotonic()
+        for entry in results:
+            attrs = entry_to_dict(entry, raw=True)
+            unique_ids = attrs.get("ipaUniqueID", attrs.get("ipauniqueid", []))
+            names = attrs.get("cn", [])
+            if len(unique_ids) and len(names):
+                self.store(unique_ids[0], names[0], now)
+
+    def clear(self):
+        with self.lock:
+            self.names.clear()
+            self.warmed.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "size": len(self.names),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+rule_name_cache = RuleNameCache(shared=shared_cache)
+
+class NamespacePolicy(object):
+    """
+    Namespace policy for one target namespace, compiled from configuration.
+
+    Settings (see POLICY_DEFAULTS):
+    - exempt_prefixes: candidate names starting with one of these prefixes
+      are exempt from namespace policies (at some point the 'ips' exemption
+      may be revoked)
+    - hostgroup_names: 'exact' allows a hostgroup named like the namespace,
+      'prefixed' allows hostgroups named namespace.<name>
+    - userclass_match: 'exact' requires userclass == namespace, 'subnamespace'
+      also accepts namespace.<name> as the host_manage permission filter does
+    - evaluation: 'fail_fast' stops at the first denied member, 'report_all'
+      evaluates every member so all offending members are reported
+    - enforcement: 'all_or_nothing' fails the whole add when a member is
+      denied, 'partial' rejects only the denied members and adds the rest
+      (partial always evaluates every member)
+    - nested_hostgroups: 'direct' checks a hostgroup candidate's own name and
+      userclass, 'transitive' also checks every host nested in it
+
+    Every check is a plain string or set operation.
+    """
+
+    ELIGIBLE, EXEMPT = ("eligible", "exempt")
+    NAME_MISMATCH, USERCLASS_MISMATCH, NOT_FOUND = ("name mismatch", "userclass mismatch", "not found")
+    NESTED_MISMATCH = "nested member mismatch"
+    DENIALS = frozenset((NAME_MISMATCH, USERCLASS_MISMATCH, NOT_FOUND, NESTED_MISMATCH))
+
+    __slots__ = ("namespace", "exempt_prefixes", "hostgroup_exact", "hostgroup_prefix",
+                 "userclass_prefix", "lc_namespace", "fail_fast",
+                 "partial_accept", "transitive")
+
+    def __init__(self, namespace, settings):
+        self.namespace = namespace
+        self.lc_namespace = namespace.lower()
+        self.exempt_prefixes = tuple(split_setting(settings["exempt_prefixes"]))
+        hostgroup_names = set(v.lower() for v in split_setting(settings["hostgroup_names"]))
+        unknown = hostgroup_names - {"exact", "prefixed"}
+        if unknown:
+            raise ValueError(f"unknown hostgroup_names '{', '.join(sorted(unknown))}'")
+        self.hostgroup_exact = "exact" in hostgroup_names
+        self.hostgroup_prefix = f"{self.lc_namespace}." if "prefixed" in hostgroup_names else None
+        userclass_match = settings["userclass_match"].strip().lower()
+        if userclass_match not in ("exact", "subnamespace"):
+            raise ValueError(f"unknown userclass_match '{userclass_match}'")
+        self.userclass_prefix = f"{namespace}." if userclass_match == "subnamespace" else None
+        evaluation = settings["evaluation"].strip().lower()
+        if evaluation not in ("fail_fast", "report_all"):
+            raise ValueError(f"unknown evaluation '{evaluation}'")
+        enforcement = settings["enforcement"].strip().lower()
+        if enforcement not in ("all_or_nothing", "partial"):
+            raise ValueError(f"unknown enforcement '{enforcement}'")
+        self.partial_accept = enforcement == "partial"
+        self.fail_fast = evaluation == "fail_fast" and not self.partial_accept
+        nested_hostgroups = settings["nested_hostgroups"].strip().lower()
+        if nested_hostgroups not in ("direct", "transitive"):
+            raise ValueError(f"unknown nested_hostgroups '{nested_hostgroups}'")
+        self.transitive = nested_hostgroups == "transitive"
+
+    def is_exempt(self, cand_name):
+        return cand_name.startswith(self.exempt_prefixes) if self.exempt_prefixes else False
+
+    def hostgroup_name_allowed(self, cand_name):
+        lc_name = cand_name.lower()
+        if self.hostgroup_exact and lc_name == self.lc_namespace:
+            return True
+        if self.hostgroup_prefix is not None and lc_name.startswith(self.hostgroup_prefix):
+            return True
+        return False
+
+    def member_verdict(self, cand_name, is_hostgroup, userclasses):
+        """
+        Verdict for one candidate member, in the order DenyIneligibleMembers
+        applies the checks. userclasses is None when the entry was not found.
+        Returns ELIGIBLE, EXEMPT or one of the denial reasons.
+        """
+        if self.is_exempt(cand_name):
+            return NamespacePolicy.EXEMPT
+        if is_hostgroup and not self.hostgroup_name_allowed(cand_name):
+            return NamespacePolicy.NAME_MISMATCH
+        if userclasses is None:
+            return NamespacePolicy.NOT_FOUND
+        if not self.userclasses_eligible(userclasses):
+            return NamespacePolicy.USERCLASS_MISMATCH
+        return NamespacePolicy.ELIGIBLE
+
+    def userclasses_eligible(self, userclasses):
+        if not userclasses: # no namespace by attribute
+            return True
+        for userclass in userclasses:
+            if userclass == self.namespace:
+                return True
+            if self.userclass_prefix is not None and userclass.startswith(self.userclass_prefix):
+                return True
+        return False
+
+def split_setting(value):
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+class PolicyRegistry(object):
+    """
+    Loads HOSTMGMT_CONFIG and hands out one compiled NamespacePolicy per
+    namespace. The file is re-read only when its modification time changes,
+    which costs a single stat() per member add.
+    """
+
+    def __init__(self, path=HOSTMGMT_CONFIG):
+        self.path = path
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.config = None
+        self.policies = {}
+
+    def load(self):
+        config = self.default_config()
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime is not None:
+            try:
+                config.read(self.path)
+            except configparser.Error as err:
+                logging.warning(f"{DenyIneligibleMembers.log_prefix} ignoring {self.path} - {err}")
+                config = self.default_config()
+        return mtime, config
+
+    def default_config(self):
+        config = configparser.ConfigParser(interpolation=None) # ldapi:// URIs are %-encoded
+        config.read_dict({"namespace_policy": POLICY_DEFAULTS, "namespace_index": INDEX_DEFAULTS,
+                          "metrics": METRICS_DEFAULTS, "decision_log": DECISION_LOG_DEFAULTS,
+                          "lookup_pool": LOOKUP_POOL_DEFAULTS, "profiling": PROFILING_DEFAULTS})
+        return config
+
+    def current_config(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        with self.lock:
+            if self.config is None or mtime != self.mtime:
+                self.mtime, self.config = self.load()
+                self.policies = {}
+            return self.config
+
+    def settings(self, namespace, config=None):
+        config = self.current_config() if config is None else config
+        settings = dict(config["namespace_policy"])
+        section = f"namespace:{namespace.lower()}"
+        if config.has_section(section):
+            settings.update(config[section])
+        return settings
+
+    def get(self, namespace):
+        config = self.current_config()
+        policy = self.policies.get(namespace)
+        if policy is None:
+            try:
+                policy = NamespacePolicy(namespace, self.settings(namespace, config))
+            except ValueError as err:
+                # logged once per file change: the policy is kept until then
+                logging.warning(f"{DenyIneligibleMembers.log_prefix} ignoring {self.path} policy for "
+                                f"'{namespace}' - {err}; using the defaults")
+                policy = NamespacePolicy(namespace, POLICY_DEFAULTS)
+            with self.lock:
+                if self.config is config:
+                    self.policies[namespace] = policy
+        return policy
+
+policy_registry = PolicyRegistry()
+
+class NamespaceIndex(object):
+    """
+    In-memory map of every host/hostgroup DN to its userclasses and every
+    HBAC/Sudo rule ipaUniqueID to its name, kept current in a background
+    thread.
+
+    The thread runs a content synchronization (syncrepl) search in
+    refreshAndPersist mode: the refresh phase is the bulk load of the whole
+    directory and the persist phase streams every later change. While the
+    index is current DenyIneligibleMembers answers from memory without LDAP
+    round trips. It is not current before the refresh is done, after the
+    connection drops, or when the thread has not polled for max_lag seconds;
+    callers then use the regular lookups. A DN missing from a current index
+    also falls back, because a just-added entry may not have arrived yet.
+    A refresh that loads hosts but not a single userclass value means the
+    bind identity cannot read userclass; the index then never becomes
+    current, since an empty userclass would make every host eligible.
+
+    The apply_*() methods are the whole update interface, so the index can be
+    fed by any stand-in for the LDAP consumer.
+    """
+
+    HOST_CLASSES = frozenset(("ipahost", "ipahostgroup"))
+    RULE_CLASSES = frozenset(("ipahbacrule", "ipasudorule"))
+    FILTER = "(|(objectclass=ipahost)(objectclass=ipahostgroup)(objectclass=ipahbacrule)(objectclass=ipasudorule))"
+    ATTRS = ["objectclass", "userclass", "cn", "ipaUniqueID"]
+
+    def __init__(self, max_lag=30):
+        self.max_lag = max_lag
+        self.lock = threading.Lock()
+        self.thread = None
+        self.userclasses = {} # dn_key -> userclass list
+        self.rule_names = {} # ipauniqueid (lower case) -> rule name
+        self.uuids = {} # sync uuid -> (kind, key)
+        self.ready = False
+        self.last_poll = None
+        self.hits = 0
+        self.fallbacks = 0
+        self.refresh_hosts = 0 # host/hostgroup entries loaded by the current refresh
+        self.refresh_userclasses = 0 # ... of which carried a userclass value
+        self.userclass_readable = None
+
+    def ensure_started(self):
+        """Starts the consumer thread once per process if the index is enabled."""
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is not None:
+                return
+            settings = policy_registry.current_config()["namespace_index"]
+            if settings.get("enabled", "false").strip().lower() not in ("true", "yes", "1"):
+                self.thread = False # disabled; do not look again in this process
+                return
+            self.max_lag = int(settings.get("max_lag", "30"))
+            self.thread = threading.Thread(target=self.run, args=(dict(settings),),
+                                           name="hostmgmt-namespace-index", daemon=True)
+            self.thread.start()
+
+    def is_current(self, now=None):
+        if not self.ready or self.last_poll is None:
+            return False
+        now = time.monotonic() if now is None else now
+        return now - self.last_poll < self.max_lag
+
+    def get_userclasses(self, key):
+        userclasses = self.userclasses.get(key)
+        if userclasses is None:
+            self.fallbacks += 1
+        else:
+            self.hits += 1
+        return userclasses
+
+    def get_rule_name(self, unique_id):
+        return self.rule_names.get(unique_id.lower())
+
+    def begin_refresh(self):
+        with self.lock:
+            self.ready = False
+            self.userclasses = {}
+            self.rule_names = {}
+            self.uuids = {}
+            self.refresh_hosts = 0
+            self.refresh_userclasses = 0
+
+    def apply_entry(self, dn, attrs, uuid=None):
+        """
+        Adds or replaces one entry. attrs maps lower case attribute names to
+        lists of str values.
+        """
+        objectclasses = set(v.lower() for v in attrs.get("objectclass", []))
+        with self.lock:
+            if objectclasses & NamespaceIndex.HOST_CLASSES:
+                key = dn_key(dn)
+                self.userclasses[key] = list(attrs.get("userclass", []))
+                record = ("host", key)
+                if not self.ready:
+                    self.refresh_hosts += 1
+                    if self.userclasses[key]:
+                        self.refresh_userclasses += 1
+            elif objectclasses & NamespaceIndex.RULE_CLASSES and attrs.get("ipauniqueid") and attrs.get("cn"):
+                key = attrs["ipauniqueid"][0].lower()
+                self.rule_names[key] = attrs["cn"][0]
+                record = ("rule", key)
+            else:
+                return
+            if uuid is not None:
+                previous = self.uuids.get(uuid)
+                if previous is not None and previous != record:
+                    self.forget(previous) # renamed/moved entry
+                self.uuids[uuid] = record
+
+    def apply_delete(self, uuids):
+        with self.lock:
+            for uuid in uuids:
+                record = self.uuids.pop(uuid, None)
+                if record is not None:
+                    self.forget(record)
+
+    def apply_present(self, uuids, refresh_deletes=False):
+        if uuids is not None and refresh_deletes:
+            self.apply_delete(uuids)
+
+    def forget(self, record):
+        kind, key = record
+        if kind == "host":
+            self.userclasses.pop(key, None)
+        else:
+            self.rule_names.pop(key, None)
+
+    def refresh_done(self):
+        self.last_poll = time.monotonic()
+        self.userclass_readable = self.refresh_userclasses > 0 or not self.refresh_hosts
+        if not self.userclass_readable:
+            logging.error(f"{DenyIneligibleMembers.log_prefix} namespace index: none of {self.refresh_hosts} "
+                          f"hosts/hostgroups has a readable userclass; check the bind identity. "
+                          f"The index stays unused")
+            return
+        self.ready = True
+
+    def heartbeat(self):
+        self.last_poll = time.monotonic()
+
+    def disconnected(self):
+        self.ready = False
+
+    def stats(self):
+        return {
+            "ready": self.ready,
+            "current": self.is_current(),
+            "userclasses": len(self.userclasses),
+            "rule_names": len(self.rule_names),
+            "userclass_readable": self.userclass_readable,
+            "hits": self.hits,
+            "fallbacks": self.fallbacks,
+        }
+
+    def run(self, settings):
+        uri, basedn = (settings.get("uri"), settings.get("basedn"))
+        if not uri or not basedn:
+            from ipalib import api
+            uri = uri or api.env.ldap_uri
+            basedn = basedn or str(api.env.basedn)
+        poll = int(settings.get("poll", "5"))
+        backoff = 1
+        while True:
+            try:
+                self.begin_refresh()
+                conn = IndexSyncConsumer(self, uri)
+                self.bind(conn, settings)
+                msgid = conn.syncrepl_search(basedn, SCOPE_SUBTREE, mode="refreshAndPersist",
+                                             filterstr=NamespaceIndex.FILTER,
+                                             attrlist=NamespaceIndex.ATTRS)
+                backoff = 1
+                while True:
+                    try:
+                        if not conn.syncrepl_poll(msgid=msgid, timeout=poll, all=1):
+                            break
+                    except LDAPTimeout:
+                        pass
+                    self.heartbeat()
+            except (LDAPError, OSError) as err:
+                logging.warning(f"{DenyIneligibleMembers.log_prefix} namespace index disconnected - {err}")
+            self.disconnected()
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+    def bind(self, conn, settings):
+        """Simple bind as bind_dn, or SASL EXTERNAL (never anonymous: it cannot read userclass)."""
+        if settings.get("bind_dn"):
+            with open(settings["password_file"]) as f:
+                conn.simple_bind_s(settings["bind_dn"], f.read().strip())
+        else:
+            conn.sasl_external_bind_s()
+
+class IndexSyncConsumer(SimpleLDAPObject, SyncreplConsumer):
+    """
+    syncrepl consumer that feeds a NamespaceIndex. No cookie is kept, so
+    every (re)connect starts with a full refresh.
+    """
+
+    def __init__(self, index, uri):
+        SimpleLDAPObject.__init__(self, uri)
+        self.index = index
+
+    def syncrepl_get_cookie(self):
+        return None
+
+    def syncrepl_set_cookie(self, cookie):
+        pass
+
+    def syncrepl_entry(self, dn, attributes, uuid):
+        attrs = {}
+        for name, values in attributes.items():
+            attrs[name.lower()] = [v.decode("utf-8") if isinstance(v, bytes) else v for v in values]
+        self.index.apply_entry(dn, attrs, uuid)
+
+    def syncrepl_delete(self, uuids):
+        self.index.apply_delete(uuids)
+
+    def syncrepl_present(self, uuids, refreshDeletes=False):
+        self.index.apply_present(uuids, refreshDeletes)
+
+    def syncrepl_refreshdone(self):
+        self.index.refresh_done()
+
+namespace_index = NamespaceIndex()
+
+class CallMetrics(object):
+    """Timings and counts of one deny_if_any_non_namespace_members() call."""
+
+    PHASES = ("target", "parse", "lookup", "enforce")
+
+    __slots__ = ("start", "last", "phases", "target_type", "candidates", "denials",
+                 "searches", "cache_hits", "cache_misses")
+
+    def __init__(self):
+        self.start = self.last = time.perf_counter()
+        self.phases = dict.fromkeys(CallMetrics.PHASES, 0.0)
+        self.target_type = "unknown"
+        self.candidates = 0
+        self.denials = 0
+        self.searches = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def lap(self, phase):
+        """Charges the time since the previous lap to phase."""
+        now = time.perf_counter()
+        self.phases[phase] += now - self.last
+        self.last = now
+
+    def duration(self):
+        return self.last - self.start
+
+class Metrics(object):
+    """
+    Per-process aggregate of CallMetrics, tagged by target type (hostgroup,
+    hbacrule, sudorule). recorder() returns None while metrics are disabled,
+    so a disabled call costs one config check and no timing.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    COUNTERS = ("calls", "candidates", "denials", "searches", "cache_hits", "cache_misses")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.path = None
+        self.format = "prometheus"
+        self.interval = 60
+        self.config = None
+        self.last_dump = time.monotonic()
+        self.targets = {}
+
+    def configure(self):
+        config = policy_registry.current_config()
+        if config is not self.config:
+            settings = config["metrics"]
+            self.enabled = settings.get("enabled", "false").strip().lower() in ("true", "yes", "1")
+            self.path = settings.get("path")
+            self.format = settings.get("format", "prometheus").strip().lower()
+            self.interval = int(settings.get("interval", "60"))
+            self.config = config
+
+    def recorder(self):
+        self.configure()
+        return CallMetrics() if self.enabled else None
+
+    def record(self, call):
+        with self.lock:
+            target = self.targets.get(call.target_type)
+            if target is None:
+                target = dict.fromkeys(Metrics.COUNTERS, 0)
+                target["phase_seconds"] = dict.fromkeys(CallMetrics.PHASES, 0.0)
+                target["duration_seconds"] = 0.0
+                target["buckets"] = [0] * len(Metrics.BUCKETS)
+                self.targets[call.target_type] = target
+            target["calls"] += 1
+            target["candidates"] += call.candidates
+            target["denials"] += call.denials
+            target["searches"] += call.searches
+            target["cache_hits"] += call.cache_hits
+            target["cache_misses"] += call.cache_misses
+            for phase, secs in call.phases.items():
+                target["phase_seconds"][phase] += secs
+            duration = call.duration()
+            target["duration_seconds"] += duration
+            for i, bound in enumerate(Metrics.BUCKETS):
+                if duration <= bound:
+                    target["buckets"][i] += 1
+            due = self.path and time.monotonic() - self.last_dump >= self.interval
+        if due:
+            self.dump()
+
+    def snapshot(self):
+        with self.lock:
+            return json.loads(json.dumps(self.targets))
+
+    def dump(self, path=None, format_=None):
+        """Writes the aggregate as Prometheus text or JSON, replacing the file atomically."""
+        path = (path or self.path).format(pid=os.getpid())
+        format_ = format_ or self.format
+        self.last_dump = time.monotonic()
+        snapshot = self.snapshot()
+        content = self.to_json(snapshot) if format_ == "json" else self.to_prometheus(snapshot)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(content)
+            os.rename(tmp_path, path)
+        except OSError as err:
+            logging.warning(f"{DenyIneligibleMembers.log_prefix} metrics dump to {path} failed - {err}")
+
+    def to_json(self, snapshot):
+        return json.dumps({"pid": os.getpid(), "targets": snapshot}, indent=2, sort_keys=True)
+
+    def to_prometheus(self, snapshot):
+        lines = []
+        for counter in Metrics.COUNTERS:
+            lines.append(f"# TYPE hostmgmt_{counter}_total counter")
+            for target, values in sorted(snapshot.items()):
+                lines.append(f'hostmgmt_{counter}_total{{target="{target}"}} {values[counter]}')
+        lines.append("# TYPE hostmgmt_phase_seconds_total counter")
+        for target, values in sorted(snapshot.items()):
+            for phase, secs in values["phase_seconds"].items():
+                lines.append(f'hostmgmt_phase_seconds_total{{target="{target}",phase="{phase}"}} {secs:.6f}')
+        lines.append("# TYPE hostmgmt_call_duration_seconds histogram")
+        for target, values in sorted(snapshot.items()):
+            for bound, count in zip(Metrics.BUCKETS, values["buckets"]):
+                lines.append(f'hostmgmt_call_duration_seconds_bucket{{target="{target}",le="{bound}"}} {count}')
+            lines.append(f'hostmgmt_call_duration_seconds_bucket{{target="{target}",le="+Inf"}} {values["calls"]}')
+            lines.append(f'hostmgmt_call_duration_seconds_sum{{target="{target}"}} {values["duration_seconds"]:.6f}')
+            lines.append(f'hostmgmt_call_duration_seconds_count{{target="{target}"}} {values["calls"]}')
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class LDAPSearchCounter(object):
+    """Wraps an ldap2 connection and counts get_entries() calls into a CallMetrics."""
+
+    def __init__(self, ldap, call):
+        self.ldap = ldap
+        self.call = call
+
+    def get_entries(self, *args, **kwargs):
+        self.call.searches += 1
+        return self.ldap.get_entries(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.ldap, name)
+
+class RequestMemo(object):
+    """
+    Lookups made while serving one member add command. The pre-callback
+    keeps it in the IPA request context (ipalib.request.context, which is
+    cleared when the request ends) and the add-member post-callback drops
+    it, so it never outlives the command. It holds the stored cn of a rule
+    target once it has been read (not the name as typed: rule names match
+    case-insensitively, the namespace does not), and every candidate
+    userclass read or found missing, so no entry is read twice within the
+    command even with the caches disabled. Later callbacks of the same command get
+    it with request_memo().
+    """
+
+    __slots__ = ("target_dn", "target_name", "userclasses", "missing")
+
+    def __init__(self, target_dn):
+        self.target_dn = target_dn
+        self.target_name = None
+        self.userclasses = {} # dn_key -> userclass list
+        self.missing = set() # dn_key of candidates not found
+
+    def remember(self, keys, userclass_map):
+        self.userclasses.update(userclass_map)
+        self.missing.update(key for key in keys if key not in userclass_map)
+
+def begin_request_memo(dn):
+    memo = RequestMemo(dn)
+    context.hostmgmt_memo = memo
+    return memo
+
+def request_memo(dn=None):
+    """The memo of the command being served (for dn, if given), or None."""
+    memo = getattr(context, "hostmgmt_memo", None)
+    if memo is not None and (dn is None or memo.target_dn == dn):
+        return memo
+    return None
+
+def end_request_memo():
+    context.__dict__.pop("hostmgmt_memo", None)
+
+class DecisionLog(object):
+    """
+    Asynchronous JSON-lines log of DenyIneligibleMembers decisions.
+
+    The request thread only appends one tuple per call to a bounded buffer;
+    formatting and file I/O happen in a background thread that wakes every
+    flush_interval seconds. A full buffer drops the new record and counts
+    it, so a slow disk never blocks a member add; the drop count is written
+    with the next flush. Each flush appends under an flock on the file and
+    rotates it (path.1 .. path.<backups>) once it exceeds max_bytes, so all
+    workers can share one file. Like Metrics, recorder() returns None while
+    the log is disabled.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.config = None
+        self.enabled = False
+        self.summary_only = False
+        self.path = None
+        self.capacity = 10000
+        self.max_bytes = 10485760
+        self.backups = 5
+        self.flush_interval = 1.0
+        self.buffer = []
+        self.dropped = 0
+        self.thread = None
+        self.pid = None
+        self.sequence = 0
+
+    def configure(self):
+        config = policy_registry.current_config()
+        if config is not self.config:
+            settings = config["decision_log"]
+            self.enabled = settings.get("enabled", "false").strip().lower() in ("true", "yes", "1")
+            self.summary_only = settings.get("mode", "decisions").strip().lower() == "summary"
+            self.path = settings.get("path")
+            self.capacity = int(settings.get("buffer", "10000"))
+            self.max_bytes = int(settings.get("max_bytes", "10485760"))
+            self.backups = int(settings.get("backups", "5"))
+            self.flush_interval = float(settings.get("flush_interval", "1"))
+            self.config = config
+
+    def recorder(self):
+        """Returns the per-call decision map for DenyIneligibleMembers, or None."""
+        self.configure()
+        return OrderedDict() if self.enabled else None
+
+    def record(self, checker, decisions, denied, elapsed):
+        """
+        Queues the decisions of one call. decisions maps dn_key() to
+        (candidate DN, rule, userclasses) for every evaluated candidate.
+        """
+        if self.pid != os.getpid():
+            self.start()
+        denied_keys = set(cand.key for cand in denied)
+        rejected_all = bool(denied_keys) and not checker.policy.partial_accept
+        summary_only = self.summary_only # the item keeps its shape if the mode is reloaded before the flush
+        if summary_only:
+            rules = {}
+            for cand_dn, rule, userclasses in decisions.values():
+                rules[rule] = rules.get(rule, 0) + 1
+            decisions = rules
+        item = (time.time(), checker.tgt_dn, checker.tgt_ns, checker.target_type(),
+                len(checker.candidates), summary_only, decisions, denied_keys, rejected_all, elapsed)
+        with self.lock:
+            if len(self.buffer) >= self.capacity:
+                self.dropped += 1
+                return
+            self.buffer.append(item)
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid() # a forked worker needs its own writer thread
+            self.buffer = []
+            self.dropped = 0
+            self.thread = threading.Thread(target=self.run, name="hostmgmt-decision-log", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as err: # keep the writer alive, or the buffer fills and every record is dropped
+                logging.error(f"{DenyIneligibleMembers.log_prefix} decision log flush failed - {err}")
+
+    def flush(self):
+        with self.lock:
+            items, self.buffer = (self.buffer, [])
+            dropped, self.dropped = (self.dropped, 0)
+        if not items and not dropped:
+            return
+        lines = []
+        for item in items:
+            lines.extend(self.format(item))
+        if dropped:
+            lines.append(json.dumps({"ts": time.time(), "pid": os.getpid(), "dropped": dropped}))
+        try:
+            with self.open_locked() as f:
+                f.write("\n".join(lines) + "\n")
+                f.flush()
+                if f.tell() >= self.max_bytes:
+                    self.rotate()
+        except OSError as err:
+            logging.warning(f"{DenyIneligibleMembers.log_prefix} decision log {self.path} - {err}")
+
+    def open_locked(self):
+        """Opens the current log file for append, locked; retries if it was rotated meanwhile."""
+        while True:
+            f = open(self.path, "a")
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(self.path).st_ino:
+                    return f
+            except OSError:
+                pass
+            f.close()
+
+    def rotate(self):
+        """Called with the file locked; later writers reopen the new file."""
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.rename(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.rename(self.path, f"{self.path}.1")
+        else:
+            os.truncate(self.path, 0)
+
+    def format(self, item):
+        ts, tgt_dn, tgt_ns, target_type, candidates, summary_only, decisions, denied_keys, rejected_all, elapsed = item
+        self.sequence += 1
+        request = f"{os.getpid()}-{self.sequence}"
+        common = {"ts": ts, "request": request, "target": str(tgt_dn), "namespace": tgt_ns,
+                  "target_type": target_type, "elapsed_ms": round(elapsed * 1000, 3)}
+        if summary_only:
+            return [json.dumps(dict(common, candidates=candidates, denied=len(denied_keys),
+                                    rejected_all=rejected_all, rules=decisions), sort_keys=True)]
+        lines = []
+        for key, (cand_dn, rule, userclasses) in decisions.items():
+            denied = key in denied_keys or rejected_all
+            lines.append(json.dumps(dict(common, candidate=str(cand_dn), rule=rule, userclass=userclasses,
+                                         decision="deny" if denied else "allow"), sort_keys=True))
+        return lines
+
+decision_log = DecisionLog()
+
+class Profiler(object):
+    """
+    On-demand cProfile of deny_if_any_non_namespace_members() calls
+    ([profiling] section of HOSTMGMT_CONFIG). While enabled, a fraction
+    (rate) of the calls runs under cProfile; a call that took at least
+    threshold seconds is written to the spool directory as <name>.prof
+    (load with pstats.Stats) and <name>.txt (target, candidate counts and
+    the top functions by cumulative time). Only the newest max_files calls
+    are kept. Like Metrics, recorder() returns None while profiling is
+    disabled, so a disabled call costs one config check.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.config = None
+        self.enabled = False
+        self.threshold = 1.0
+        self.rate = 1.0
+        self.spool = None
+        self.max_files = 50
+        self.top = 40
+        self.sequence = 0
+        self.random = random.Random()
+
+    def configure(self):
+        config = policy_registry.current_config()
+        if config is not self.config:
+            settings = config["profiling"]
+            self.enabled = settings.get("enabled", "false").strip().lower() in ("true", "yes", "1")
+            self.threshold = float(settings.get("threshold", "1.0"))
+            self.rate = float(settings.get("rate", "1.0"))
+            self.spool = settings.get("spool")
+            self.max_files = max(int(settings.get("max_files", "50")), 1)
+            self.top = int(settings.get("top", "40"))
+            self.config = config
+
+    def recorder(self):
+        """Returns an enabled cProfile.Profile for this call, or None."""
+        self.configure()
+        if not self.enabled or (self.rate < 1.0 and self.random.random() >= self.rate):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError: # another profiler is active in this process
+            return None
+        return profile
+
+    def record(self, profile, dn, checker, denied, elapsed):
+        """Called with the profile disabled; spools the call if it was slow."""
+        if elapsed < self.threshold:
+            return
+        with self.lock:
+            self.sequence += 1
+            sequence = self.sequence
+        now = time.time()
+        name = f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime(now))}-{os.getpid()}-{sequence}"
+        path = os.path.join(self.spool, name)
+        candidates = [] if checker is None else checker.candidates
+        hostgroups = sum(1 for cand in candidates if cand.is_hostgroup)
+        header = [
+            f"target: {dn}",
+            f"target_type: {'unknown' if checker is None else checker.target_type()}",
+            f"namespace: {None if checker is None else checker.tgt_ns}",
+            f"candidates: {len(candidates)} (hosts {len(candidates) - hostgroups}, hostgroups {hostgroups})",
+            f"denied: {'-' if denied is None else len(denied)}",
+            f"elapsed_ms: {elapsed * 1000:.3f}",
+            f"ts: {now:.3f}",
+            f"pid: {os.getpid()}",
+            "",
+        ]
+        try:
+            report = io.StringIO()
+            pstats.Stats(profile, stream=report).sort_stats("cumulative").print_stats(self.top)
+            os.makedirs(self.spool, mode=0o750, exist_ok=True)
+            profile.dump_stats(f"{path}.prof")
+            with open(f"{path}.txt", "w") as f:
+                f.write("\n".join(header) + report.getvalue())
+            self.prune()
+        except OSError as err:
+            logging.warning(f"{DenyIneligibleMembers.log_prefix} profile spool {self.spool} - {err}")
+
+    def prune(self):
+        """Keeps the newest max_files profiles; the spool is shared by all workers."""
+        profiles = []
+        for entry in os.scandir(self.spool):
+            if entry.name.endswith(".prof"):
+                try:
+                    profiles.append((entry.stat().st_mtime, entry.name[:-len(".prof")]))
+                except OSError:
+                    pass
+        profiles.sort(reverse=True)
+        for mtime, name in profiles[self.max_files:]:
+            for suffix in (".prof", ".txt"):
+                try:
+                    os.unlink(os.path.join(self.spool, name + suffix))
+                except OSError:
+                    pass
+
+profiler = Profiler()
+
+class CandidateLookups(object):
+    """
+    Single-entry reads of the candidates a batched search could not resolve
+    (a failed chunk, for example one over the server's filter length limit).
+
+    fetch() reads up to concurrency candidates at a time, each over its own
+    read-only connection from a bounded pool; connections are opened on
+    first use and kept for later requests of the worker. A read of a DN
+    that another request of this worker already has in flight is not
+    started again: both wait for the same Future. While the pool is
+    disabled the reads run one by one on the request's connection, still
+    merged with concurrent requests.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.config = None
+        self.enabled = False
+        self.concurrency = 4
+        self.settings = {}
+        self.pid = None
+        self.executor = None
+        self.idle = queue.LifoQueue() # idle pooled connections
+        self.opened = 0
+        self.inflight = {} # dn_key -> Future of the entry (None when not read)
+        self.reads = 0
+        self.merged = 0
+
+    def configure(self):
+        config = policy_registry.current_config()
+        if config is not self.config or self.pid != os.getpid():
+            settings = config["lookup_pool"]
+            with self.lock:
+                self.close()
+                self.enabled = settings.get("enabled", "false").strip().lower() in ("true", "yes", "1")
+                if self.enabled and not (settings.get("bind_dn") and settings.get("password_file")):
+                    logging.error(f"{DenyIneligibleMembers.log_prefix} [lookup_pool] needs bind_dn and "
+                                  f"password_file; reading on the request connection")
+                    self.enabled = False
+                self.concurrency = max(int(settings.get("concurrency", "4")), 1)
+                self.settings = dict(settings)
+                self.pid = os.getpid() # a forked worker needs its own threads and connections
+                self.config = config
+
+    def close(self):
+        """Called with the lock held; in-flight reads finish on the old pool."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        idle, self.idle = (self.idle, queue.LifoQueue())
+        while not idle.empty():
+            self.disconnect(idle.get_nowait())
+
+    def fetch(self, checker, cands):
+        """
+        Reads cands with checker.read_candidate_entry(). Returns a map of
+        dn_key() to entry without the candidates that were not found or
+        could not be read, which the caller then denies.
+        """
+        self.configure()
+        owned = []
+        waits = []
+        with self.lock:
+            for cand in cands:
+                future = self.inflight.get(cand.key)
+                if future is None:
+                    future = self.inflight[cand.key] = Future()
+                    owned.append((cand, future))
+                else:
+                    self.merged += 1
+                waits.append((cand, future))
+            self.reads += len(owned)
+            executor = self.pool_executor() if self.enabled else None
+        for cand, future in owned:
+            try:
+                if executor is not None:
+                    executor.submit(self.read, checker, cand, future)
+                    continue
+            except RuntimeError: # the pool was reconfigured meanwhile
+                pass
+            self.read(checker, cand, future, checker.ldap)
+        if executor is not None and checker.call_metrics is not None:
+            checker.call_metrics.searches += len(owned)
+        entries = {}
+        for cand, future in waits:
+            entry = future.result()
+            if entry is not None:
+                entries[cand.key] = entry
+        return entries
+
+    def pool_executor(self):
+        """Called with the lock held."""
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="hostmgmt-lookup")
+        return self.executor
+
+    def read(self, checker, cand, future, ldap=None):
+        entry = None
+        try:
+            if ldap is not None:
+                entry = checker.get_candidate_entry(cand, ldap)
+            else:
+                entry = self.pooled_read(checker, cand)
+        finally:
+            with self.lock:
+                if self.inflight.get(cand.key) is future:
+                    del self.inflight[cand.key]
+            future.set_result(entry)
+
+    def pooled_read(self, checker, cand):
+        idle = self.idle
+        try:
+            conn = idle.get_nowait()
+        except queue.Empty:
+            conn = None
+        try:
+            if conn is None:
+                conn = self.connect()
+            entry = checker.read_candidate_entry(cand, conn)
+        except NotFound as err:
+            checker.candidate_not_read(cand, err)
+            entry = None
+        except Exception as err:
+            checker.candidate_not_read(cand, err)
+            self.disconnect(conn) # do not hand a broken connection to the next read
+            return None
+        if idle is self.idle:
+            idle.put(conn)
+        else: # the pool was reconfigured meanwhile
+            self.disconnect(conn)
+        return entry
+
+    def connect(self):
+        settings = self.settings
+        uri = settings.get("uri")
+        if not uri:
+            from ipalib import api
+            uri = api.env.ldap_uri
+        with open(settings["password_file"]) as f:
+            password = f.read().strip()
+        # never the process credentials: they belong to the user of the
+        # request that happened to open the connection
+        conn = LDAPClient(uri)
+        conn.simple_bind(DN(settings["bind_dn"]), password)
+        with self.lock:
+            self.opened += 1
+        return conn
+
+    def disconnect(self, conn):
+        if conn is None:
+            return
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "concurrency": self.concurrency,
+            "connections": self.opened,
+            "idle": self.idle.qsize(),
+            "inflight": len(self.inflight),
+            "reads": self.reads,
+            "merged": self.merged,
+        }
+
+candidate_lookups = CandidateLookups()
 
 class DenyIneligibleMembers(object):
     """
@@ -26,115 +1727,275 @@ class DenyIneligibleMembers(object):
     Essentially, the code ensures that if a target group or rule belongs to a
     specific namespace (e.g., 'jpl.hostgroup'), only members from that same
     namespace are permitted. Exceptions are made for certain hostnames (starting
-    with 'icam' or 'ips') and for hostgroups whose names match the target's
-    namespace.
+    with 'icam' or 'ips' by default) and for hostgroups whose names match the
+    target's namespace. The rules are compiled per namespace into a
+    NamespacePolicy.
     """
 
     log_prefix = "jpl.DenyIneligibleMembers -"
 
-    def __init__(self, ldap, tgt_dn, cands, rejects):
+    def __init__(self, ldap, tgt_dn, cands, rejects, call_metrics=None, decisions=None, memo=None):
         assert isinstance(tgt_dn, DN)
         self.lprefix = DenyIneligibleMembers.log_prefix
-        self.ldap = ldap
+        self.call_metrics = call_metrics
+        self.decisions = decisions
+        self.memo = memo
+        self.ldap = ldap if call_metrics is None else LDAPSearchCounter(ldap, call_metrics)
         self.tgt_dn = tgt_dn
         self.tgt_ns = self.target_namespace()
+        self.policy = policy_registry.get(self.tgt_ns) if isinstance(self.tgt_ns, str) else None
+        self.lap("target")
         self.cand_hosts, self.cand_hostgroups = self.candidate_lists(cands)
         self.reject_hosts, self.reject_hostgroups = self.reject_lists(rejects)
+        self.candidates = []
+        if call_metrics is not None:
+            call_metrics.target_type = self.target_type()
+            call_metrics.candidates = len(self.cand_hosts) + len(self.cand_hostgroups)
 
     def execute(self):
+        """Returns the denied Candidate records."""
         if isinstance(self.tgt_ns, str): # hostgroup/hbacrule/sudorule have no namespace
-            denied_dns = []
-            for cand_dn in self.cand_hosts + self.cand_hostgroups:
-                assert isinstance(cand_dn, DN)
-                cand_name, attr = self.parse_dn(cand_dn)
-                if self.exempt_from_namespace_policies(cand_name):
-                    continue
-                if self.exclude_by_hostgroup_name(cand_dn) or self.exclude_by_userclass(cand_dn):
-                    denied_dns.append(cand_dn)
-            self.enforce_exclusions(denied_dns)
+            self.candidates = self.parse_candidates()
+            denied = self.evaluate_candidates()
+            self.lap("lookup")
+            self.enforce_exclusions(denied)
+            self.lap("enforce")
+            if self.call_metrics is not None:
+                self.call_metrics.denials = len(denied)
+            return denied
         else:
             logging.info(f"{self.lprefix} {self.tgt_dn} has no namespace")
+            return None
 
-    def exempt_from_namespace_policies(self, cand_name):
+    def parse_candidates(self):
+        """Parses every candidate DN once into a Candidate record."""
+        return ([Candidate(dn) for dn in self.cand_hosts] +
+                [Candidate(dn, is_hostgroup=True) for dn in self.cand_hostgroups])
+
+    def evaluate_candidates(self):
         """
-        Hosts with names starting with 'icam' or 'ips' are exempt from
-        namespace policies. At some point the 'ips' exemption may be revoked.
+        Returns the denied candidates. Checks run in order of cost: exemption
+        and hostgroup name (no I/O), then cached userclasses, then LDAP
+        lookups in batches. In the default fail_fast evaluation mode the
+        first denial ends the evaluation, because a single denied member
+        already fails the whole operation; report_all evaluates every
+        candidate so operators get the full list of offending members.
         """
-        return True if re.search(r"^(icam|ips)", cand_name) else False
+        fail_fast = self.policy.fail_fast
+        denied = []
+        lookups = []
+        for cand in self.candidates:
+            if cand.name is None: # not a host or hostgroup DN
+                self.decide(cand, NamespacePolicy.NOT_FOUND)
+                denied.append(cand)
+            elif self.exempt_from_namespace_policies(cand.name):
+                self.decide(cand, NamespacePolicy.EXEMPT)
+                continue
+            elif self.exclude_by_hostgroup_name(cand):
+                self.decide(cand, NamespacePolicy.NAME_MISMATCH)
+                denied.append(cand)
+            else:
+                lookups.append(cand)
+                continue
+            if fail_fast:
+                self.lap("parse")
+                return denied
+        self.lap("parse")
+        userclass_map, pending = self.get_cached_userclasses(lookups)
+        if self.call_metrics is not None:
+            self.call_metrics.cache_hits += len(userclass_map)
+            self.call_metrics.cache_misses += len(pending)
+        for cand in lookups:
+            if cand.key in userclass_map and self.exclude_by_userclass(cand, userclass_map):
+                denied.append(cand)
+                if fail_fast:
+                    return denied
+        batch_size = USERCLASS_BATCH_SIZE if fail_fast else max(len(pending), 1)
+        for i in range(0, len(pending), batch_size):
+            batch = pending[i:i + batch_size]
+            userclass_map = self.fetch_candidate_userclasses(batch)
+            for cand, record in batch:
+                if self.exclude_by_userclass(cand, userclass_map):
+                    denied.append(cand)
+            if fail_fast and len(denied):
+                return denied
+        if self.policy.transitive:
+            denied_keys = set(cand.key for cand in denied)
+            nested = [cand for cand in lookups if cand.is_hostgroup and cand.key not in denied_keys]
+            denied.extend(self.exclude_by_nested_members(nested))
+        return denied
+
+    def member_verdicts(self):
+        """
+        Read-only counterpart of evaluate_candidates() for the
+        hostmgmt_check_members command: returns the NamespacePolicy verdict
+        of every candidate, keyed by dn_key(). Candidates that pass the
+        exemption and name checks are resolved with the same cached and
+        batched lookups; nothing is rejected or removed.
+        """
+        verdicts = OrderedDict()
+        self.candidates = self.parse_candidates()
+        if not isinstance(self.tgt_ns, str): # no namespace, nothing is denied
+            for cand in self.candidates:
+                verdicts[cand.key] = NamespacePolicy.ELIGIBLE
+            return verdicts
+        lookups = []
+        for cand in self.candidates:
+            if cand.name is None:
+                verdicts[cand.key] = NamespacePolicy.NOT_FOUND
+                continue
+            verdict = self.policy.member_verdict(cand.name, cand.is_hostgroup, [])
+            verdicts[cand.key] = verdict
+            if verdict == NamespacePolicy.ELIGIBLE:
+                lookups.append(cand)
+        userclass_map = self.get_candidate_userclasses(lookups)
+        for cand in lookups:
+            verdicts[cand.key] = self.policy.member_verdict(cand.name, cand.is_hostgroup,
+                                                            userclass_map.get(cand.key))
+        if self.policy.transitive:
+            nested = [cand for cand in lookups
+                      if cand.is_hostgroup and verdicts[cand.key] == NamespacePolicy.ELIGIBLE]
+            for cand in self.exclude_by_nested_members(nested):
+                verdicts[cand.key] = NamespacePolicy.NESTED_MISMATCH
+        return verdicts
+
+    def decide(self, cand, rule, userclasses=None):
+        """Notes the rule that decided a candidate for the decision log."""
+        if self.decisions is not None:
+            self.decisions[cand.key] = (cand.dn, rule, userclasses)
+
+    def lap(self, phase):
+        if self.call_metrics is not None:
+            self.call_metrics.lap(phase)
+
+    def target_type(self):
+        tgt_dn = str(self.tgt_dn).lower()
+        if self.target_is_sudorule():
+            return "sudorule"
+        if ",cn=hbac,dc=" in tgt_dn:
+            return "hbacrule"
+        if ",cn=hostgroups," in tgt_dn:
+            return "hostgroup"
+        return "unknown"
 
-    def is_hostgroup_candidate(self, cand_dn):
-        return True if cand_dn in self.cand_hostgroups else False
+    def exempt_from_namespace_policies(self, cand_name):
+        """
+        Hosts with names starting with one of the policy's exempt prefixes
+        ('icam' or 'ips' by default) are exempt from namespace policies.
+        """
+        return self.policy.is_exempt(cand_name)
 
-    def exclude_by_hostgroup_name(self, cand_dn):
+    def exclude_by_hostgroup_name(self, cand):
         """
         Denies hostgroup members unless their name matches the target namespace
         or is prefixed by it (e.g., namespace.hostgroup).
         """
-        if self.is_hostgroup_candidate(cand_dn):
-            cand_name, attr = self.parse_dn(cand_dn)
-            if re.search(rf"^{self.tgt_ns}\.", cand_name, re.I) \
-                    or re.search(rf"^{self.tgt_ns}$", cand_name, re.I):
+        if cand.is_hostgroup:
+            if self.policy.hostgroup_name_allowed(cand.name):
                 return False # hostgroup not excluded by hostgroup name
             return True # hostgroup excluded because not in target namespace
         return False # not excluded here because not a hostgroup
 
-    def exclude_by_userclass(self, cand_dn):
+    def exclude_by_userclass(self, cand, userclass_map):
         """
         Denies members unless they are eligible, as determined by their LDAP
-        attributes.
+        attributes. The userclass_map is built by get_candidate_userclasses();
+        a candidate missing from it was not found in LDAP.
         """
-        entry = self.get_candidate_entry(cand_dn)
-        if entry is not None:
-            eligible = self.is_eligible_based_on_userclass(entry)
+        userclasses = userclass_map.get(cand.key)
+        if userclasses is not None:
+            eligible = self.is_eligible_userclasses(userclasses)
+            self.decide(cand, NamespacePolicy.ELIGIBLE if eligible else NamespacePolicy.USERCLASS_MISMATCH,
+                        userclasses)
             return not eligible
         else:
-            logging.info(f"{self.lprefix} {cand_dn} excluded because entry not found")
+            logging.info(f"{self.lprefix} {cand.dn} excluded because entry not found")
+            self.decide(cand, NamespacePolicy.NOT_FOUND)
             return True
 
+    def exclude_by_nested_members(self, hostgroups):
+        """
+        Transitive enforcement: denies hostgroup candidates that contain,
+        directly or through nested hostgroups, a host that would be denied
+        as a direct member. Exempt host names stay exempt, and hosts that
+        are gone since the closure was read are ignored.
+        """
+        if not len(hostgroups):
+            return []
+        closures = self.get_hostgroup_closures(hostgroups)
+        hosts = OrderedDict()
+        for closure in closures.values():
+            hosts.update(closure)
+        host_records = dict((key, Candidate(dn)) for key, dn in hosts.items())
+        userclass_map = self.get_candidate_userclasses(list(host_records.values()))
+        denied = []
+        for cand in hostgroups:
+            for host_key in closures.get(cand.key, {}):
+                host = host_records[host_key]
+                userclasses = userclass_map.get(host_key)
+                if userclasses is None:
+                    continue
+                if self.policy.member_verdict(host.name, False, userclasses) in NamespacePolicy.DENIALS:
+                    logging.info(f"{self.lprefix} {cand.dn} excluded because nested host {host.dn} is not in namespace")
+                    self.decide(cand, NamespacePolicy.NESTED_MISMATCH, userclasses)
+                    denied.append(cand)
+                    break
+        return denied
+
     def is_eligible_based_on_userclass(self, entry):
         """
         An host or hostgroup entry is eligible for membership if it either has
         no userclass attribute or its userclass matches the target group's
         namespace.
         """
+        return self.is_eligible_userclasses(self.entry_userclasses(entry))
+
+    def entry_userclasses(self, entry):
         attrs = entry_to_dict(entry, raw=True)
-        userclasses = attrs.get("userclass", [])
-        eligible = False
-        if not userclasses: # no namespace by attribute
-            eligible = True
-        else:
-            for userclass in userclasses:
-                if userclass == self.tgt_ns:
-                    eligible = True
-                    break
-        return eligible
+        return attrs.get("userclass", [])
+
+    def entry_usn(self, entry):
+        attrs = entry_to_dict(entry, raw=True)
+        usns = attrs.get("entryusn", [])
+        return usns[0] if len(usns) else None
 
-    def enforce_exclusions(self, denied_dns):
+    def is_eligible_userclasses(self, userclasses):
+        return self.policy.userclasses_eligible(userclasses)
+
+    def enforce_exclusions(self, denied):
         """
         If a single member is denied, the entire operation to add all members
-        will fail.
-        """
-        tgt_is_sudorule = self.target_is_sudorule()
-        if len(denied_dns): # there is at least one denied member candidate
-            for dn in self.cand_hosts: # clear candidate hosts
-                self.cand_hosts.remove(dn)
-            for dn in self.cand_hostgroups: # clear candidate hostgroups
-                self.cand_hostgroups.remove(dn)
-            for denied_dn in denied_dns: # provide caller with ineligible candidates
-                if denied_dn in self.cand_hosts:
-                    # this is here to avoid an error downstream in
-                    # ipaserver.plugins.baseldap.add_external_post_callback()
-                    if not tgt_is_sudorule:
-                        self.reject_hosts.append(denied_dn)
-                if denied_dn in self.cand_hostgroups:
-                    self.reject_hostgroups.append(denied_dn)
+        will fail, unless the namespace policy uses partial enforcement; then
+        only the denied members are removed and the rest are added. Denied
+        candidates are handed back to the caller through the reject lists and
+        the candidate lists are updated in place.
+        """
+        if not len(denied): # every member candidate is eligible
+            return
+        denied_keys = set(cand.key for cand in denied)
+        hosts = [cand for cand in self.candidates if not cand.is_hostgroup]
+        hostgroups = [cand for cand in self.candidates if cand.is_hostgroup]
+        # this is here to avoid an error downstream in
+        # ipaserver.plugins.baseldap.add_external_post_callback()
+        if not self.target_is_sudorule():
+            self.reject_hosts.extend(cand.dn for cand in hosts if cand.key in denied_keys)
+        elif self.policy.partial_accept:
+            denied_hosts = [str(cand.dn) for cand in hosts if cand.key in denied_keys]
+            if len(denied_hosts):
+                logging.warning(f"{self.lprefix} {self.tgt_dn} hosts not added: {', '.join(denied_hosts)}")
+        self.reject_hostgroups.extend(cand.dn for cand in hostgroups if cand.key in denied_keys)
+        if self.policy.partial_accept:
+            self.cand_hosts[:] = [cand.dn for cand in hosts if cand.key not in denied_keys]
+            self.cand_hostgroups[:] = [cand.dn for cand in hostgroups if cand.key not in denied_keys]
+        else:
+            del self.cand_hosts[:]
+            del self.cand_hostgroups[:]
 
     def target_namespace(self):
-        tgt_name = self.target_name()
-        if tgt_name is not None:
-            m = re.search(r"^(\w+)\.\w+", tgt_name)
-            return m.group(1) if m else None
-        return None
+        """
+        The namespace is the leading word of a 'namespace.name' target name.
+        """
+        return namespace_of(self.target_name())
 
     def get_target_entry(self):
         id_name, id_attr = self.parse_dn(self.tgt_dn)
@@ -156,41 +2017,269 @@ class DenyIneligibleMembers(object):
         return None
 
     def target_is_sudorule(self):
-        if re.search(r"cn=sudorules,cn=sudo,dc=", str(self.tgt_dn), re.I):
-            return True
-        return False
+        return "cn=sudorules,cn=sudo,dc=" in str(self.tgt_dn).lower()
 
-    def get_candidate_entry(self, dn):
-        assert isinstance(dn, DN)
-        cand_name, attr = self.parse_dn(dn)
-        if attr is not None:
-            filter_ = self.ldap.make_filter_from_attr(attr, cand_name, self.ldap.MATCH_ALL)
-            try:
-                results = self.ldap.get_entries(
-                              dn,
-                              scope=SCOPE_BASE,
-                              filter=filter_,
-                              attrs_list=['userclass'],
-                              size_limit=-1, # paged search will get everything anyway
-                              paged_search=True)
-            except Exception as err:
-                if err:
-                    logging.warning(f"{self.lprefix} SEARCH EXCEPTION: '{type(err)}'='{err}'")
-                logging.warning(f"{self.lprefix} canidate {dn} not found")
-                results = []
+    def get_candidate_entry(self, cand, ldap=None):
+        try:
+            return self.read_candidate_entry(cand, self.ldap if ldap is None else ldap)
+        except Exception as err:
+            self.candidate_not_read(cand, err)
+            return None
+
+    def read_candidate_entry(self, cand, ldap):
+        if cand.attr is not None:
+            filter_ = ldap.make_filter_from_attr(cand.attr, cand.name, ldap.MATCH_ALL)
+            results = ldap.get_entries(
+                          DN(cand.dn),
+                          scope=SCOPE_BASE,
+                          filter=filter_,
+                          attrs_list=['userclass', 'entryusn'],
+                          size_limit=-1, # paged search will get everything anyway
+                          paged_search=True)
             if len(results):
                 return results[0]
         return None
 
+    def candidate_not_read(self, cand, err):
+        if err:
+            logging.warning(f"{self.lprefix} SEARCH EXCEPTION: '{type(err)}'='{err}'")
+        logging.warning(f"{self.lprefix} canidate {cand.dn} not found")
+
+    def get_candidate_userclasses(self, cands):
+        """
+        Resolves the userclass values of many candidates with as few LDAP
+        searches as possible. Returns a map of candidate dn_key() to
+        userclass list; candidates that were not found are absent from the
+        map.
+        """
+        userclass_map, pending = self.get_cached_userclasses(cands)
+        userclass_map.update(self.fetch_candidate_userclasses(pending))
+        return userclass_map
+
+    def get_cached_userclasses(self, cands):
+        """
+        Returns (userclass_map, pending): the userclasses found in the request
+        memo, the namespace_index or fresh in the process-wide
+        userclass_cache, and a list of (candidate, stale_record)
+        for the candidates that still need LDAP. stale_record is the
+        (userclasses, entryusn) of a stale cache entry, or None on a miss.
+        """
+        userclass_map = {}
+        pending = []
+        memo = self.memo
+        index_current = namespace_index.is_current()
+        for cand in cands:
+            key = cand.key
+            if memo is not None:
+                if key in memo.userclasses:
+                    userclass_map[key] = memo.userclasses[key]
+                    continue
+                if key in memo.missing: # read earlier in this command, not found
+                    continue
+            if index_current:
+                userclasses = namespace_index.get_userclasses(key)
+                if userclasses is not None:
+                    userclass_map[key] = userclasses
+                    continue
+            state, userclasses, usn = userclass_cache.lookup(key)
+            if state == UserclassCache.FRESH:
+                userclass_map[key] = userclasses
+            elif state == UserclassCache.STALE:
+                pending.append((cand, (userclasses, usn)))
+            else:
+                pending.append((cand, None))
+        return userclass_map, pending
+
+    def fetch_candidate_userclasses(self, pending):
+        """
+        Resolves pending candidates from get_cached_userclasses(). Stale cache
+        entries are confirmed with an entryusn-only search; misses and
+        entries whose entryusn changed are read in full and cached.
+        """
+        userclass_map = {}
+        fetches = [cand for cand, record in pending if record is None]
+        stale = [(cand, record) for cand, record in pending if record is not None]
+        if stale:
+            entries = self.search_candidates([cand for cand, record in stale], ['entryusn'])
+            for cand, (userclasses, usn) in stale:
+                entry = entries.get(cand.key)
+                if entry is not None and self.entry_usn(entry) == usn:
+                    userclass_cache.revalidated(cand.key, userclasses, usn)
+                    userclass_map[cand.key] = userclasses
+                else:
+                    userclass_cache.invalidate(cand.key)
+                    fetches.append(cand)
+        for key, entry in self.search_candidates(fetches, ['userclass', 'entryusn']).items():
+            userclasses = userclass_cache.interned(self.entry_userclasses(entry))
+            userclass_cache.store(key, userclasses, self.entry_usn(entry))
+            userclass_map[key] = userclasses
+        if self.memo is not None:
+            self.memo.remember([cand.key for cand, record in pending], userclass_map)
+        return userclass_map
+
+    def get_hostgroup_closures(self, hostgroups):
+        """
+        Returns a map of hostgroup dn_key() to its effective hosts (dn_key ->
+        DN), from hostgroup_closure_cache where possible. Stale records are
+        confirmed with one batched entryusn search over all the hostgroups
+        they depend on; the rest are read with fetch_hostgroup_closures().
+        """
+        closures = {}
+        fetches = []
+        stale = []
+        for cand in hostgroups:
+            state, hosts, usns = hostgroup_closure_cache.lookup(cand.key)
+            if state == UserclassCache.FRESH:
+                closures[cand.key] = hosts
+            elif state == UserclassCache.STALE:
+                stale.append((cand, hosts, usns))
+            else:
+                fetches.append(cand)
+        if stale:
+            nested_keys = set(nested_key for cand, hosts, usns in stale for nested_key in usns)
+            entries = self.search_candidates([Candidate(nested_key, is_hostgroup=True) for nested_key in nested_keys],
+                                             ['entryusn'])
+            for cand, hosts, usns in stale:
+                current = dict((nested_key, self.entry_usn(entries[nested_key]))
+                               for nested_key in usns if nested_key in entries)
+                if current == usns:
+                    hostgroup_closure_cache.revalidated(cand.key)
+                    closures[cand.key] = hosts
+                else:
+                    fetches.append(cand)
+        if fetches:
+            closures.update(self.fetch_hostgroup_closures(fetches))
+        return closures
+
+    def fetch_hostgroup_closures(self, hostgroups):
+        """
+        Reads the effective hosts of many hostgroups in bulk. The memberOf
+        plugin lists every enclosing hostgroup, nested or not, on each host
+        and hostgroup, so one memberOf OR-filter search per container and
+        chunk covers a whole tree. The hosts' userclasses come back with
+        the same search and are stored in userclass_cache.
+        """
+        closures = {}
+        for i in range(0, len(hostgroups), USERCLASS_BATCH_SIZE):
+            chunk = hostgroups[i:i + USERCLASS_BATCH_SIZE]
+            keys = set(cand.key for cand in chunk)
+            hosts = dict((key, {}) for key in keys)
+            usns = dict((key, {}) for key in keys)
+            memberof_filter = self.ldap.make_filter_from_attr("memberof", [str(cand.dn) for cand in chunk],
+                                                              self.ldap.MATCH_ANY)
+            container = DN(chunk[0].container)
+            computers = DN(("cn", "computers"), container[1:])
+            cn_filter = self.ldap.make_filter_from_attr("cn", [cand.name for cand in chunk], self.ldap.MATCH_ANY)
+            hostgroup_filter = self.ldap.combine_filters([memberof_filter, cn_filter], self.ldap.MATCH_ANY)
+            for entry in self.search_container(container, hostgroup_filter, ['memberof', 'entryusn']):
+                entry_key = dn_key(entry.dn)
+                usn = self.entry_usn(entry)
+                if entry_key in keys:
+                    usns[entry_key][entry_key] = usn
+                for key in self.entry_memberof(entry) & keys:
+                    usns[key][entry_key] = usn
+            for entry in self.search_container(computers, memberof_filter, ['memberof', 'userclass', 'entryusn']):
+                entry_key = dn_key(entry.dn)
+                userclass_cache.store(entry_key, self.entry_userclasses(entry), self.entry_usn(entry))
+                for key in self.entry_memberof(entry) & keys:
+                    hosts[key][entry_key] = entry.dn
+            for key in keys:
+                hostgroup_closure_cache.store(key, hosts[key], usns[key])
+                closures[key] = hosts[key]
+        return closures
+
+    def search_container(self, container, filter_, attrs_list):
+        try:
+            return self.ldap.get_entries(
+                       container,
+                       scope=SCOPE_ONELEVEL,
+                       filter=filter_,
+                       attrs_list=attrs_list,
+                       size_limit=-1, # paged search will get everything anyway
+                       paged_search=True)
+        except NotFound:
+            return []
+
+    def entry_memberof(self, entry):
+        attrs = entry_to_dict(entry, raw=True)
+        return set(dn_key(dn) for dn in attrs.get("memberof", []))
+
+    def search_candidates(self, cands, attrs_list):
+        """
+        Reads attrs_list for many candidates. Candidates are grouped by parent
+        container (cn=computers, cn=hostgroups) and fetched with chunked
+        OR-filter ONELEVEL searches; a DN is built once per container.
+        Returns a map of dn_key() to entry.
+        """
+        by_container = {}
+        for cand in cands:
+            if cand.attr is None:
+                continue
+            by_container.setdefault((cand.container, cand.attr), []).append(cand)
+        entries = {}
+        for (container, attr), members in by_container.items():
+            container_dn = DN(container)
+            for i in range(0, len(members), USERCLASS_BATCH_SIZE):
+                chunk = members[i:i + USERCLASS_BATCH_SIZE]
+                self.search_candidate_chunk(container_dn, attr, chunk, attrs_list, entries)
+        return entries
+
+    def search_candidate_chunk(self, container, attr, chunk, attrs_list, entries):
+        names = [cand.name for cand in chunk]
+        filter_ = self.ldap.make_filter_from_attr(attr, names, self.ldap.MATCH_ANY)
+        try:
+            results = self.ldap.get_entries(
+                          container,
+                          scope=SCOPE_ONELEVEL,
+                          filter=filter_,
+                          attrs_list=[attr] + attrs_list,
+                          size_limit=-1, # paged search will get everything anyway
+                          paged_search=True)
+        except NotFound:
+            results = []
+        except Exception as err:
+            # fall back to one search per candidate so a bad chunk only
+            # affects the candidates that really cannot be read
+            logging.warning(f"{self.lprefix} BATCH SEARCH EXCEPTION: '{type(err)}'='{err}'")
+            entries.update(candidate_lookups.fetch(self, chunk))
+            return
+        keys = dict((cand.key, cand.key) for cand in chunk)
+        for entry in results:
+            key = dn_key(entry.dn)
+            entries[keys.get(key, key)] = entry # keep the candidate's key string, not a copy
+
     def target_name(self):
         tgt_name, id_attr = self.parse_dn(self.tgt_dn)
-        if re.search(r"ipaUniqueID", id_attr, re.I):
-            tgt_entry = self.get_target_entry() # get hbacrule/sudorule
+        if id_attr.lower() == "ipauniqueid":
+            if self.memo is not None and self.memo.target_name is not None:
+                return self.memo.target_name # stored cn, read earlier in this command
+            rule_name = self.stored_rule_name(tgt_name)
+            if rule_name is not None:
+                if self.memo is not None:
+                    self.memo.target_name = rule_name
+                return rule_name
+        return tgt_name
+
+    def stored_rule_name(self, unique_id):
+        """The cn of the hbacrule/sudorule with ipaUniqueID unique_id, as stored."""
+        if namespace_index.is_current():
+            rule_name = namespace_index.get_rule_name(unique_id)
+            if rule_name is not None:
+                return rule_name
+        rule_container = DN(self.tgt_dn[1:])
+        if rule_name_cache.needs_warming(rule_container):
+            rule_name_cache.warm(self.ldap, rule_container)
+        rule_name = rule_name_cache.get(unique_id)
+        if rule_name is not None:
+            return rule_name
+        tgt_entry = self.get_target_entry() # get hbacrule/sudorule
+        if tgt_entry is not None:
             attrs = entry_to_dict(tgt_entry, raw=True)
             tgt_names = attrs.get("cn", [])
             if len(tgt_names):
+                rule_name_cache.store(unique_id, tgt_names[0])
                 return tgt_names[0]
-        return tgt_name
+        return None
 
     def candidate_lists(self, cands):
         dict_ = cands.get('member', cands.get('memberhost', None))
@@ -201,12 +2290,63 @@ class DenyIneligibleMembers(object):
         return (dict_.get('host', []), dict_.get('hostgroup', []))
 
     def parse_dn(self, dn):
-        attr, name = (None, None)
-        # This regex supports host, hostgroup, hbacrule and sudorule DNs
-        m = re.search(r"^(cn|fqdn|ipaUniqueID)=([^,]+),.+", str(dn), re.I) 
-        if m:
-            attr, name = (m.group(1), m.group(2))
-        return name, attr
+        return parse_dn(dn)
+
+def dn_key(dn):
+    """Normalized, hashable key for a DN (DN comparison is case-insensitive)."""
+    return str(dn).lower()
+
+DN_NAMING_ATTRS = frozenset(("cn", "fqdn", "ipauniqueid"))
+
+def parse_dn(dn):
+    """
+    Splits the first RDN of a host, hostgroup, hbacrule or sudorule DN into
+    (name, attr); returns (None, None) for any other DN.
+    """
+    dn_str = str(dn)
+    attr, sep, rest = dn_str.partition("=")
+    if sep and attr.lower() in DN_NAMING_ATTRS:
+        name, sep, parent = rest.partition(",")
+        if sep and name and parent:
+            return name, attr
+    return None, None
+
+class Candidate(object):
+    """
+    A member candidate, parsed once. dn is the DN IPA passed in, kept only to
+    be handed back through the reject lists; the rest of the evaluation works
+    on key (dn_key()), name and the interned naming attribute and parent
+    container strings, which all the hosts of a container share. attr, name
+    and container are None for a DN that is not a host or hostgroup.
+    """
+
+    __slots__ = ("dn", "key", "attr", "name", "container", "is_hostgroup")
+
+    def __init__(self, dn, is_hostgroup=False):
+        dn_str = str(dn)
+        self.dn = dn
+        self.key = dn_str.lower()
+        self.is_hostgroup = is_hostgroup
+        self.attr = self.name = self.container = None
+        attr, sep, rest = dn_str.partition("=")
+        if sep and attr.lower() in DN_NAMING_ATTRS:
+            name, sep, parent = rest.partition(",")
+            if sep and name and parent:
+                self.attr = sys.intern(attr)
+                self.name = name
+                self.container = sys.intern(parent)
+
+def namespace_of(name):
+    """Leading word of a 'namespace.name' hostgroup/rule name, or None."""
+    if name is not None:
+        namespace, sep, rest = name.partition(".")
+        if sep and is_word(namespace) and rest and is_word(rest[0]):
+            return namespace
+    return None
+
+def is_word(value):
+    """Equivalent of matching value against the regex ^\\w+$."""
+    return bool(value) and value.replace("_", "a").isalnum()
 
 def deny_if_any_non_namespace_members(caller, ldap, dn, candidates, rejects, *keys, **options):
     """
@@ -214,9 +2354,161 @@ def deny_if_any_non_namespace_members(caller, ldap, dn, candidates, rejects, *ke
     filters members for hostgroups, Sudo rules, and HBAC rules to enforce
     namespace policies.
     """
-    DenyIneligibleMembers(ldap, dn, candidates, rejects).execute()
+    namespace_index.ensure_started()
+    call_metrics = metrics.recorder()
+    decisions = decision_log.recorder()
+    profile = profiler.recorder()
+    start = time.perf_counter()
+    checker = denied = None
+    try:
+        memo = begin_request_memo(dn)
+        checker = DenyIneligibleMembers(ldap, dn, candidates, rejects, call_metrics, decisions, memo)
+        denied = checker.execute()
+    finally:
+        if profile is not None:
+            profile.disable()
+            profiler.record(profile, dn, checker, denied, time.perf_counter() - start)
+    if call_metrics is not None:
+        metrics.record(call_metrics)
+    if decisions is not None and denied is not None:
+        decision_log.record(checker, decisions, denied, time.perf_counter() - start)
+    return dn
+
+def invalidate_renamed_rule(caller, ldap, dn, entry_attrs, *keys, **options):
+    """
+    This function is a post-callback for the hbacrule/sudorule mod operations.
+    It drops the cached rule name so a renamed rule is re-read on its next
+    member add.
+    """
+    name, attr = parse_dn(dn)
+    if attr is not None and attr.lower() == "ipauniqueid":
+        rule_name_cache.invalidate(name)
+    return dn
+
+def invalidate_modified_member(caller, ldap, dn, entry_attrs, *keys, **options):
+    """
+    This function is a post-callback for the host/hostgroup mod operations.
+    It drops the cached userclass so a changed --class is seen on the next
+    member add.
+    """
+    userclass_cache.invalidate(dn_key(dn))
     return dn
 
+def invalidate_deleted_member(caller, ldap, dn, *keys, **options):
+    """
+    This function is a post-callback for the host/hostgroup del operations.
+    It drops the cached userclass so a re-created entry is read again, and
+    every hostgroup closure the entry was part of.
+    """
+    userclass_cache.invalidate(dn_key(dn))
+    hostgroup_closure_cache.invalidate(dn_key(dn))
+    return True
+
+def drop_request_memo(caller, ldap, completed, failed, dn, entry_attrs, *keys, **options):
+    """
+    This function is a post-callback for the member add operations. It ends
+    the request memo started by deny_if_any_non_namespace_members().
+    """
+    end_request_memo()
+    return (completed, dn)
+
+def invalidate_hostgroup_closure(caller, ldap, completed, failed, dn, entry_attrs, *keys, **options):
+    """
+    This function is a post-callback for the hostgroup add/remove member
+    operations. It drops the cached closure of the hostgroup and of every
+    hostgroup that nests it.
+    """
+    hostgroup_closure_cache.invalidate(dn_key(dn))
+    return (completed, dn)
+
+register = Registry()
+
+@register()
+class hostmgmt_check_members(Command):
+    __doc__ = _("""
+Check which hosts and host groups a host group, HBAC rule or sudo rule
+would accept as members under the namespace policy, without adding them.
+
+EXAMPLES:
+
+ Check two hosts and a host group against a host group:
+   ipa hostmgmt-check-members hostgroup foo.hgroup --hosts=web1.example.com,web2.example.com --hostgroups=bar.web
+""")
+
+    MEMBER_ATTRS = {"hostgroup": "member", "hbacrule": "memberhost", "sudorule": "memberhost"}
+
+    takes_args = (
+        StrEnum("target_type",
+            cli_name="type",
+            label=_("Target type"),
+            values=("hostgroup", "hbacrule", "sudorule"),
+        ),
+        Str("target",
+            cli_name="target",
+            label=_("Target name"),
+        ),
+    )
+
+    takes_options = (
+        Str("host*",
+            cli_name="hosts",
+            label=_("member host"),
+        ),
+        Str("hostgroup*",
+            cli_name="hostgroups",
+            label=_("member host group"),
+        ),
+    )
+
+    has_output = (
+        output.Output("result", dict, _("Eligibility and reason per member")),
+        output.summary,
+    )
+
+    def execute(self, target_type, target, **options):
+        ldap = self.api.Backend.ldap2
+        tgt_dn = self.api.Object[target_type].get_dn(target)
+        ldap.get_entry(tgt_dn, ["cn"]) # NotFound for an unknown target
+        names = {}
+        cands = {"host": [], "hostgroup": []}
+        for member_type in ("host", "hostgroup"):
+            for name in options.get(member_type) or ():
+                dn = self.api.Object[member_type].get_dn(name)
+                names[dn_key(dn)] = (member_type, name)
+                cands[member_type].append(dn)
+        member_attr = hostmgmt_check_members.MEMBER_ATTRS[target_type]
+        rejects = {member_attr: {"host": [], "hostgroup": []}}
+        checker = DenyIneligibleMembers(ldap, tgt_dn, {member_attr: cands}, rejects)
+        result = {"namespace": checker.tgt_ns, "host": [], "hostgroup": []}
+        denied = 0
+        for key, verdict in checker.member_verdicts().items():
+            member_type, name = names[key]
+            eligible = verdict not in NamespacePolicy.DENIALS
+            denied += 0 if eligible else 1
+            result[member_type].append({"name": name, "eligible": eligible, "reason": verdict})
+        summary = _("%(denied)d of %(total)d members ineligible") % dict(denied=denied, total=len(names))
+        return dict(result=result, summary=str(summary))
+
+    def output_for_cli(self, textui, output, *args, **options):
+        result = output["result"]
+        for member_type in ("host", "hostgroup"):
+            for member in result[member_type]:
+                textui.print_plain(f"  {member_type} {member['name']}: {member['reason']}")
+        textui.print_summary(output["summary"])
+        denied = [m for t in ("host", "hostgroup") for m in result[t] if not m["eligible"]]
+        return 1 if denied else 0
+
 hostgroup_add_member.register_pre_callback(deny_if_any_non_namespace_members)
 hbacrule_add_host.register_pre_callback(deny_if_any_non_namespace_members)
 sudorule_add_host.register_pre_callback(deny_if_any_non_namespace_members)
+hostgroup_add_member.register_post_callback(drop_request_memo)
+hbacrule_add_host.register_post_callback(drop_request_memo)
+sudorule_add_host.register_post_callback(drop_request_memo)
+hbacrule_mod.register_post_callback(invalidate_renamed_rule)
+sudorule_mod.register_post_callback(invalidate_renamed_rule)
+host_mod.register_post_callback(invalidate_modified_member)
+hostgroup_mod.register_post_callback(invalidate_modified_member)
+host_del.register_post_callback(invalidate_deleted_member)
+hostgroup_add_member.register_post_callback(invalidate_hostgroup_closure)
+hostgroup_remove_member.register_post_callback(invalidate_hostgroup_closure)
+hostgroup_del.register_post_callback(invalidate_deleted_member)
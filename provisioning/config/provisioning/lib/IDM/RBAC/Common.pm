@@ -5,6 +5,7 @@ use Data::Dumper;
 use Sys::Hostname;
 use Carp qw(carp confess);
 use YAML::Tiny;
+use JSON::PP;
 use feature 'say';
 use constant {
    true  => 1,
@@ -82,6 +83,11 @@ modify_user
 add_group_member
 find_user
 find_group_member
+set_snapshot
+get_snapshot
+has_snapshot
+snapshot_record
+snapshot_show
 );
 
 sub new
@@ -114,6 +120,7 @@ sub get_settings
       set_short_domainname => $self->get_short_domainname(),
       namespace            => $self->get_namespace(),
       ucnamespace          => $self->get_ucnamespace(),
+      snapshot             => $self->get_snapshot(),
    };
 
    return $settings;
@@ -171,8 +178,11 @@ sub get_namespaces
    my @namespaces;
 
    my $command = "ipa group-show namespaces --all --raw | grep \"^  member:\" | grep \"\\.admin\" 2>/dev/null";
+   my @members = $self->has_snapshot()
+      ? grep { /\.admin/ } split /\n/, $self->snapshot_show("groups", "namespaces")
+      : `$command`;
 
-   foreach my $dn (`$command`) {
+   foreach my $dn (@members) {
       chomp $dn;
       my ($namespace) = $dn =~ /cn=(.+?)\.admin/;
       push @namespaces, $namespace;
@@ -362,6 +372,11 @@ sub check_group
 {
    my $self = shift or confess "failed object";
    my $group = shift or confess "group missing";
+
+   if ( $self->has_snapshot() ) {
+      return defined $self->snapshot_record("groups", $group) ? true : false;
+   }
+
    my $command = sprintf('ipa group-show %s >/dev/null 2>&1', $group);
    my $result = system($command);
    if ( $result == 0 ) {
@@ -435,6 +450,16 @@ sub get_existing_rbac
 
    my $ucnamespace = $self->get_ucnamespace();
 
+   if ( $self->has_snapshot() ) {
+      foreach my $type (qw(role privilege permission)) {
+         foreach my $record ( values %{$self->get_snapshot()->{"${type}s"}} ) {
+            my $entry = $record->{cn}->[0];
+            $self->{rbac}->{bad}->{$type}->{$entry}++ if $entry =~ /^$ucnamespace /;
+         }
+      }
+      return;
+   }
+
    foreach my $type (qw(role privilege permission)) {
       my $command = sprintf('ipa %s-find "%s " --all --raw --sizelimit=0 --timelimit=0 | grep "^  cn: "',
          $type,
@@ -673,6 +698,21 @@ sub set_current_permissions
    my $ucnamespace = $self->get_ucnamespace();
    my $privilege_name = $self->get_privilege_name();
 
+   if ( $self->has_snapshot() ) {
+      my $record = $self->snapshot_record("privileges", $privilege_name);
+      if ( not defined $record ) {
+         carp "privilege not found: $privilege_name";
+         return;
+      }
+      foreach my $dn ( @{$record->{memberof} // []} ) {
+         my ($permission) = $dn =~ /\Acn=(.+?),cn=permissions,/;
+         if ( defined $permission and $permission =~ /\A$ucnamespace / ) {
+            $self->{current_permissions}->{$permission}++;
+         }
+      }
+      return;
+   }
+
    my $command = sprintf('ipa privilege-show "%s" --all --raw', $privilege_name);
    my $result = `$command >/dev/null 2>$1 && echo $?`;
    if ( $result > 0 ) {
@@ -757,6 +797,10 @@ sub show_privilege
 
    my $privilege_name = $self->get_privilege_name();
 
+   if ( $self->has_snapshot() ) {
+      return $self->snapshot_show("privileges", $privilege_name);
+   }
+
    my $command = sprintf('ipa privilege-show "%s" --all --raw 2>/dev/null', $privilege_name);
    my $result = `$command`;
 
@@ -769,6 +813,16 @@ sub privilege_content
 
    my $role_name = $self->get_role_name();
 
+   if ( $self->has_snapshot() ) {
+      if ( defined $self->snapshot_record("privileges", $role_name) ) {
+         my $content = $self->show_privilege();
+         $content =~ s/\n/ :: /g;
+         return $content;
+      }
+      say("$role_name privilege not found") if $self->is_troubleshoot();
+      return;
+   }
+
    my $command = sprintf('ipa privilege-show "%s" --all --raw', $role_name);
    my $privilege_show = `$command >/dev/null 2>&1 && echo -n $?`;
 
@@ -791,6 +845,16 @@ sub role_content
 
    my $command = sprintf('ipa role-show "%s" --all --raw 2>/dev/null', $role_name);
 
+   if ( $self->has_snapshot() ) {
+      my $result = $self->snapshot_show("roles", $role_name);
+      if ( length $result ) {
+         $result =~ s/\n/ :: /g;
+         return $result;
+      }
+      say("$role_name role not found") if $self->is_troubleshoot();
+      return;
+   }
+
    my $role_show = `$command >/dev/null 2>&1 && echo -n $?`;
 
    if ( $role_show == 0 ) {
@@ -945,7 +1009,13 @@ sub get_permission_aci
    my $name = $self->get_permission_name($permission);
 
    if ( $self->is_permission($name) ) {
-      my $perm_aci = `ipa permission-show "$name" --all --raw 2>/dev/null | grep "^  aci:"`;
+      my $perm_aci;
+      if ( $self->has_snapshot() ) {
+         $perm_aci = $self->snapshot_record("permissions", $name)->{aci} // "";
+      }
+      else {
+         $perm_aci = `ipa permission-show "$name" --all --raw 2>/dev/null | grep "^  aci:"`;
+      }
       chomp $perm_aci;
       $perm_aci =~ s/  aci: //;
       $perm_aci =~ s/((?:;write_keys|;read_keys))/\\$1/g;
@@ -962,6 +1032,10 @@ sub is_role
    my $self = shift or confess "failed object";
    my $name = shift or confess "permission name missing";
 
+   if ( $self->has_snapshot() ) {
+      return defined $self->snapshot_record("roles", $name) ? true : false;
+   }
+
    my $command = sprintf('ipa role-show "%s" > /dev/null 2>&1', $name);
    my $show = system($command);
 
@@ -974,6 +1048,10 @@ sub is_privilege
    my $self = shift or confess "failed object";
    my $name = shift or confess "permission name missing";
 
+   if ( $self->has_snapshot() ) {
+      return defined $self->snapshot_record("privileges", $name) ? true : false;
+   }
+
    my $command = sprintf('ipa privilege-show "%s" > /dev/null 2>&1', $name);
    my $show = system($command);
 
@@ -986,6 +1064,10 @@ sub is_permission
    my $self = shift or confess "failed object";
    my $name = shift or confess "permission name missing";
    
+   if ( $self->has_snapshot() ) {
+      return defined $self->snapshot_record("permissions", $name) ? true : false;
+   }
+
    my $command = sprintf('ipa permission-show "%s" > /dev/null 2>&1', $name);
    my $show = system($command);
 
@@ -1255,7 +1337,10 @@ sub find_user
    my $self = shift or confess "failed object";
    my $user = shift or confess "user missing";
    my $command = sprintf('ipa user-show %s >/dev/null 2>&1', $user);
-   my $result = system($command);
+   # the snapshot only exports the hostenroll users; ipa answers for any other user
+   my $result = ( $self->has_snapshot() and defined $self->snapshot_record("users", $user) )
+      ? 0
+      : system($command);
    if ( $result == 0 ) {
       carp "# GOOD: user $user" if $self->is_troubleshoot();
       return true;
@@ -1276,7 +1361,10 @@ sub find_group_member
       $group,
       $user
    );
-   my $result = `$command`;
+   # groups the snapshot does not export are read with ipa
+   my $result = ( $self->has_snapshot() and defined $self->snapshot_record("groups", $group) )
+      ? $self->snapshot_show("groups", $group)
+      : `$command`;
 
    if ( $result =~ /uid=$user,/ ) {
       return true;
@@ -1286,4 +1374,61 @@ sub find_group_member
    }
 }
 
+sub set_snapshot
+{
+   my $self = shift or confess "failed object";
+   my $file = shift or confess "snapshot file missing";
+
+   open(my $fh, "<", $file) or confess "unable to read snapshot $file";
+   my $snapshot = decode_json(do { local $/; <$fh> });
+   close $fh;
+
+   if ( not defined $snapshot->{format} or $snapshot->{format} != 1 ) {
+      confess "unsupported snapshot format in $file";
+   }
+
+   carp "# snapshot $file created $snapshot->{created} lastusn $snapshot->{last_usn}" if $self->is_troubleshoot();
+   $self->{snapshot} = $snapshot;
+}
+
+sub get_snapshot
+{
+   my $self = shift or confess "failed object";
+   return $self->{snapshot};
+}
+
+sub has_snapshot
+{
+   my $self = shift or confess "failed object";
+   return defined $self->{snapshot} ? true : false;
+}
+
+sub snapshot_record
+{
+   my $self = shift or confess "failed object";
+   my $type = shift or confess "snapshot type missing (roles,privileges,permissions,groups,users)";
+   my $name = shift or confess "name missing";
+
+   return $self->get_snapshot()->{$type}->{lc($name)};
+}
+
+# the record formatted like 'ipa <type>-show --all --raw', empty if not found
+sub snapshot_show
+{
+   my $self = shift or confess "failed object";
+   my $type = shift or confess "snapshot type missing (roles,privileges,permissions,groups,users)";
+   my $name = shift or confess "name missing";
+
+   my $record = $self->snapshot_record($type, $name) or return "";
+
+   my $content = "  dn: $record->{dn}\n";
+   foreach my $attribute ( sort keys %{$record} ) {
+      next if ref $record->{$attribute} ne "ARRAY";
+      foreach my $value ( @{$record->{$attribute}} ) {
+         $content .= "  $attribute: $value\n";
+      }
+   }
+   return $content;
+}
+
 1;
@@ -16,6 +16,7 @@ use Getopt::Long qw(GetOptions);
 GetOptions(
    'n|ns|namespace=s' => \my $namespace,
    't|troubleshoot'   => \my $TROUBLESHOOT,
+   's|snapshot=s'     => \my $SNAPSHOT,
    'h|help'           => \my $HELP,
 );
 
@@ -29,6 +30,7 @@ MAIN:
    my $rbac = IDM::RBAC::Common->new(\%settings);
    $rbac->init();
    $rbac->set_troubleshoot($TROUBLESHOOT);
+   $rbac->set_snapshot($SNAPSHOT) if defined $SNAPSHOT;
 
    my @namespaces = defined $namespace ? ($namespace) : $rbac->get_namespaces();
 
@@ -77,6 +79,9 @@ sub usage
 
      validate specific namespace; verbose output
       : $0 --namespace=acme --troubleshoot
+
+     validate all namespaces from an RBAC snapshot (see rbac_snapshot.py) instead of ipa show/find commands
+      : $0 --snapshot=/var/tmp/rbac_snapshot.json
    ";
 
    exit;
@@ -0,0 +1,443 @@
+#! /usr/bin/env python3
+
+__version__ = "1.0.0"
+
+import argparse
+import csv
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+from collections import Counter, OrderedDict
+
+import yaml
+
+import ldap
+import ldap.sasl
+import ldif
+from ldap import SCOPE_BASE, SCOPE_SUBTREE
+from ldap.controls import SimplePagedResultsControl
+
+# NOTE: counts, for every namespace, the entries each permission template of
+# the namespace admin, owner and hostenroll roles applies to, from one pass
+# over a directory snapshot instead of ipa *-find commands per namespace.
+# Run on an IPA enrolled host with a kerberos ticket (or --bind-dn), or
+# offline against an LDIF export:
+#
+#   ./permission_matrix.py > matrix.txt
+#   ./permission_matrix.py --ldif /var/lib/dirsrv/slapd-EXAMPLE/ldif/export.ldif --format csv
+
+TEMPLATE_DIR = "/home/icam/JPL/config"
+ROLES = ("admin", "owner", "hostenroll")
+PAGE_SIZE = 1000
+NAMESPACES_GROUP = "cn=namespaces,cn=groups,cn=accounts"
+
+# namespace dependent placeholders, as set by IDM::RBAC::{Admin,Owner,Hostenroll};
+# {ns} is the namespace, the values are compared case-insensitively
+NAMESPACE_PLACEHOLDERS = {
+    "namespace": "{ns}",
+    "ucnamespace": "{ns}",
+    "group_admin": "{ns}.admin",
+    "group_owner": "{ns}.owner",
+    "hostenroll": "{ns}-hostenroll",
+    "uchostenroll": "{ns}-hostenroll",
+}
+PLACEHOLDER_RE = re.compile(r"%(\w+)%")
+NAMESPACE_GROUP = r"(?P<ns>\w+)"
+NAMESPACE_BACKREF = r"(?P=ns)"
+
+# An evaluator returns the namespaces an entry matches for as (negated, names):
+# (False, names) is exactly names, (True, names) is every namespace but names.
+ALL = (True, frozenset())
+NONE = (False, frozenset())
+
+def ns_and(a, b):
+    if a[0] and b[0]:
+        return (True, a[1] | b[1])
+    if a[0]:
+        return (False, b[1] - a[1])
+    if b[0]:
+        return (False, a[1] - b[1])
+    return (False, a[1] & b[1])
+
+def ns_or(a, b):
+    if a[0] and b[0]:
+        return (True, a[1] & b[1])
+    if a[0]:
+        return (True, a[1] - b[1])
+    if b[0]:
+        return (True, b[1] - a[1])
+    return (False, a[1] | b[1])
+
+def ns_not(a):
+    return (not a[0], a[1])
+
+def substitute(text, values):
+    """Replaces %label% placeholders found in values, like permissions_format() in IDM::RBAC::Common."""
+    return PLACEHOLDER_RE.sub(lambda m: values.get(m.group(1), m.group(0)), text)
+
+def compile_pattern(text, wildcard):
+    """
+    Compiles a value or DN pattern with '*' wildcards and namespace
+    placeholders into (regex, has_namespace). Every placeholder must stand
+    for the same namespace; wildcard is the regex a '*' stands for.
+    """
+    regex = []
+    has_namespace = False
+    for i, part in enumerate(PLACEHOLDER_RE.split(text.lower())):
+        if i % 2 == 0:
+            regex.append(wildcard.join(re.escape(literal) for literal in part.split("*")))
+            continue
+        if part not in NAMESPACE_PLACEHOLDERS:
+            raise ValueError(f"unknown placeholder %{part}% in '{text}'")
+        group = NAMESPACE_BACKREF if has_namespace else NAMESPACE_GROUP
+        regex.append(group.join(re.escape(literal) for literal in NAMESPACE_PLACEHOLDERS[part].split("{ns}")))
+        has_namespace = True
+    return re.compile("".join(regex)), has_namespace
+
+def parse_filter(text):
+    """
+    Parses an LDAP filter into a tree of ("&", [nodes]), ("|", [nodes]),
+    ("!", node) and ("=", attr, value) tuples. Only the equality, presence
+    and substring items used by permission templates are supported.
+    """
+    node, pos = parse_filter_item(text, 0)
+    if pos != len(text):
+        raise ValueError(f"trailing characters in filter '{text}'")
+    return node
+
+def parse_filter_item(text, pos):
+    if text[pos:pos + 1] != "(":
+        raise ValueError(f"'(' expected at {pos} in filter '{text}'")
+    pos += 1
+    op = text[pos:pos + 1]
+    if op in ("&", "|"):
+        nodes = []
+        pos += 1
+        while text[pos:pos + 1] == "(":
+            node, pos = parse_filter_item(text, pos)
+            nodes.append(node)
+        result = (op, nodes)
+    elif op == "!":
+        node, pos = parse_filter_item(text, pos + 1)
+        result = (op, node)
+    else:
+        end = text.find(")", pos)
+        if end < 0:
+            raise ValueError(f"unterminated item at {pos} in filter '{text}'")
+        attr, sep, value = text[pos:end].partition("=")
+        if not sep or not attr or attr[-1] in "<>~:":
+            raise ValueError(f"unsupported item '{text[pos:end]}' in filter '{text}'")
+        result = ("=", attr.lower(), re.sub(r"\\([0-9a-fA-F]{2})", lambda m: chr(int(m.group(1), 16)), value))
+        pos = end
+    if text[pos:pos + 1] != ")":
+        raise ValueError(f"')' expected at {pos} in filter '{text}'")
+    return result, pos + 1
+
+def compile_filter(node, attrs):
+    """
+    Compiles a parse_filter() tree into an evaluator of an entry and adds
+    the attributes it reads to attrs. Items without namespace placeholders
+    evaluate to ALL or NONE; items with one yield the namespaces named by
+    the matching values.
+    """
+    op = node[0]
+    if op in ("&", "|"):
+        evaluators = [compile_filter(child, attrs) for child in node[1]]
+        combine, start = (ns_and, ALL) if op == "&" else (ns_or, NONE)
+        def evaluate(entry):
+            result = start
+            for evaluator in evaluators:
+                result = combine(result, evaluator(entry))
+                if result == (NONE if op == "&" else ALL):
+                    break
+            return result
+        return evaluate
+    if op == "!":
+        evaluator = compile_filter(node[1], attrs)
+        return lambda entry: ns_not(evaluator(entry))
+    attr, value = node[1], node[2]
+    attrs.add(attr)
+    if value == "*":
+        return lambda entry: ALL if attr in entry else NONE
+    regex, has_namespace = compile_pattern(value, ".*")
+    if has_namespace:
+        def evaluate(entry):
+            names = set()
+            for v in entry.get(attr, ()):
+                m = regex.fullmatch(v)
+                if m is not None:
+                    names.add(m.group("ns"))
+            return (False, frozenset(names))
+        return evaluate
+    if "*" not in value:
+        value = value.lower()
+        return lambda entry: ALL if value in entry.get(attr, ()) else NONE
+    return lambda entry: ALL if any(regex.fullmatch(v) for v in entry.get(attr, ())) else NONE
+
+class PermissionTemplate(object):
+    """
+    One permission template, compiled once for every namespace. The subtree
+    may only depend on global placeholders; target and filter may name the
+    namespace. evaluate() returns the namespaces the permission grants
+    access to the entry for.
+    """
+
+    def __init__(self, label, settings, global_values):
+        self.label = label
+        self.name = settings.get("name", label)
+        self.subtree = substitute(settings["subtree"], global_values).lower()
+        self.attrs = set()
+        target = substitute(settings.get("target", settings["subtree"]), global_values)
+        self.target, self.target_has_namespace = compile_pattern(target, "[^,]*")
+        self.target_rdns = target.count(",") + 1
+        self.filter = None
+        if settings.get("filter"):
+            self.filter = compile_filter(parse_filter(substitute(settings["filter"], global_values)), self.attrs)
+        if PLACEHOLDER_RE.search(self.subtree):
+            raise ValueError(f"{label}: subtree may not depend on the namespace")
+
+    def evaluate(self, rdns, entry):
+        """rdns is the lower case entry DN split at commas."""
+        if len(rdns) < self.target_rdns:
+            return NONE
+        m = self.target.fullmatch(",".join(rdns[-self.target_rdns:]))
+        if m is None:
+            return NONE
+        result = (False, frozenset((m.group("ns"),))) if self.target_has_namespace else ALL
+        if self.filter is not None:
+            result = ns_and(result, self.filter(entry))
+        return result
+
+def load_templates(template_dir, roles, global_values):
+    """
+    Reads the permission templates of each role directory, skipping hidden
+    and README files like gather_permissions() in IDM::RBAC::Common.
+    """
+    templates = []
+    for role in roles:
+        directory = os.path.join(template_dir, role)
+        for file in sorted(os.listdir(directory)):
+            if file.startswith(".") or file.startswith("README"):
+                continue
+            with open(os.path.join(directory, file)) as f:
+                settings = next(yaml.safe_load_all(f))["permission"]
+            templates.append(PermissionTemplate(f"{role}/{file}", settings, global_values))
+    return templates
+
+class PermissionMatrix(object):
+    """
+    Entry counts per namespace and permission template, accumulated in one
+    pass over the snapshot. An entry matched for every namespace but a few
+    adds to a per-template total and to the exceptions of those few, so the
+    cost of an entry does not grow with the number of namespaces.
+    """
+
+    def __init__(self, templates):
+        self.templates = templates
+        self.by_subtree = OrderedDict()
+        for index, template in enumerate(templates):
+            self.by_subtree.setdefault(template.subtree, []).append((index, template))
+        self.totals = [0] * len(templates)
+        self.excluded = [Counter() for template in templates]
+        self.included = [Counter() for template in templates]
+        self.entries = 0
+
+    def attrs(self):
+        attrs = set()
+        for template in self.templates:
+            attrs |= template.attrs
+        return sorted(attrs)
+
+    def subtrees(self):
+        """The subtree roots to read, without those nested in another."""
+        subtrees = sorted(self.by_subtree, key=len)
+        return [s for i, s in enumerate(subtrees) if not any(s.endswith("," + o) for o in subtrees[:i])]
+
+    def add(self, dn, attrs):
+        """attrs maps attribute names to str values."""
+        dn = dn.lower()
+        self.entries += 1
+        entry = None
+        rdns = None
+        for subtree, templates in self.by_subtree.items():
+            if dn != subtree and not dn.endswith("," + subtree):
+                continue
+            if entry is None:
+                entry = normalize_entry(attrs)
+                rdns = [rdn.strip() for rdn in dn.split(",")]
+            for index, template in templates:
+                negated, names = template.evaluate(rdns, entry)
+                if negated:
+                    self.totals[index] += 1
+                    self.excluded[index].update(names)
+                elif names:
+                    self.included[index].update(names)
+
+    def count(self, namespace, index):
+        return self.totals[index] - self.excluded[index][namespace] + self.included[index][namespace]
+
+    def rows(self, namespaces):
+        for namespace in namespaces:
+            yield namespace, [self.count(namespace, index) for index in range(len(self.templates))]
+
+def normalize_entry(attrs):
+    """
+    Lower cases attribute names and values; values of attribute subtypes
+    (e.g. ipaallowedtoperform;read_keys) also count for the base attribute.
+    """
+    entry = {}
+    for name, values in attrs.items():
+        name = name.lower()
+        values = [v.lower() for v in values]
+        entry.setdefault(name, []).extend(values)
+        base, sep, option = name.partition(";")
+        if sep:
+            entry.setdefault(base, []).extend(values)
+    return entry
+
+def namespace_members(attrs):
+    """Namespaces of the '<namespace>.admin' members of the namespaces group, as get_namespaces() finds them."""
+    namespaces = []
+    for member in attrs.get("member", []):
+        m = re.search(r"cn=(.+?)\.admin", member, re.IGNORECASE)
+        if m:
+            namespaces.append(m.group(1).lower())
+    return namespaces
+
+def paged_search(conn, base, filterstr, attrs, scope=SCOPE_SUBTREE, page_size=PAGE_SIZE):
+    """Yields (dn, attrs) one page at a time; attrs maps attribute names to lists of str values."""
+    control = SimplePagedResultsControl(True, size=page_size, cookie="")
+    while True:
+        msgid = conn.search_ext(base, scope, filterstr, attrs, serverctrls=[control])
+        rtype, rdata, rmsgid, serverctrls = conn.result3(msgid)
+        for dn, entry in rdata:
+            if dn is None: # search continuation reference
+                continue
+            yield dn, dict((name, [v.decode("utf-8") for v in values]) for name, values in entry.items())
+        cookies = [c.cookie for c in serverctrls if c.controlType == SimplePagedResultsControl.controlType]
+        if not cookies or not cookies[0]:
+            return
+        control.cookie = cookies[0]
+
+class LDIFSnapshot(ldif.LDIFParser):
+    """Streams the records of an LDIF export to a handler, one at a time."""
+
+    def __init__(self, f, handler):
+        ldif.LDIFParser.__init__(self, f)
+        self.handler = handler
+
+    def handle(self, dn, entry):
+        self.handler(dn, dict((name, [v.decode("utf-8") for v in values]) for name, values in entry.items()))
+
+def connect(settings):
+    conn = ldap.initialize(settings["uri"])
+    conn.set_option(ldap.OPT_REFERRALS, 0)
+    if settings["bind_dn"]:
+        password = ""
+        if settings["password_file"]:
+            with open(settings["password_file"]) as f:
+                password = f.read().strip()
+        conn.simple_bind_s(settings["bind_dn"], password)
+    elif settings["uri"].startswith("ldapi://"):
+        conn.sasl_external_bind_s()
+    else:
+        conn.sasl_interactive_bind_s("", ldap.sasl.gssapi())
+    return conn
+
+def short_domainname():
+    """First label of the NIS domain name, like set_short_domainname() in IDM::RBAC::Common."""
+    result = subprocess.run(["domainname"], stdout=subprocess.PIPE)
+    domainname = result.stdout.decode("utf-8").strip()
+    shortdomainname, sep, rest = domainname.partition(".")
+    if not sep or not shortdomainname:
+        raise ValueError(f"short domainname cannot be derived from '{domainname}'")
+    return shortdomainname
+
+def write_matrix(matrix, namespaces, fmt, out):
+    labels = [template.label for template in matrix.templates]
+    if fmt == "json":
+        document = {
+            "version": __version__,
+            "entries": matrix.entries,
+            "permissions": labels,
+            "namespaces": OrderedDict((ns, OrderedDict(zip(labels, counts))) for ns, counts in matrix.rows(namespaces)),
+        }
+        json.dump(document, out, indent=2)
+        out.write("\n")
+    elif fmt == "csv":
+        writer = csv.writer(out)
+        writer.writerow(["namespace"] + labels)
+        for namespace, counts in matrix.rows(namespaces):
+            writer.writerow([namespace] + counts)
+    else:
+        width = max([len("namespace")] + [len(ns) for ns in namespaces])
+        for i, label in enumerate(labels):
+            out.write(f"{'':<{width}}  [{i}] {label}\n")
+        out.write(f"{'namespace':<{width}}" + "".join(f"{f'[{i}]':>8}" for i in range(len(labels))) + "\n")
+        for namespace, counts in matrix.rows(namespaces):
+            out.write(f"{namespace:<{width}}" + "".join(f"{count:>8}" for count in counts) + "\n")
+
+def main():
+    parser = argparse.ArgumentParser(description="Count the entries each namespace permission template applies to")
+    parser.add_argument("--templates", default=TEMPLATE_DIR, help="directory with the role template directories")
+    parser.add_argument("--roles", default=",".join(ROLES), help="comma separated role directories")
+    parser.add_argument("-n", "--namespace", action="append",
+                        help="namespace to report (repeatable; default: members of the namespaces group)")
+    parser.add_argument("--shortdomainname", help="default: first label of the domainname command")
+    parser.add_argument("--ldif", help="read the snapshot from an LDIF export instead of LDAP")
+    parser.add_argument("--uri", help="LDAP URI (default: ldap://<IPA server>)")
+    parser.add_argument("--basedn", help="directory suffix (default: the IPA basedn)")
+    parser.add_argument("--bind-dn", default="", help="simple bind DN (default: SASL GSSAPI, or EXTERNAL over ldapi)")
+    parser.add_argument("--password-file")
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE)
+    parser.add_argument("--format", choices=("text", "csv", "json"), default="text")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stderr)
+
+    start = time.monotonic()
+    global_values = {"shortdomainname": args.shortdomainname or short_domainname()}
+    templates = load_templates(args.templates, [r.strip() for r in args.roles.split(",") if r.strip()], global_values)
+    matrix = PermissionMatrix(templates)
+    namespaces = [ns.lower() for ns in args.namespace or []]
+    found = []
+
+    if args.ldif:
+        def add(dn, attrs):
+            if dn.lower().startswith(NAMESPACES_GROUP + ","):
+                found.extend(namespace_members(attrs))
+            matrix.add(dn, attrs)
+        with open(args.ldif, "rb") as f:
+            LDIFSnapshot(f, add).parse()
+    else:
+        settings = {"uri": args.uri, "basedn": args.basedn, "bind_dn": args.bind_dn,
+                    "password_file": args.password_file}
+        if not settings["uri"] or not settings["basedn"]:
+            from ipalib import api
+            if not api.isdone("bootstrap"):
+                api.bootstrap(context="cli", log=None)
+            settings["uri"] = settings["uri"] or f"ldap://{api.env.server}"
+            settings["basedn"] = settings["basedn"] or str(api.env.basedn)
+        conn = connect(settings)
+        if not namespaces:
+            for dn, attrs in paged_search(conn, f"{NAMESPACES_GROUP},{settings['basedn']}", "(objectclass=*)",
+                                          ["member"], SCOPE_BASE, args.page_size):
+                found.extend(namespace_members(attrs))
+        attrs = matrix.attrs() or ["1.1"]
+        for subtree in matrix.subtrees():
+            for dn, entry in paged_search(conn, subtree, "(objectclass=*)", attrs, SCOPE_SUBTREE, args.page_size):
+                matrix.add(dn, entry)
+        conn.unbind_s()
+
+    namespaces = namespaces or sorted(set(found))
+    write_matrix(matrix, namespaces, args.format, sys.stdout)
+    logging.info(f"{matrix.entries} entries, {len(templates)} permissions, {len(namespaces)} namespaces "
+                 f"in {time.monotonic() - start:.1f}s")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,174 @@
+#! /usr/bin/env python3
+
+__version__ = "1.0.0"
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import ldap
+from ldap import SCOPE_BASE, SCOPE_ONELEVEL
+
+from permission_matrix import PAGE_SIZE, connect, paged_search
+
+# NOTE: exports the roles, privileges, permissions, namespace groups and
+# hostenroll users checkit.pl validates with a few paged LDAP searches, so
+# checkit.pl can read them from the snapshot instead of forking ipa for each
+# object. Run on an IPA enrolled host with a kerberos ticket (or --bind-dn):
+#
+#   ./rbac_snapshot.py && ./checkit.pl --snapshot=/var/tmp/rbac_snapshot.json
+#
+# The snapshot records the directory's lastusn; while it is unchanged the
+# existing snapshot is kept and no object is read.
+
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_PATH = "/var/tmp/rbac_snapshot.json"
+
+# groups checkit.pl looks at: the namespaces group, the per-namespace role and
+# nonperson groups, and the groups hostenroll users are added to
+GROUP_FILTER = ("(|(cn=namespaces)(cn=*.admin)(cn=*.owner)(cn=*.nonperson)(cn=enrollment_administrators)"
+                "(cn=hostenroll_selfservice)(cn=automation_account_password_policy))")
+USER_FILTER = "(uid=*-hostenroll)"
+
+SECTIONS = (
+    # (section, container, filter, attributes)
+    ("roles", "cn=roles,cn=accounts", "(objectclass=*)", ["cn", "member", "memberof", "entryusn"]),
+    ("privileges", "cn=privileges,cn=pbac", "(objectclass=*)", ["cn", "member", "memberof", "entryusn"]),
+    ("permissions", "cn=permissions,cn=pbac", "(objectclass=*)",
+     ["cn", "member", "memberof", "ipapermlocation", "entryusn"]),
+    ("groups", "cn=groups,cn=accounts", GROUP_FILTER, ["cn", "member", "entryusn"]),
+    ("users", "cn=users,cn=accounts", USER_FILTER, ["uid", "memberof", "entryusn"]),
+)
+
+def entry_usn(attrs):
+    usns = attrs.get("entryusn", [])
+    return int(usns[0]) if len(usns) else 0
+
+def last_usn(conn):
+    """
+    Highest entryusn of the directory from the root DSE lastusn attribute(s),
+    or None when the USN plugin is not enabled.
+    """
+    attrs = read_entry(conn, "", ["lastusn"])
+    usns = [int(v) for name, values in attrs.items() if name.lower().startswith("lastusn")
+            for v in values if v.lstrip("-").isdigit()]
+    return max(usns) if usns else None
+
+def read_entry(conn, dn, attrs):
+    """The str values of one entry, or {} when it cannot be read."""
+    try:
+        results = conn.search_s(dn, SCOPE_BASE, "(objectclass=*)", attrs)
+    except ldap.NO_SUCH_OBJECT:
+        return {}
+    for result_dn, entry in results:
+        if result_dn is not None:
+            return dict((name, [v.decode("utf-8") for v in values]) for name, values in entry.items())
+    return {}
+
+def load_snapshot(path):
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if snapshot.get("format") != SNAPSHOT_FORMAT:
+        return None
+    return snapshot
+
+def save_snapshot(path, snapshot):
+    tmp_path = f"{path}.{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(snapshot, f, indent=1, sort_keys=True)
+    os.rename(tmp_path, path)
+
+def permission_acis(conn, permissions):
+    """
+    Reads the ACI of every permission from its ipapermlocation entry, the way
+    ipa permission-show --all --raw reports it; one read per distinct
+    location.
+    """
+    locations = {}
+    for record in permissions.values():
+        for location in record.get("ipapermlocation", []):
+            locations.setdefault(location.lower(), location)
+    acis = {}
+    for location in locations.values():
+        for aci in read_entry(conn, location, ["aci"]).get("aci", []):
+            start = aci.find('acl "permission:')
+            if start >= 0:
+                name = aci[start + len('acl "permission:'):].split('"', 1)[0]
+                acis.setdefault(name.lower(), aci)
+    for key, record in permissions.items():
+        if key in acis:
+            record["aci"] = acis[key]
+
+def export(conn, basedn, page_size):
+    """
+    Returns the snapshot: one map per section, keyed by the lower case cn
+    (uid for users), of records holding the dn, entryusn and the raw
+    attribute values.
+    """
+    snapshot = {"format": SNAPSHOT_FORMAT, "version": __version__, "basedn": basedn}
+    highest_usn = 0
+    for section, container, filterstr, attrs in SECTIONS:
+        records = {}
+        for dn, entry in paged_search(conn, f"{container},{basedn}", filterstr, attrs, SCOPE_ONELEVEL, page_size):
+            entry = dict((name.lower(), values) for name, values in entry.items())
+            names = entry.get("uid" if section == "users" else "cn", [])
+            if not names:
+                continue
+            usn = entry_usn(entry)
+            highest_usn = max(highest_usn, usn)
+            record = dict((name, values) for name, values in entry.items() if name != "entryusn")
+            record.update({"dn": dn, "entryusn": usn})
+            records[names[0].lower()] = record
+        snapshot[section] = records
+    permission_acis(conn, snapshot["permissions"])
+    snapshot["highest_usn"] = highest_usn
+    return snapshot
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the namespace RBAC objects checkit.pl validates")
+    parser.add_argument("-o", "--output", default=SNAPSHOT_PATH)
+    parser.add_argument("--force", action="store_true", help="export even when the directory lastusn is unchanged")
+    parser.add_argument("--uri", help="LDAP URI (default: ldap://<IPA server>)")
+    parser.add_argument("--basedn", help="directory suffix (default: the IPA basedn)")
+    parser.add_argument("--bind-dn", default="", help="simple bind DN (default: SASL GSSAPI, or EXTERNAL over ldapi)")
+    parser.add_argument("--password-file")
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stderr)
+
+    settings = {"uri": args.uri, "basedn": args.basedn, "bind_dn": args.bind_dn,
+                "password_file": args.password_file}
+    if not settings["uri"] or not settings["basedn"]:
+        from ipalib import api
+        if not api.isdone("bootstrap"):
+            api.bootstrap(context="cli", log=None)
+        settings["uri"] = settings["uri"] or f"ldap://{api.env.server}"
+        settings["basedn"] = settings["basedn"] or str(api.env.basedn)
+
+    start = time.monotonic()
+    conn = connect(settings)
+    usn = last_usn(conn)
+    cached = None if args.force else load_snapshot(args.output)
+    if cached is not None and usn is not None and cached.get("last_usn") == usn \
+            and cached.get("basedn") == settings["basedn"]:
+        conn.unbind_s()
+        logging.info(f"{args.output} is current (lastusn {usn})")
+        return 0
+    snapshot = export(conn, settings["basedn"], args.page_size)
+    conn.unbind_s()
+    snapshot["last_usn"] = usn
+    snapshot["created"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    save_snapshot(args.output, snapshot)
+    logging.info(f"{args.output}: " + ", ".join(f"{len(snapshot[s[0]])} {s[0]}" for s in SECTIONS) +
+                 f" in {time.monotonic() - start:.1f}s")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,19 +2,50 @@
 
 __version__ = "1.0.0"
 
+import itertools
 import logging
+import math
+import os
 import re
 import subprocess
 import sys
+import threading
+import time
 import unittest
+import uuid
 
 # NOTE: ran tests logged in to VM (icam-test-jw1-idm01) as 'admin' user with 'admin' user token
+#
+# HOSTMGMT_TEST_BACKEND selects how IPATestUtil runs the ipa commands:
+#   cli       : fork the ipa CLI against the enrolled IdM (end-to-end, default)
+#   inprocess : run the commands against a stub directory in this process and
+#               call the callbacks registered by hostmgmt_callbacks directly;
+#               needs only the IPA server python packages, and the test
+#               classes may run in parallel (e.g. pytest -n 3 --dist loadscope)
+TEST_BACKEND = os.environ.get("HOSTMGMT_TEST_BACKEND", "cli")
 
 DEBUG = False
 VERBOSE = False # display test commands
 TEST_HOSTGROUP_ADDS = True
 TEST_HBACRULE_ADDS = True
 TEST_SUDORULE_ADDS = True
+TEST_NAMESPACE_INDEX = True
+TEST_NAMESPACE_AUDIT = True
+TEST_CHECK_MEMBERS = True
+TEST_NESTED_HOSTGROUPS = True
+TEST_DECISION_LOG = True
+TEST_REQUEST_MEMO = True
+TEST_PERMISSION_MATRIX = True
+TEST_RBAC_SNAPSHOT = True
+TEST_CANDIDATE_LOOKUPS = True
+TEST_PROFILING = True
+TEST_SHARED_CACHE = True
+TEST_REJECT_LISTS = True
+TEST_EVALUATION_MODES = True
+TEST_PARTIAL_ENFORCEMENT = True
+TEST_POLICY_OPTIONS = True
+TEST_METRICS_OUTPUT = True
+TEST_CANDIDATE_BATCHING = True
 
 # set up logging to stdout
 log_level = logging.DEBUG if DEBUG else logging.INFO
@@ -26,14 +57,17 @@ l.setLevel(log_level)
 l.addHandler(stdout_h)
 
 domain = None
-cmd = ["domainname"]
-result = subprocess.run(cmd, stdout=subprocess.PIPE)
-result = result.stdout.decode('utf-8').rstrip()
-m = re.search(r"^(\w+)-\w+", result)
-if m:
-    domain = m.group(1)
-if not domain:
-    raise Exception(f"Failed to discover domain from command '{cmd}'")
+if TEST_BACKEND == "inprocess":
+    domain = "inprocess"
+else:
+    cmd = ["domainname"]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE)
+    result = result.stdout.decode('utf-8').rstrip()
+    m = re.search(r"^(\w+)-\w+", result)
+    if m:
+        domain = m.group(1)
+    if not domain:
+        raise Exception(f"Failed to discover domain from command '{cmd}'")
 
 tgt_ns = "foo" # target namespace
 alt_ns = "bar" # alternative (not target) namespace
@@ -280,8 +314,1353 @@ class Test3SudoRuleAdds(unittest.TestCase):
             self.assertTrue(success and "Number of members added 0" in content)
             self.util.del_hostgroup(cand_alt_hg, silent_fail=True)
 
+class Test6CheckMembers(unittest.TestCase):
+    """ipa hostmgmt-check-members dry run against a hostgroup"""
+
+    @classmethod
+    def setUpClass(self):
+        if TEST_CHECK_MEMBERS and True:
+            self.util = IPATestUtil()
+            self.alt_host = f"alt.{cand_host}"
+            self.missing_host = f"missing.{cand_host}"
+            self.check_cmd = (f"ipa hostmgmt-check-members hostgroup {tgt_hostgroup}"
+                              f" --hosts={cand_ips_host},{cand_host},{self.alt_host},{self.missing_host}"
+                              f" --hostgroups={cand_tgt_hg},{cand_alt_hg}")
+            self.util.del_hostgroup(tgt_hostgroup, silent_fail=True)
+            self.util.add_hostgroup(tgt_hostgroup)
+            self.util.add_host(cand_ips_host, ns=alt_ns)
+            self.util.add_host(cand_host, ns=tgt_ns)
+            self.util.add_host(self.alt_host, ns=alt_ns)
+            self.util.add_hostgroup(cand_tgt_hg)
+            self.util.add_hostgroup(cand_alt_hg)
+
+    @classmethod
+    def tearDownClass(self):
+        if TEST_CHECK_MEMBERS and True:
+            for host in (cand_ips_host, cand_host, self.alt_host):
+                self.util.del_host(host, silent_fail=True)
+            for hostgroup in (tgt_hostgroup, cand_tgt_hg, cand_alt_hg):
+                self.util.del_hostgroup(hostgroup, silent_fail=True)
+
+    def test_0_reasons(self):
+        """Every member gets the reason the pre-callback would apply"""
+        if TEST_CHECK_MEMBERS and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            success, content = self.util.execute(self.check_cmd, verbose=VERBOSE)
+            self.assertTrue(success)
+            for line in (f"host {cand_ips_host}: exempt", f"host {cand_host}: eligible",
+                         f"host {self.alt_host}: userclass mismatch", f"host {self.missing_host}: not found",
+                         f"hostgroup {cand_tgt_hg}: eligible", f"hostgroup {cand_alt_hg}: name mismatch"):
+                self.assertIn(line, content)
+            self.assertIn("3 of 6 members ineligible", content)
+
+    def test_1_nothing_added(self):
+        """The dry run does not add members"""
+        if TEST_CHECK_MEMBERS and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            self.util.execute(self.check_cmd, verbose=VERBOSE)
+            success, content = self.util.execute(f"ipa hostgroup-add-member {tgt_hostgroup} --hosts={cand_host}",
+                                                 verbose=VERBOSE)
+            self.assertTrue(success and "Number of members added 1" in content)
+
+@unittest.skipUnless(TEST_BACKEND == "inprocess", "needs the policy file of the in-process backend")
+class Test7NestedHostgroups(unittest.TestCase):
+    """nested_hostgroups = transitive for the 'deep' namespace"""
+
+    @classmethod
+    def setUpClass(self):
+        if TEST_NESTED_HOSTGROUPS and True:
+            import tempfile
+            import hostmgmt_callbacks
+            self.plugin = hostmgmt_callbacks
+            self.config = tempfile.NamedTemporaryFile("w", suffix=".conf")
+            self.config.write("[namespace:deep]\nnested_hostgroups = transitive\n")
+            self.config.flush()
+            self.saved_path = hostmgmt_callbacks.policy_registry.path
+            hostmgmt_callbacks.policy_registry.path = self.config.name
+            self.util = IPATestUtil()
+            self.bad_host = f"bad.{cand_host}"
+            self.util.add_hostgroup("deep.hgroup")
+            self.util.add_hostgroup("deep.outer")
+            self.util.add_hostgroup("deep") # no namespace of its own, members are not checked
+            self.util.add_host(self.bad_host, ns=alt_ns)
+            self.util.add_host(cand_host, ns="deep")
+            self.util.execute("ipa hostgroup-add-member deep.outer --hostgroups=deep")
+            self.util.execute(f"ipa hostgroup-add-member deep --hosts={cand_host},{self.bad_host}")
+
+    @classmethod
+    def tearDownClass(self):
+        if TEST_NESTED_HOSTGROUPS and True:
+            self.plugin.policy_registry.path = self.saved_path
+            self.config.close()
+
+    def test_0_nested_alt_host_denied(self):
+        """Hostgroup whose nested hostgroup holds a host of another namespace is denied"""
+        if TEST_NESTED_HOSTGROUPS and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            success, content = self.util.execute("ipa hostgroup-add-member deep.hgroup --hostgroups=deep.outer")
+            self.assertTrue(success and "Number of members added 0" in content)
+
+    def test_1_closure_invalidated_on_remove(self):
+        """Removing the offending host from the nested hostgroup is seen at once"""
+        if TEST_NESTED_HOSTGROUPS and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            self.util.execute("ipa hostgroup-add-member deep.hgroup --hostgroups=deep.outer")
+            self.util.execute(f"ipa hostgroup-remove-member deep --hosts={self.bad_host}")
+            success, content = self.util.execute("ipa hostgroup-add-member deep.hgroup --hostgroups=deep.outer")
+            self.assertTrue(success and "Number of members added 1" in content)
+
+@unittest.skipUnless(TEST_BACKEND == "inprocess", "needs the policy file of the in-process backend")
+class Test8DecisionLog(unittest.TestCase):
+    """[decision_log] records written by the background writer"""
+
+    @classmethod
+    def setUpClass(self):
+        if TEST_DECISION_LOG and True:
+            import tempfile
+            import hostmgmt_callbacks
+            self.plugin = hostmgmt_callbacks
+            self.tmpdir = tempfile.TemporaryDirectory()
+            self.log_path = os.path.join(self.tmpdir.name, "decisions.log")
+            self.config_path = os.path.join(self.tmpdir.name, "hostmgmt_callbacks.conf")
+            self.saved_path = hostmgmt_callbacks.policy_registry.path
+            hostmgmt_callbacks.policy_registry.path = self.config_path
+            self.util = IPATestUtil()
+            self.util.add_hostgroup(tgt_hostgroup)
+            self.util.add_host(cand_host, ns=alt_ns)
+            self.util.add_host(cand_ips_host)
+
+    @classmethod
+    def tearDownClass(self):
+        if TEST_DECISION_LOG and True:
+            self.plugin.policy_registry.path = self.saved_path
+            self.plugin.decision_log.configure()
+            self.tmpdir.cleanup()
+
+    def configure(self, mode, buffer=100):
+        with open(self.config_path, "w") as f:
+            f.write(f"[decision_log]\nenabled = true\npath = {self.log_path}\nmode = {mode}\n"
+                    f"buffer = {buffer}\nflush_interval = 3600\n")
+        os.utime(self.config_path, (0, time.time() + len(mode) + buffer)) # new mtime, reloaded
+        if os.path.exists(self.log_path):
+            os.unlink(self.log_path)
+
+    def records(self):
+        import json
+        self.plugin.decision_log.flush()
+        with open(self.log_path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_0_decisions(self):
+        """One record per evaluated candidate with the deciding rule"""
+        if TEST_DECISION_LOG and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            self.configure("decisions")
+            self.util.execute(f"ipa hostgroup-add-member {tgt_hostgroup} --hosts={cand_ips_host},{cand_host}")
+            rules = sorted((r["candidate"].split(",")[0], r["rule"], r["decision"]) for r in self.records())
+            self.assertEqual(rules, [(f"fqdn={cand_host}", "userclass mismatch", "deny"),
+                                     (f"fqdn={cand_ips_host}", "exempt", "deny")]) # all_or_nothing
+
+    def test_1_summary(self):
+        """Summary mode writes one record per call"""
+        if TEST_DECISION_LOG and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            self.configure("summary")
+            self.util.execute(f"ipa hostgroup-add-member {tgt_hostgroup} --hosts={cand_ips_host},{cand_host}")
+            records = self.records()
+            self.assertEqual(len(records), 1)
+            self.assertEqual((records[0]["candidates"], records[0]["denied"], records[0]["rules"]),
+                             (2, 1, {"exempt": 1, "userclass mismatch": 1}))
+
+    def test_2_full_buffer_drops(self):
+        """A full buffer drops records and the drop count is logged"""
+        if TEST_DECISION_LOG and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            self.configure("summary", buffer=1)
+            for i in range(3):
+                self.util.execute(f"ipa hostgroup-add-member {tgt_hostgroup} --hosts={cand_host}")
+            records = self.records()
+            self.assertEqual([r.get("dropped") for r in records], [None, 2])
+
+    def test_3_mode_change_before_flush(self):
+        """Records queued before a mode change are written in the mode they were recorded in"""
+        if TEST_DECISION_LOG and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            self.configure("summary")
+            self.util.execute(f"ipa hostgroup-add-member {tgt_hostgroup} --hosts={cand_host}")
+            self.configure("decisions")
+            self.util.execute(f"ipa hostgroup-add-member {tgt_hostgroup} --hosts={cand_host}")
+            records = self.records()
+            self.assertEqual([("rules" in r, r.get("rule")) for r in records],
+                             [(True, None), (False, "userclass mismatch")])
+
+@unittest.skipUnless(TEST_BACKEND == "inprocess", "needs the IPA server python packages")
+class Test4NamespaceIndex(unittest.TestCase):
+    """NamespaceIndex fed by an in-process stand-in for the syncrepl consumer"""
+
+    @classmethod
+    def setUpClass(self):
+        if TEST_NAMESPACE_INDEX and True:
+            from ipapython.dn import DN
+            import hostmgmt_callbacks
+            self.DN = DN
+            self.plugin = hostmgmt_callbacks
+            self.computers = f"cn=computers,cn=accounts,{base_dn}"
+            self.hbac = f"cn=hbac,{base_dn}"
+            self.rule_dn = f"ipaUniqueID=0001,{self.hbac}"
+
+    def setUp(self):
+        if TEST_NAMESPACE_INDEX and True:
+            self.index = self.plugin.NamespaceIndex()
+            self.index.begin_refresh()
+            self.index.apply_entry(f"fqdn={cand_host},{self.computers}",
+                                   {"objectclass": ["ipahost"], "userclass": [tgt_ns]}, "uuid-1")
+            self.index.apply_entry(self.rule_dn,
+                                   {"objectclass": ["ipahbacrule"], "ipauniqueid": ["0001"], "cn": [tgt_hbacrule]}, "uuid-2")
+            self.index.refresh_done()
+            self.saved = (self.plugin.namespace_index, self.plugin.userclass_cache.enabled,
+                          self.plugin.rule_name_cache.enabled)
+            self.plugin.namespace_index = self.index
+            self.plugin.userclass_cache.enabled = False
+            self.plugin.rule_name_cache.enabled = False
+
+    def tearDown(self):
+        if TEST_NAMESPACE_INDEX and True:
+            (self.plugin.namespace_index, self.plugin.userclass_cache.enabled,
+             self.plugin.rule_name_cache.enabled) = self.saved
+
+    def add_host(self, ldap):
+        cands = {"memberhost": {"host": [self.DN(f"fqdn={cand_host},{self.computers}")], "hostgroup": []}}
+        rejects = {"memberhost": {"host": [], "hostgroup": []}}
+        self.plugin.DenyIneligibleMembers(ldap, self.DN(self.rule_dn), cands, rejects).execute()
+        return cands, rejects
+
+    def test_0_current_index_no_ldap(self):
+        """Current index answers target name and userclass without LDAP"""
+        if TEST_NAMESPACE_INDEX and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            ldap = CountingLDAP()
+            cands, rejects = self.add_host(ldap)
+            self.assertEqual(ldap.searches, 0)
+            self.assertEqual(len(cands["memberhost"]["host"]), 1)
+
+    def test_1_disconnected_index_falls_back(self):
+        """Disconnected index falls back to LDAP lookups"""
+        if TEST_NAMESPACE_INDEX and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            self.index.disconnected()
+            ldap = CountingLDAP()
+            self.add_host(ldap)
+            self.assertTrue(ldap.searches > 0)
+
+    def test_2_deleted_entry_falls_back(self):
+        """Entry deleted through the sync feed is no longer answered from the index"""
+        if TEST_NAMESPACE_INDEX and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            self.index.apply_delete(["uuid-1"])
+            ldap = CountingLDAP()
+            cands, rejects = self.add_host(ldap)
+            self.assertEqual(ldap.searches, 1) # target from index, host from LDAP
+            self.assertEqual(len(cands["memberhost"]["host"]), 0) # not found is denied
+
+    def test_3_unreadable_userclass_not_current(self):
+        """A refresh without any readable userclass never makes the index current"""
+        if TEST_NAMESPACE_INDEX and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            index = self.plugin.NamespaceIndex()
+            index.begin_refresh()
+            for i in range(3):
+                index.apply_entry(f"fqdn=h{i}.{cand_host},{self.computers}", {"objectclass": ["ipahost"]}, f"uuid-{i}")
+            index.refresh_done()
+            self.assertFalse(index.is_current())
+            self.assertFalse(index.stats()["userclass_readable"])
+
+    def test_4_bind_identity(self):
+        """The consumer binds as bind_dn, or with SASL EXTERNAL; never anonymously"""
+        if TEST_NAMESPACE_INDEX and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            import tempfile
+
+            class RecordingConnection(object):
+                def __init__(self):
+                    self.binds = []
+                def simple_bind_s(self, who, cred):
+                    self.binds.append(("simple", who, cred))
+                def sasl_external_bind_s(self):
+                    self.binds.append(("external",))
+
+            conn = RecordingConnection()
+            self.index.bind(conn, {"bind_dn": "", "password_file": ""})
+            with tempfile.NamedTemporaryFile("w") as f:
+                f.write("secret\n")
+                f.flush()
+                self.index.bind(conn, {"bind_dn": "uid=hostmgmt", "password_file": f.name})
+            self.assertEqual(conn.binds, [("external",), ("simple", "uid=hostmgmt", "secret")])
+
+    def test_5_ldapi_uri_from_policy_file(self):
+        """A %-encoded ldapi URI in the policy file reaches the consumer thread as written"""
+        if TEST_NAMESPACE_INDEX and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            import tempfile
+            uri = "ldapi://%2Frun%2Fslapd-EXAMPLE-COM.socket"
+            index = self.plugin.NamespaceIndex()
+            started = []
+            index.run = started.append # no consumer, just the settings it would get
+            saved_path = self.plugin.policy_registry.path
+            with tempfile.TemporaryDirectory() as tmpdir:
+                config_path = os.path.join(tmpdir, "hostmgmt_callbacks.conf")
+                with open(config_path, "w") as f:
+                    f.write(f"[namespace_index]\nenabled = true\nuri = {uri}\n")
+                os.utime(config_path, (0, time.time() + 5)) # new mtime, reloaded
+                self.plugin.policy_registry.path = config_path
+                try:
+                    index.ensure_started()
+                    index.thread.join()
+                finally:
+                    self.plugin.policy_registry.path = saved_path
+            self.assertEqual(started[0]["uri"], uri)
+
+@unittest.skipUnless(TEST_BACKEND == "inprocess", "needs the IPA server python packages")
+class Test5NamespaceAudit(unittest.TestCase):
+    """audit_hostmgmt_namespaces.NamespaceAudit over in-memory search results"""
+
+    @classmethod
+    def setUpClass(self):
+        if TEST_NAMESPACE_AUDIT and True:
+            import audit_hostmgmt_namespaces
+            import hostmgmt_callbacks
+            import tempfile
+            self.plugin = hostmgmt_callbacks
+            self.saved_path = hostmgmt_callbacks.policy_registry.path
+            hostmgmt_callbacks.policy_registry.path = os.devnull
+            self.tmpdir = tempfile.TemporaryDirectory()
+            self.audit = audit_hostmgmt_namespaces
+            self.computers = f"cn=computers,cn=accounts,{base_dn}"
+            self.hostgroups = f"cn=hostgroups,cn=accounts,{base_dn}"
+            self.hosts = {
+                "tgt": (f"fqdn=tgt.{cand_host},{self.computers}", [tgt_ns], 10),
+                "alt": (f"fqdn=alt.{cand_host},{self.computers}", [alt_ns], 11),
+                "orphan": (f"fqdn={cand_host},{self.computers}", [], 12),
+                "exempt": (f"fqdn={cand_ips_host},{self.computers}", [alt_ns], 13),
+                "alt_hg": (f"cn={cand_alt_hg},{self.hostgroups}", [], 14),
+            }
+
+    @classmethod
+    def tearDownClass(self):
+        if TEST_NAMESPACE_AUDIT and True:
+            self.plugin.policy_registry.path = self.saved_path
+            self.tmpdir.cleanup()
+
+    def members(self, since_usn=None):
+        records = [(dn, {"userclass": userclasses, "entryusn": [str(usn)]})
+                   for dn, userclasses, usn in self.hosts.values()]
+        return self.audit.MemberDirectory(since_usn).load(records)
+
+    def run_audit(self, members, since_usn=None, usn=20):
+        violations = []
+        audit = self.audit.NamespaceAudit(tgt_ns, members, violations.append, since_usn)
+        missing = f"fqdn=missing.{cand_host},{self.computers}"
+        attrs = {"cn": [tgt_hostgroup], "entryusn": [str(usn)],
+                 "member": [dn for dn, userclasses, usn in self.hosts.values()] + [missing]}
+        audit.audit_target("hostgroup", f"cn={tgt_hostgroup},{self.hostgroups}", attrs, "member")
+        return audit, violations
+
+    def test_0_full_audit_reports_violations(self):
+        """Full audit reports every ineligible member with its reason"""
+        if TEST_NAMESPACE_AUDIT and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            audit, violations = self.run_audit(self.members())
+            reasons = sorted((v["member"].split(",")[0], v["reason"]) for v in violations)
+            self.assertEqual(reasons, [(f"cn={cand_alt_hg}", "name mismatch"),
+                                       (f"fqdn=alt.{cand_host}", "userclass mismatch"),
+                                       (f"fqdn=missing.{cand_host}", "not found")])
+
+    def test_1_incremental_skips_unchanged(self):
+        """Incremental audit skips a target when neither it nor its members changed"""
+        if TEST_NAMESPACE_AUDIT and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            audit, violations = self.run_audit(self.members(since_usn=30), since_usn=30)
+            self.assertEqual((audit.targets, audit.skipped, len(violations)), (0, 1, 0))
+
+    def test_2_incremental_audits_changed_member(self):
+        """Incremental audit re-checks a target whose member changed"""
+        if TEST_NAMESPACE_AUDIT and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            audit, violations = self.run_audit(self.members(since_usn=10), since_usn=30)
+            self.assertEqual((audit.targets, len(violations)), (1, 3))
+
+    def nested_audit(self, nested_hostgroups, since_usn=None):
+        config_path = os.path.join(self.tmpdir.name, f"{nested_hostgroups}.conf")
+        with open(config_path, "w") as f:
+            f.write(f"[namespace_policy]\nnested_hostgroups = {nested_hostgroups}\n")
+        self.plugin.policy_registry.path = config_path
+        try:
+            nested_hg = f"cn={cand_tgt_hg},{self.hostgroups}"
+            records = [(nested_hg, {"userclass": [], "entryusn": ["15"]}),
+                       (f"fqdn=nested.{cand_host},{self.computers}",
+                        {"userclass": [alt_ns], "entryusn": ["16"], "memberof": [nested_hg]}),
+                       (f"fqdn=direct.{cand_host},{self.computers}", {"userclass": [tgt_ns], "entryusn": ["12"]})]
+            members = self.audit.MemberDirectory(since_usn).load(records)
+            violations = []
+            audit = self.audit.NamespaceAudit(tgt_ns, members, violations.append, since_usn)
+            attrs = {"cn": [tgt_hostgroup], "entryusn": ["10"],
+                     "member": [dn for dn, attrs in records[:1] + records[2:]]} # the nested host is not a member
+            audit.audit_target("hostgroup", f"cn={tgt_hostgroup},{self.hostgroups}", attrs, "member")
+        finally:
+            self.plugin.policy_registry.path = os.devnull
+        return audit, [(v["member"].split(",")[0], v["reason"]) for v in violations]
+
+    def test_3_transitive_nested_mismatch(self):
+        """With nested_hostgroups = transitive a hostgroup with an ineligible nested host is reported"""
+        if TEST_NAMESPACE_AUDIT and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            audit, violations = self.nested_audit("transitive")
+            self.assertEqual(violations, [(f"cn={cand_tgt_hg}", "nested member mismatch")])
+            audit, violations = self.nested_audit("direct")
+            self.assertEqual(violations, [])
+
+    def test_4_transitive_incremental_nested_change(self):
+        """Incremental transitive audit re-checks a target when a nested host changed"""
+        if TEST_NAMESPACE_AUDIT and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            audit, violations = self.nested_audit("transitive", since_usn=15)
+            self.assertEqual((audit.targets, audit.skipped, len(violations)), (1, 0, 1))
+            audit, violations = self.nested_audit("direct", since_usn=15)
+            self.assertEqual((audit.targets, audit.skipped), (0, 1))
+
+@unittest.skipUnless(TEST_BACKEND == "inprocess", "needs the IPA server python packages")
+class Test9RequestMemo(unittest.TestCase):
+    """Lookups shared through the request memo within one member add"""
+
+    @classmethod
+    def setUpClass(self):
+        if TEST_REQUEST_MEMO and True:
+            from ipapython.dn import DN
+            from bench_hostmgmt_callbacks import FakeLDAP2
+            import hostmgmt_callbacks
+            self.DN = DN
+            self.plugin = hostmgmt_callbacks
+            self.ldap = FakeLDAP2()
+            self.computers = f"cn=computers,cn=accounts,{base_dn}"
+            self.host_dn = self.ldap.add(self.computers, "fqdn", cand_host, {"fqdn": [cand_host], "userclass": [tgt_ns]})
+            self.rule_dn = self.ldap.add(f"cn=hbac,{base_dn}", "ipaUniqueID", "memo-0001",
+                                         {"cn": [tgt_hbacrule], "ipaUniqueID": ["memo-0001"]})
+
+    def setUp(self):
+        if TEST_REQUEST_MEMO and True:
+            self.saved = (self.plugin.userclass_cache.enabled, self.plugin.rule_name_cache.enabled)
+            self.plugin.userclass_cache.enabled = False
+            self.plugin.rule_name_cache.enabled = False
+
+    def tearDown(self):
+        if TEST_REQUEST_MEMO and True:
+            self.plugin.userclass_cache.enabled, self.plugin.rule_name_cache.enabled = self.saved
+            self.plugin.end_request_memo()
+
+    def test_0_no_entry_read_twice(self):
+        """Later checks of the same command reuse the stored rule name and the candidate lookup"""
+        if TEST_REQUEST_MEMO and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            tgt_dn = self.DN(self.rule_dn)
+            cands = {"memberhost": {"host": [self.DN(self.host_dn)], "hostgroup": []}}
+            rejects = {"memberhost": {"host": [], "hostgroup": []}}
+            searches = self.ldap.searches
+            self.plugin.deny_if_any_non_namespace_members(None, self.ldap, tgt_dn, cands, rejects, tgt_hbacrule)
+            self.assertEqual(self.ldap.searches - searches, 2) # the rule and the candidate
+            memo = self.plugin.request_memo(tgt_dn)
+            self.assertEqual(memo.target_name, tgt_hbacrule)
+            checker = self.plugin.DenyIneligibleMembers(self.ldap, tgt_dn, cands, rejects, memo=memo)
+            self.assertEqual(list(checker.member_verdicts().values()), ["eligible"])
+            self.assertEqual(self.ldap.searches - searches, 2)
+
+    def test_1_post_callback_ends_memo(self):
+        """The add-member post-callback drops the memo"""
+        if TEST_REQUEST_MEMO and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            tgt_dn = self.DN(self.rule_dn)
+            self.plugin.begin_request_memo(tgt_dn)
+            self.plugin.drop_request_memo(None, self.ldap, 1, {}, tgt_dn, {}, tgt_hbacrule)
+            self.assertIsNone(self.plugin.request_memo())
+
+    def test_2_mis_cased_rule_name(self):
+        """A rule typed in another case gets the namespace of its stored cn"""
+        if TEST_REQUEST_MEMO and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            util = IPATestUtil()
+            util.add_host(cand_host, ns=tgt_ns)
+            for verb, rule in (("sudorule", tgt_sudorule), ("hbacrule", tgt_hbacrule)):
+                getattr(util, f"add_{verb}")(rule)
+                success, content = util.execute(f"ipa {verb}-add-host {rule.upper()} --hosts={cand_host}")
+                self.assertTrue(success and "Number of members added 1" in content, f"{verb}: {content}")
+
+@unittest.skipUnless(TEST_BACKEND == "inprocess", "needs the IPA server python packages")
+class Test10PermissionMatrix(unittest.TestCase):
+    """provisioning/rbac/permission_matrix.py over the shipped permission templates"""
+
+    @classmethod
+    def setUpClass(self):
+        if TEST_PERMISSION_MATRIX and True:
+            provisioning = os.path.join(os.path.dirname(os.path.abspath(__file__)), "provisioning")
+            sys.path.insert(0, os.path.join(provisioning, "rbac"))
+            import permission_matrix
+            self.matrix = permission_matrix
+            shortdomainname = base_dn.split(",")[0][3:]
+            self.templates = permission_matrix.load_templates(os.path.join(provisioning, "config"),
+                                                              permission_matrix.ROLES,
+                                                              {"shortdomainname": shortdomainname})
+            self.computers = f"cn=computers,cn=accounts,{base_dn}"
+            self.groups = f"cn=groups,cn=accounts,{base_dn}"
+
+    def template(self, label):
+        return [t for t in self.templates if t.label == label][0]
+
+    def test_0_filter_yields_namespaces(self):
+        """host_manage applies to hosts without userclass for every namespace, else to the userclass namespace"""
+        if TEST_PERMISSION_MATRIX and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            template = self.template("admin/host_manage")
+            host = f"fqdn={cand_host},{self.computers}".lower().split(",")
+            def evaluate(attrs):
+                return template.evaluate(host, self.matrix.normalize_entry(attrs))
+            self.assertEqual(evaluate({"objectClass": ["ipahost"]}), self.matrix.ALL)
+            self.assertEqual(evaluate({"objectClass": ["ipahost"], "userClass": [f"{tgt_ns}.web"]}),
+                             (False, frozenset([tgt_ns])))
+            self.assertEqual(evaluate({"objectClass": ["ipahostgroup"]}), self.matrix.NONE)
+
+    def test_1_matrix_counts(self):
+        """One pass counts, per namespace, the entries each permission applies to"""
+        if TEST_PERMISSION_MATRIX and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            matrix = self.matrix.PermissionMatrix(self.templates)
+            matrix.add(f"fqdn=a.{cand_host},{self.computers}", {"objectclass": ["ipahost"]})
+            matrix.add(f"fqdn=b.{cand_host},{self.computers}", {"objectclass": ["ipahost"], "userclass": [tgt_ns]})
+            matrix.add(f"fqdn=c.{cand_host},{self.computers}", {"objectclass": ["ipahost"], "userclass": [alt_ns]})
+            for group in (f"{tgt_ns}.admin", f"{tgt_ns}.owner", f"{alt_ns}.admin"):
+                matrix.add(f"cn={group},{self.groups}", {"cn": [group], "objectclass": ["ipausergroup"]})
+            labels = [t.label for t in self.templates]
+            rows = dict(matrix.rows([tgt_ns, alt_ns]))
+            counts = dict((ns, dict((label, rows[ns][labels.index(label)])
+                                    for label in ("admin/host_manage", "admin/groups_manage_subnamespace",
+                                                  "owner/owner_admin_manage")))
+                          for ns in rows)
+            self.assertEqual(counts, {
+                tgt_ns: {"admin/host_manage": 2, "admin/groups_manage_subnamespace": 2, "owner/owner_admin_manage": 2},
+                alt_ns: {"admin/host_manage": 2, "admin/groups_manage_subnamespace": 1, "owner/owner_admin_manage": 1},
+            })
+
+@unittest.skipUnless(TEST_BACKEND == "inprocess", "needs the IPA server python packages")
+class Test11RBACSnapshot(unittest.TestCase):
+    """provisioning/rbac/rbac_snapshot.py export over an in-memory directory"""
+
+    @classmethod
+    def setUpClass(self):
+        if TEST_RBAC_SNAPSHOT and True:
+            sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "provisioning", "rbac"))
+            import rbac_snapshot
+            self.snapshot = rbac_snapshot
+            pbac = f"cn=pbac,{base_dn}"
+            self.entries = {
+                f"cn=FOO Administrator,cn=roles,cn=accounts,{base_dn}": {
+                    "cn": ["FOO Administrator"], "member": [f"cn={tgt_ns}.admin,cn=groups,cn=accounts,{base_dn}"],
+                    "memberOf": [f"cn=FOO Administration,cn=privileges,{pbac}"], "entryusn": ["7"]},
+                f"cn=FOO Administration,cn=privileges,{pbac}": {"cn": ["FOO Administration"], "entryusn": ["8"]},
+                f"cn=FOO Host Manage,cn=permissions,{pbac}": {
+                    "cn": ["FOO Host Manage"], "ipaPermLocation": [f"cn=computers,cn=accounts,{base_dn}"],
+                    "entryusn": ["9"]},
+                f"cn=computers,cn=accounts,{base_dn}": {
+                    "aci": ['(targetattr = "fqdn")(version 3.0;acl "permission:FOO Host Manage";allow (read) '
+                            'groupdn = "ldap:///cn=FOO Host Manage";)']},
+                f"cn={tgt_ns}.admin,cn=groups,cn=accounts,{base_dn}": {"cn": [f"{tgt_ns}.admin"], "entryusn": ["5"]},
+            }
+
+    class Connection(object):
+        """python-ldap stand-in answering ONELEVEL and BASE searches from a dict of entries"""
+
+        def __init__(self, entries):
+            self.entries = dict((dn, dict((name, [v.encode("utf-8") for v in values])
+                                          for name, values in attrs.items())) for dn, attrs in entries.items())
+            self.searches = 0
+
+        def search_ext(self, base, scope, filterstr, attrs, serverctrls=None):
+            self.searches += 1
+            self.results = [(dn, dict((name, values) for name, values in entry.items() if name.lower() in attrs))
+                            for dn, entry in self.entries.items()
+                            if dn.lower().endswith("," + base.lower()) and dn.count(",") == base.count(",") + 1]
+            return self.searches
+
+        def result3(self, msgid):
+            return (None, self.results, msgid, [])
+
+        def search_s(self, base, scope, filterstr, attrs):
+            self.searches += 1
+            if base == "":
+                return [("", {"lastUSN;userroot": [b"9"]})]
+            return [(base, self.entries[base])] if base in self.entries else []
+
+    def test_0_export(self):
+        """One search per object type plus one per permission location; records keyed by lower case cn"""
+        if TEST_RBAC_SNAPSHOT and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            conn = self.Connection(self.entries)
+            snapshot = self.snapshot.export(conn, base_dn, 100)
+            self.assertEqual(conn.searches, len(self.snapshot.SECTIONS) + 1)
+            self.assertEqual(snapshot["roles"]["foo administrator"]["entryusn"], 7)
+            self.assertEqual(snapshot["roles"]["foo administrator"]["memberof"],
+                             [f"cn=FOO Administration,cn=privileges,cn=pbac,{base_dn}"])
+            self.assertIn('acl "permission:FOO Host Manage"', snapshot["permissions"]["foo host manage"]["aci"])
+            self.assertEqual(sorted(snapshot["groups"]), [f"{tgt_ns}.admin"])
+            self.assertEqual((snapshot["highest_usn"], self.snapshot.last_usn(conn)), (9, 9))
+
+@unittest.skipUnless(TEST_BACKEND == "inprocess", "needs the policy file of the in-process backend")
+class Test12CandidateLookups(unittest.TestCase):
+    """[lookup_pool] single-entry reads after a failed batched search"""
+
+    @classmethod
+    def setUpClass(self):
+        if TEST_CANDIDATE_LOOKUPS and True:
+            import tempfile
+            from ipapython.dn import DN
+            from bench_hostmgmt_callbacks import FakeLDAP2
+            import hostmgmt_callbacks
+
+            class FilterLimitLDAP(FakeLDAP2):
+                """Refuses OR-filter searches; counts concurrent single-entry reads"""
+
+                def __init__(self):
+                    FakeLDAP2.__init__(self)
+                    self.lock = threading.Lock()
+                    self.active = self.max_active = self.reads = 0
+                    self.broken = set()
+
+                def get_entries(self, base_dn, scope=None, filter=None, **kwargs):
+                    if filter and filter.startswith("(|"):
+                        raise Exception("filter too long")
+                    with self.lock:
+                        self.reads += 1
+                        self.active += 1
+                        self.max_active = max(self.max_active, self.active)
+                    try:
+                        time.sleep(0.01)
+                        if str(base_dn).lower() in self.broken:
+                            raise Exception("server is unwilling to perform")
+                        return FakeLDAP2.get_entries(self, base_dn, scope, filter, **kwargs)
+                    finally:
+                        with self.lock:
+                            self.active -= 1
+
+            self.DN = DN
+            self.plugin = hostmgmt_callbacks
+            self.ldap = FilterLimitLDAP()
+            computers = f"cn=computers,cn=accounts,{base_dn}"
+            self.hosts = [self.ldap.add(computers, "fqdn", f"pool{i}.{cand_host}", {"userclass": [tgt_ns]})
+                          for i in range(8)]
+            self.alt_host = self.ldap.add(computers, "fqdn", f"alt.{cand_host}", {"userclass": [alt_ns]})
+            self.broken_host = self.ldap.add(computers, "fqdn", f"broken.{cand_host}", {"userclass": [tgt_ns]})
+            self.ldap.broken.add(self.broken_host.lower())
+            self.missing_host = f"fqdn=missing.{cand_host},{computers}"
+            self.tgt_dn = DN(self.ldap.add(f"cn=hostgroups,cn=accounts,{base_dn}", "cn", tgt_hostgroup, {}))
+            self.tmpdir = tempfile.TemporaryDirectory()
+            self.config_path = os.path.join(self.tmpdir.name, "hostmgmt_callbacks.conf")
+            self.bind_dn = f"uid=hostmgmt,cn=sysaccounts,cn=etc,{base_dn}"
+            self.password_file = os.path.join(self.tmpdir.name, "hostmgmt_callbacks.pw")
+            with open(self.password_file, "w") as f:
+                f.write("secret\n")
+            with open(self.config_path, "w") as f:
+                f.write("[namespace_policy]\nevaluation = report_all\nenforcement = partial\n"
+                        "[lookup_pool]\nenabled = true\nconcurrency = 3\nuri = ldapi://%2Frun%2Fslapd.socket\n"
+                        f"bind_dn = {self.bind_dn}\n"
+                        f"password_file = {self.password_file}\n")
+            self.saved_path = hostmgmt_callbacks.policy_registry.path
+            hostmgmt_callbacks.policy_registry.path = self.config_path
+            hostmgmt_callbacks.candidate_lookups.connect = lambda: self.ldap
+
+    @classmethod
+    def tearDownClass(self):
+        if TEST_CANDIDATE_LOOKUPS and True:
+            del self.plugin.candidate_lookups.connect
+            self.plugin.policy_registry.path = self.saved_path
+            self.plugin.candidate_lookups.configure()
+            self.tmpdir.cleanup()
+
+    def setUp(self):
+        if TEST_CANDIDATE_LOOKUPS and True:
+            self.saved = self.plugin.userclass_cache.enabled
+            self.plugin.userclass_cache.enabled = False
+
+    def tearDown(self):
+        if TEST_CANDIDATE_LOOKUPS and True:
+            self.plugin.userclass_cache.enabled = self.saved
+
+    def members(self, hosts):
+        return ({"member": {"host": [self.DN(dn) for dn in hosts], "hostgroup": []}},
+                {"member": {"host": [], "hostgroup": []}})
+
+    def test_0_concurrent_reads(self):
+        """Candidates of a refused batch are read concurrently, never more than concurrency at a time"""
+        if TEST_CANDIDATE_LOOKUPS and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            cands, rejects = self.members(self.hosts + [self.alt_host])
+            reads = self.ldap.reads
+            checker = self.plugin.DenyIneligibleMembers(self.ldap, self.tgt_dn, cands, rejects)
+            denied = checker.execute()
+            self.assertEqual([str(cand.dn) for cand in denied], [self.alt_host])
+            self.assertEqual(len(cands["member"]["host"]), len(self.hosts))
+            self.assertEqual(self.ldap.reads - reads, len(self.hosts) + 1)
+            self.assertTrue(1 < self.ldap.max_active <= 3)
+
+    def test_1_unreadable_denied(self):
+        """A candidate that cannot be read or does not exist is denied"""
+        if TEST_CANDIDATE_LOOKUPS and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            cands, rejects = self.members(self.hosts[:2] + [self.broken_host, self.missing_host])
+            checker = self.plugin.DenyIneligibleMembers(self.ldap, self.tgt_dn, cands, rejects)
+            denied = checker.execute()
+            self.assertEqual(sorted(str(cand.dn) for cand in denied), sorted([self.broken_host, self.missing_host]))
+            self.assertEqual(len(cands["member"]["host"]), 2)
+
+    def test_2_inflight_read_merged(self):
+        """A read already in flight for the same DN is waited for, not repeated"""
+        if TEST_CANDIDATE_LOOKUPS and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            from concurrent.futures import Future
+            from ldap import SCOPE_BASE
+            lookups = self.plugin.candidate_lookups
+            cand = self.plugin.Candidate(self.DN(self.hosts[0]))
+            cands, rejects = self.members([self.hosts[0]])
+            checker = self.plugin.DenyIneligibleMembers(self.ldap, self.tgt_dn, cands, rejects)
+            pending = Future()
+            lookups.configure()
+            lookups.inflight[cand.key] = pending
+            results = []
+            reads = self.ldap.reads
+            waiter = threading.Thread(target=lambda: results.append(lookups.fetch(checker, [cand])))
+            waiter.start()
+            waiter.join(0.1)
+            self.assertTrue(waiter.is_alive())
+            entry = self.ldap.get_entries(self.DN(self.hosts[0]), SCOPE_BASE, "(fqdn=*)")[0]
+            del lookups.inflight[cand.key]
+            pending.set_result(entry)
+            waiter.join()
+            self.assertEqual(results, [{cand.key: entry}])
+            self.assertEqual(self.ldap.reads - reads, 1) # only the read made by this test
+
+    def test_3_bind_identity(self):
+        """Pooled connections bind as the configured service account, never with the process credentials"""
+        if TEST_CANDIDATE_LOOKUPS and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            binds = []
+
+            class RecordingClient(object):
+                def __init__(self, uri):
+                    self.uri = uri
+                def simple_bind(self, bind_dn, password):
+                    binds.append(("simple", str(bind_dn), password))
+                def external_bind(self):
+                    binds.append(("external",))
+                def gssapi_bind(self):
+                    binds.append(("gssapi",))
+
+            lookups = self.plugin.candidate_lookups
+            lookups.configure()
+            saved_client = self.plugin.LDAPClient
+            self.plugin.LDAPClient = RecordingClient
+            try:
+                self.plugin.CandidateLookups.connect(lookups)
+            finally:
+                self.plugin.LDAPClient = saved_client
+            self.assertEqual(binds, [("simple", self.bind_dn, "secret")])
+
+    def test_4_no_service_account_no_pool(self):
+        """Without bind_dn and password_file the pool stays disabled and reads use the request connection"""
+        if TEST_CANDIDATE_LOOKUPS and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            config_path = os.path.join(self.tmpdir.name, "anonymous.conf")
+            with open(config_path, "w") as f:
+                f.write("[namespace_policy]\nevaluation = report_all\n[lookup_pool]\nenabled = true\n")
+            os.utime(config_path, (0, time.time() + 7)) # new mtime, reloaded
+            self.plugin.policy_registry.path = config_path
+            try:
+                lookups = self.plugin.CandidateLookups()
+                lookups.configure()
+                self.assertFalse(lookups.enabled)
+                cands, rejects = self.members(self.hosts[:2])
+                checker = self.plugin.DenyIneligibleMembers(self.ldap, self.tgt_dn, cands, rejects)
+                self.assertEqual(set(lookups.fetch(checker, checker.parse_candidates())),
+                                 set(dn.lower() for dn in self.hosts[:2]))
+                self.assertEqual(lookups.opened, 0)
+            finally:
+                self.plugin.policy_registry.path = self.config_path
+
+    def test_5_ldapi_uri_fallback(self):
+        """A %-encoded ldapi URI in [lookup_pool] is used as written by the batch-search fallback"""
+        if TEST_CANDIDATE_LOOKUPS and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            uri = "ldapi://%2Fvar%2Frun%2Fslapd-EXAMPLE-COM.socket"
+            config_path = os.path.join(self.tmpdir.name, "ldapi.conf")
+            with open(config_path, "w") as f:
+                f.write(f"[namespace_policy]\nevaluation = report_all\n[lookup_pool]\nenabled = true\nuri = {uri}\n"
+                        f"bind_dn = {self.bind_dn}\npassword_file = {self.password_file}\n")
+            os.utime(config_path, (0, time.time() + 9)) # new mtime, reloaded
+            uris = []
+            directory = self.ldap
+
+            class DirectoryClient(object):
+                def __init__(self, uri):
+                    uris.append(uri)
+                def simple_bind(self, bind_dn, password):
+                    pass
+                def __getattr__(self, name):
+                    return getattr(directory, name)
+
+            lookups = self.plugin.candidate_lookups
+            saved_connect, saved_client = (lookups.connect, self.plugin.LDAPClient)
+            del lookups.connect
+            self.plugin.LDAPClient = DirectoryClient
+            self.plugin.policy_registry.path = config_path
+            try:
+                cands, rejects = self.members(self.hosts[:3] + [self.alt_host])
+                denied = self.plugin.DenyIneligibleMembers(self.ldap, self.tgt_dn, cands, rejects).execute()
+                self.assertEqual([str(cand.dn) for cand in denied], [self.alt_host])
+                self.assertTrue(len(uris) and set(uris) == {uri})
+            finally:
+                self.plugin.policy_registry.path = self.config_path
+                self.plugin.LDAPClient = saved_client
+                lookups.connect = saved_connect
+
+@unittest.skipUnless(TEST_BACKEND == "inprocess", "needs the policy file of the in-process backend")
+class Test13Profiling(unittest.TestCase):
+    """[profiling] spool of slow calls"""
+
+    @classmethod
+    def setUpClass(self):
+        if TEST_PROFILING and True:
+            import tempfile
+            import hostmgmt_callbacks
+            self.plugin = hostmgmt_callbacks
+            self.tmpdir = tempfile.TemporaryDirectory()
+            self.spool = os.path.join(self.tmpdir.name, "profiles")
+            self.config_path = os.path.join(self.tmpdir.name, "hostmgmt_callbacks.conf")
+            self.saved_path = hostmgmt_callbacks.policy_registry.path
+            hostmgmt_callbacks.policy_registry.path = self.config_path
+            self.util = IPATestUtil()
+            self.util.add_hostgroup(tgt_hostgroup)
+            self.util.add_host(cand_host, ns=alt_ns)
+            self.util.add_host(cand_ips_host)
+
+    @classmethod
+    def tearDownClass(self):
+        if TEST_PROFILING and True:
+            self.plugin.policy_registry.path = self.saved_path
+            self.plugin.profiler.configure()
+            self.tmpdir.cleanup()
+
+    def configure(self, enabled, threshold, max_files=50):
+        with open(self.config_path, "w") as f:
+            f.write(f"[profiling]\nenabled = {enabled}\nthreshold = {threshold}\nspool = {self.spool}\n"
+                    f"max_files = {max_files}\n")
+        os.utime(self.config_path, (0, time.time() + threshold + max_files + len(enabled))) # new mtime, reloaded
+
+    def profiles(self):
+        return sorted(os.listdir(self.spool)) if os.path.isdir(self.spool) else []
+
+    def add_members(self):
+        self.util.execute(f"ipa hostgroup-add-member {tgt_hostgroup} --hosts={cand_ips_host},{cand_host}")
+
+    def test_0_slow_call_spooled(self):
+        """A call over the threshold leaves a loadable profile and its target and candidate counts"""
+        if TEST_PROFILING and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            import pstats
+            self.configure("true", 0)
+            self.add_members()
+            names = [name for name in self.profiles() if name.endswith(".txt")]
+            self.assertEqual(len(names), 1)
+            with open(os.path.join(self.spool, names[0])) as f:
+                report = f.read()
+            self.assertIn(f"cn={tgt_hostgroup},", report)
+            self.assertIn("candidates: 2 (hosts 2, hostgroups 0)", report)
+            self.assertIn("denied: 1", report)
+            stats = pstats.Stats(os.path.join(self.spool, names[0][:-len(".txt")] + ".prof"))
+            self.assertTrue(any(func[2] == "evaluate_candidates" for func in stats.stats))
+
+    def test_1_fast_or_disabled_not_spooled(self):
+        """Calls under the threshold, or with profiling disabled, write nothing"""
+        if TEST_PROFILING and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            before = self.profiles()
+            self.configure("true", 3600)
+            self.add_members()
+            self.configure("false", 0)
+            self.add_members()
+            self.assertIsNone(self.plugin.profiler.recorder())
+            self.assertEqual(self.profiles(), before)
+
+    def test_2_spool_bounded(self):
+        """Only the newest max_files profiles are kept"""
+        if TEST_PROFILING and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            self.configure("true", 0, max_files=2)
+            for i in range(4):
+                self.add_members()
+            self.assertEqual(len(self.profiles()), 4) # .prof and .txt of two calls
+
+@unittest.skipUnless(TEST_BACKEND == "inprocess", "needs the IPA server python packages")
+class Test14SharedCache(unittest.TestCase):
+    """SharedNamespaceCache records seen across two mappings of one file"""
+
+    @classmethod
+    def setUpClass(self):
+        if TEST_SHARED_CACHE and True:
+            import tempfile
+            import hostmgmt_callbacks
+            self.plugin = hostmgmt_callbacks
+            self.tmpdir = tempfile.TemporaryDirectory()
+            self.path = os.path.join(self.tmpdir.name, "hostmgmt_callbacks.cache")
+            self.key = f"fqdn={cand_host},cn=computers,cn=accounts,{base_dn}".lower()
+
+    @classmethod
+    def tearDownClass(self):
+        if TEST_SHARED_CACHE and True:
+            self.tmpdir.cleanup()
+
+    def caches(self):
+        """Two workers' views of one cache file"""
+        return (self.plugin.SharedNamespaceCache(self.path, slots=64, enabled=True),
+                self.plugin.SharedNamespaceCache(self.path, slots=64, enabled=True))
+
+    def test_0_store_seen_by_other_worker(self):
+        """A record stored by one worker is read by another, with its entryusn"""
+        if TEST_SHARED_CACHE and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            writer, reader = self.caches()
+            writer.store(writer.USERCLASS, self.key, [tgt_ns, alt_ns], usn="42")
+            value, usn, age = reader.lookup(reader.USERCLASS, self.key)
+            self.assertEqual((value, usn), ([tgt_ns, alt_ns], "42"))
+            self.assertIsNone(reader.lookup(reader.RULE_NAME, self.key))
+
+    def test_1_oversize_store_drops_record(self):
+        """A value too large for a record removes the key's older record"""
+        if TEST_SHARED_CACHE and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            writer, reader = self.caches()
+            writer.store(writer.USERCLASS, self.key, [tgt_ns], usn="1")
+            writer.store(writer.USERCLASS, self.key, [f"{alt_ns}{i}" for i in range(40)], usn="2")
+            self.assertIsNone(reader.lookup(reader.USERCLASS, self.key))
+
+    def test_2_torn_read_retried(self):
+        """A record read while a writer holds it (odd sequence) is read again"""
+        if TEST_SHARED_CACHE and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+
+            class TornMap(bytearray):
+                """Mapping whose next torn slot reads see a writer in progress"""
+                torn = 0
+                def __getitem__(self, index):
+                    data = bytearray.__getitem__(self, index)
+                    if isinstance(index, slice) and self.torn:
+                        self.torn -= 1
+                        data = bytes([data[0] | 1]) + bytes(data[1:])
+                    return data
+
+            writer, reader = self.caches()
+            writer.store(writer.RULE_NAME, "0001", tgt_hbacrule)
+            reader.open()
+            reader.mm = TornMap(writer.mm[:])
+            reader.mm.torn = 1
+            self.assertEqual(reader.lookup(reader.RULE_NAME, "0001")[0], tgt_hbacrule)
+            self.assertEqual(reader.mm.torn, 0)
+            reader.mm.torn = 3 * reader.PROBES # busy on every attempt: a miss, not a torn value
+            self.assertIsNone(reader.lookup(reader.RULE_NAME, "0001"))
+
+    def test_3_oversize_userclasses_cached_locally(self):
+        """A userclass list too long for a shared record is still served from the worker's own cache"""
+        if TEST_SHARED_CACHE and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            writer, reader = self.caches()
+            local = self.plugin.UserclassCache(enabled=True, shared=writer)
+            other = self.plugin.UserclassCache(enabled=True, shared=reader)
+            long_userclasses = [f"{alt_ns}{i}" for i in range(40)]
+            local.store(self.key, long_userclasses, "3")
+            self.assertEqual(local.lookup(self.key), (local.FRESH, long_userclasses, "3"))
+            self.assertEqual(other.lookup(self.key), (None, None, None)) # never shared
+            local.store(self.key, [tgt_ns], "4") # fits again: shared, and read from the shared record
+            self.assertEqual(other.lookup(self.key), (other.FRESH, [tgt_ns], "4"))
+            reader.invalidate(reader.USERCLASS, self.key) # modified through the other worker
+            self.assertEqual(local.lookup(self.key), (None, None, None))
+
+@unittest.skipUnless(TEST_BACKEND == "inprocess", "inspects the failed members of the in-process backend")
+class Test15RejectLists(unittest.TestCase):
+    """Denied candidates are handed back in the failed members and never added"""
+
+    @classmethod
+    def setUpClass(self):
+        if TEST_REJECT_LISTS and True:
+            self.util = IPATestUtil()
+            self.ipa = self.util.backend
+            self.util.add_hostgroup(tgt_hostgroup)
+            self.good_hosts = [f"good{i}.{cand_host}" for i in range(2)]
+            self.bad_hosts = [f"bad{i}.{cand_host}" for i in range(3)] # adjacent denials
+            for host in self.good_hosts:
+                self.util.add_host(host, ns=tgt_ns)
+            for host in self.bad_hosts:
+                self.util.add_host(host, ns=alt_ns)
+            self.util.add_hostgroup(cand_tgt_hg)
+            self.util.add_hostgroup(cand_alt_hg)
+
+    def failed_and_members(self, command):
+        success, content = self.util.execute(command)
+        self.assertTrue(success, content)
+        return self.ipa.failed, self.ipa.target_members("hostgroup", tgt_hostgroup)
+
+    def test_0_denied_hosts_failed(self):
+        """Every denied host is in failed and none is added"""
+        if TEST_REJECT_LISTS and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            hosts = [self.good_hosts[0]] + self.bad_hosts + [self.good_hosts[1]]
+            failed, members = self.failed_and_members(
+                f"ipa hostgroup-add-member {tgt_hostgroup} --hosts={','.join(hosts)}")
+            self.assertEqual(failed["host"], [self.ipa.member_dn("host", host) for host in self.bad_hosts])
+            self.assertEqual(failed["hostgroup"], [])
+            self.assertEqual(members, set()) # all_or_nothing
+
+    def test_1_denied_hostgroup_failed(self):
+        """A denied hostgroup is in failed and not added"""
+        if TEST_REJECT_LISTS and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            failed, members = self.failed_and_members(
+                f"ipa hostgroup-add-member {tgt_hostgroup} --hostgroups={cand_tgt_hg},{cand_alt_hg}")
+            self.assertEqual(failed, {"host": [], "hostgroup": [self.ipa.member_dn("hostgroup", cand_alt_hg)]})
+            self.assertNotIn(self.ipa.member_dn("hostgroup", cand_alt_hg).lower(), members)
+
+@unittest.skipUnless(TEST_BACKEND == "inprocess", "needs the policy file of the in-process backend")
+class Test16EvaluationModes(unittest.TestCase):
+    """evaluation = fail_fast stops at the first denied batch, report_all lists every denial"""
+
+    @classmethod
+    def setUpClass(self):
+        if TEST_EVALUATION_MODES and True:
+            import tempfile
+            from ipapython.dn import DN
+            from bench_hostmgmt_callbacks import FakeLDAP2
+            import hostmgmt_callbacks
+            self.DN = DN
+            self.plugin = hostmgmt_callbacks
+            self.ldap = FakeLDAP2()
+            computers = f"cn=computers,cn=accounts,{base_dn}"
+            batch = hostmgmt_callbacks.USERCLASS_BATCH_SIZE
+            self.hosts = [self.ldap.add(computers, "fqdn", f"h{i:04d}.{cand_host}", {"userclass": [tgt_ns]})
+                          for i in range(3 * batch)]
+            self.denied = [self.hosts[1], self.hosts[2 * batch + 1]] # in the first and the last batch
+            for dn in self.denied:
+                self.ldap.find(computers, dn.split(",", 1)[0].split("=", 1)[1])[1]["userclass"] = [alt_ns]
+            self.tgt_dn = DN(self.ldap.add(f"cn=hostgroups,cn=accounts,{base_dn}", "cn", tgt_hostgroup, {}))
+            self.tmpdir = tempfile.TemporaryDirectory()
+            self.config_path = os.path.join(self.tmpdir.name, "hostmgmt_callbacks.conf")
+            self.saved_path = hostmgmt_callbacks.policy_registry.path
+            hostmgmt_callbacks.policy_registry.path = self.config_path
+
+    @classmethod
+    def tearDownClass(self):
+        if TEST_EVALUATION_MODES and True:
+            self.plugin.policy_registry.path = self.saved_path
+            self.tmpdir.cleanup()
+
+    def setUp(self):
+        if TEST_EVALUATION_MODES and True:
+            self.saved = self.plugin.userclass_cache.enabled
+            self.plugin.userclass_cache.enabled = False
+
+    def tearDown(self):
+        if TEST_EVALUATION_MODES and True:
+            self.plugin.userclass_cache.enabled = self.saved
+
+    def evaluate(self, evaluation):
+        with open(self.config_path, "w") as f:
+            f.write(f"[namespace_policy]\nevaluation = {evaluation}\n")
+        os.utime(self.config_path, (0, time.time() + len(evaluation))) # new mtime, reloaded
+        cands = {"member": {"host": [self.DN(dn) for dn in self.hosts], "hostgroup": []}}
+        rejects = {"member": {"host": [], "hostgroup": []}}
+        searches = self.ldap.searches
+        denied = self.plugin.DenyIneligibleMembers(self.ldap, self.tgt_dn, cands, rejects).execute()
+        return [str(cand.dn) for cand in denied], self.ldap.searches - searches, rejects
+
+    def test_0_fail_fast(self):
+        """fail_fast reads only the first batch"""
+        if TEST_EVALUATION_MODES and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            denied, searches, rejects = self.evaluate("fail_fast")
+            self.assertEqual((denied, searches), (self.denied[:1], 1))
+            self.assertEqual([str(dn) for dn in rejects["member"]["host"]], self.denied[:1])
+
+    def test_1_report_all(self):
+        """report_all reads every batch and rejects every offending member"""
+        if TEST_EVALUATION_MODES and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            denied, searches, rejects = self.evaluate("report_all")
+            self.assertEqual((sorted(denied), searches), (self.denied, 3))
+            self.assertEqual(sorted(str(dn) for dn in rejects["member"]["host"]), self.denied)
+
+@unittest.skipUnless(TEST_BACKEND == "inprocess", "needs the policy file of the in-process backend")
+class Test17PartialEnforcement(unittest.TestCase):
+    """enforcement = partial adds the eligible members of an HBAC or sudo rule and rejects the rest"""
+
+    @classmethod
+    def setUpClass(self):
+        if TEST_PARTIAL_ENFORCEMENT and True:
+            import tempfile
+            import hostmgmt_callbacks
+            self.plugin = hostmgmt_callbacks
+            self.config = tempfile.NamedTemporaryFile("w", suffix=".conf")
+            self.config.write("[namespace_policy]\nenforcement = partial\n")
+            self.config.flush()
+            self.saved_path = hostmgmt_callbacks.policy_registry.path
+            hostmgmt_callbacks.policy_registry.path = self.config.name
+            self.util = IPATestUtil()
+            self.ipa = self.util.backend
+            self.good_host, self.bad_host = (f"good.{cand_host}", f"bad.{cand_host}")
+            self.util.add_host(self.good_host, ns=tgt_ns)
+            self.util.add_host(self.bad_host, ns=alt_ns)
+            self.util.add_hostgroup(cand_tgt_hg)
+            self.util.add_hostgroup(cand_alt_hg)
+            self.util.add_hbacrule(tgt_hbacrule)
+            self.util.add_sudorule(tgt_sudorule)
+
+    @classmethod
+    def tearDownClass(self):
+        if TEST_PARTIAL_ENFORCEMENT and True:
+            self.plugin.policy_registry.path = self.saved_path
+            self.config.close()
+
+    def add_members(self, rule_type, rule):
+        success, content = self.util.execute(f"ipa {rule_type}-add-host {rule} --hosts={self.good_host},{self.bad_host}"
+                                             f" --hostgroups={cand_tgt_hg},{cand_alt_hg}")
+        self.assertTrue(success and "Number of members added 2" in content, content)
+        members = self.ipa.target_members(rule_type, rule)
+        self.assertEqual(members, set([self.ipa.member_dn("host", self.good_host).lower(),
+                                       self.ipa.member_dn("hostgroup", cand_tgt_hg).lower()]))
+        return self.ipa.failed
+
+    def test_0_hbacrule(self):
+        """Denied hosts and hostgroups of an HBAC rule are reported as failed"""
+        if TEST_PARTIAL_ENFORCEMENT and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            failed = self.add_members("hbacrule", tgt_hbacrule)
+            self.assertEqual(failed, {"host": [self.ipa.member_dn("host", self.bad_host)],
+                                      "hostgroup": [self.ipa.member_dn("hostgroup", cand_alt_hg)]})
+
+    def test_1_sudorule(self):
+        """Denied sudo rule hosts are dropped without a failed entry; hostgroups are reported"""
+        if TEST_PARTIAL_ENFORCEMENT and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            failed = self.add_members("sudorule", tgt_sudorule)
+            self.assertEqual(failed, {"host": [], "hostgroup": [self.ipa.member_dn("hostgroup", cand_alt_hg)]})
+
+@unittest.skipUnless(TEST_BACKEND == "inprocess", "needs the IPA server python packages")
+class Test18PolicyOptions(unittest.TestCase):
+    """hostmgmt_callbacks.conf policy options compiled by a PolicyRegistry"""
+
+    @classmethod
+    def setUpClass(self):
+        if TEST_POLICY_OPTIONS and True:
+            import tempfile
+            import hostmgmt_callbacks
+            self.plugin = hostmgmt_callbacks
+            self.tmpdir = tempfile.TemporaryDirectory()
+
+    @classmethod
+    def tearDownClass(self):
+        if TEST_POLICY_OPTIONS and True:
+            self.tmpdir.cleanup()
+
+    def registry(self, content):
+        path = os.path.join(self.tmpdir.name, f"{len(os.listdir(self.tmpdir.name))}.conf")
+        with open(path, "w") as f:
+            f.write(content)
+        return self.plugin.PolicyRegistry(path)
+
+    def test_0_subnamespace_userclass(self):
+        """userclass_match = subnamespace also accepts <namespace>.<name>, for that namespace only"""
+        if TEST_POLICY_OPTIONS and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            registry = self.registry(f"[namespace:{tgt_ns}]\nuserclass_match = subnamespace\n")
+            policy = registry.get(tgt_ns)
+            self.assertEqual([policy.userclasses_eligible([uc]) for uc in (tgt_ns, f"{tgt_ns}.web", f"{tgt_ns}web", alt_ns)],
+                             [True, True, False, False])
+            self.assertFalse(registry.get(alt_ns).userclasses_eligible([f"{alt_ns}.web"]))
+
+    def test_1_exempt_prefixes(self):
+        """exempt_prefixes replaces the built-in icam/ips exemptions"""
+        if TEST_POLICY_OPTIONS and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            policy = self.registry("[namespace_policy]\nexempt_prefixes = lab, build\n").get(tgt_ns)
+            self.assertEqual([policy.is_exempt(name) for name in ("lab01.example.com", "build7", cand_ips_host)],
+                             [True, True, False])
+            self.assertEqual(policy.member_verdict("lab01.example.com", False, [alt_ns]), "exempt")
+            self.assertEqual(policy.member_verdict(cand_ips_host, False, [alt_ns]), "userclass mismatch")
+
+    def test_2_invalid_value_uses_defaults(self):
+        """An unknown setting value is logged and the built-in defaults apply instead of failing every add"""
+        if TEST_POLICY_OPTIONS and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            registry = self.registry("[namespace_policy]\nevaluation = sometimes\nexempt_prefixes = lab\n")
+            with self.assertLogs(level="WARNING") as logs:
+                policy = registry.get(tgt_ns)
+            self.assertIn("unknown evaluation 'sometimes'", "\n".join(logs.output))
+            self.assertTrue(policy.fail_fast)
+            self.assertTrue(policy.is_exempt(cand_ips_host))
+            self.assertIs(registry.get(tgt_ns), policy) # compiled once per file change
+
+    def test_3_invalid_hostgroup_names_uses_defaults(self):
+        """A misspelled hostgroup_names token falls back to the defaults instead of denying every hostgroup"""
+        if TEST_POLICY_OPTIONS and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            registry = self.registry(f"[namespace:{tgt_ns}]\nhostgroup_names = exact, prefix\n")
+            with self.assertLogs(level="WARNING") as logs:
+                policy = registry.get(tgt_ns)
+            self.assertIn("unknown hostgroup_names 'prefix'", "\n".join(logs.output))
+            self.assertEqual(policy.member_verdict(cand_tgt_hg, True, [tgt_ns]), "eligible")
+            self.assertEqual(policy.member_verdict(cand_alt_hg, True, [tgt_ns]), "name mismatch")
+
+@unittest.skipUnless(TEST_BACKEND == "inprocess", "needs the IPA server python packages")
+class Test19MetricsOutput(unittest.TestCase):
+    """Metrics aggregate written as Prometheus text and JSON"""
+
+    @classmethod
+    def setUpClass(self):
+        if TEST_METRICS_OUTPUT and True:
+            import hostmgmt_callbacks
+            self.plugin = hostmgmt_callbacks
+            self.metrics = hostmgmt_callbacks.Metrics()
+            for duration, target_type in ((0.003, "hostgroup"), (0.02, "hostgroup"), (3.0, "hostgroup"),
+                                          (0.2, "sudorule")):
+                call = hostmgmt_callbacks.CallMetrics()
+                call.target_type = target_type
+                call.last = call.start + duration
+                call.phases["lookup"] = duration
+                call.candidates, call.denials, call.searches = (10, 1, 2)
+                self.metrics.record(call)
+
+    def test_0_prometheus(self):
+        """Buckets are cumulative; +Inf, _count and _sum match the calls"""
+        if TEST_METRICS_OUTPUT and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            lines = self.metrics.to_prometheus(self.metrics.snapshot()).splitlines()
+            samples = dict(line.rsplit(" ", 1) for line in lines if not line.startswith("#"))
+            bucket = 'hostmgmt_call_duration_seconds_bucket{target="hostgroup",le="%s"}'
+            self.assertEqual([samples[bucket % le] for le in ("0.005", "0.01", "0.025", "2.5", "5.0", "+Inf")],
+                             ["1", "1", "2", "2", "3", "3"])
+            self.assertEqual(samples['hostmgmt_call_duration_seconds_count{target="hostgroup"}'], "3")
+            self.assertAlmostEqual(float(samples['hostmgmt_call_duration_seconds_sum{target="hostgroup"}']), 3.023)
+            self.assertEqual(samples['hostmgmt_calls_total{target="sudorule"}'], "1")
+            self.assertEqual(samples['hostmgmt_searches_total{target="hostgroup"}'], "6")
+            self.assertIn("# TYPE hostmgmt_call_duration_seconds histogram", lines)
+
+    def test_1_json(self):
+        """JSON has the pid and, per target, the counters, phases, duration and buckets"""
+        if TEST_METRICS_OUTPUT and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            import json
+            document = json.loads(self.metrics.to_json(self.metrics.snapshot()))
+            self.assertEqual(sorted(document), ["pid", "targets"])
+            self.assertEqual(sorted(document["targets"]), ["hostgroup", "sudorule"])
+            hostgroup = document["targets"]["hostgroup"]
+            self.assertEqual(sorted(hostgroup), sorted(self.plugin.Metrics.COUNTERS +
+                                                       ("phase_seconds", "duration_seconds", "buckets")))
+            self.assertEqual(sorted(hostgroup["phase_seconds"]), sorted(self.plugin.CallMetrics.PHASES))
+            self.assertEqual((hostgroup["calls"], hostgroup["candidates"], hostgroup["denials"]), (3, 30, 3))
+            self.assertEqual(len(hostgroup["buckets"]), len(self.plugin.Metrics.BUCKETS))
+
+@unittest.skipUnless(TEST_BACKEND == "inprocess", "counts the searches of the in-process backend")
+class Test20CandidateBatching(unittest.TestCase):
+    """search_candidates() reads USERCLASS_BATCH_SIZE candidates per search, one per candidate if a chunk fails"""
+
+    @classmethod
+    def setUpClass(self):
+        if TEST_CANDIDATE_BATCHING and True:
+            import hostmgmt_callbacks
+            self.plugin = hostmgmt_callbacks
+            self.ipa = InProcessIPA()
+            self.batch = hostmgmt_callbacks.USERCLASS_BATCH_SIZE
+            self.hosts = [f"b{i:04d}.{cand_host}" for i in range(2 * self.batch + self.batch // 2)]
+            self.hostgroups = [f"{cand_tgt_hg}{i}" for i in range(5)]
+            for host in self.hosts:
+                self.ipa.add_entry("host", host, {"class": tgt_ns})
+            for hostgroup in self.hostgroups + [tgt_hostgroup]:
+                self.ipa.add_entry("hostgroup", hostgroup, {})
+
+    def setUp(self):
+        if TEST_CANDIDATE_BATCHING and True:
+            self.saved = self.plugin.candidate_lookups.enabled
+            self.plugin.candidate_lookups.enabled = False # fallback reads go through the checker's connection
+
+    def tearDown(self):
+        if TEST_CANDIDATE_BATCHING and True:
+            self.plugin.candidate_lookups.enabled = self.saved
+
+    def search_candidates(self, ldap):
+        cands = {"member": {"host": [self.ipa.DN(self.ipa.member_dn("host", host)) for host in self.hosts],
+                            "hostgroup": [self.ipa.DN(self.ipa.member_dn("hostgroup", hostgroup))
+                                          for hostgroup in self.hostgroups]}}
+        rejects = {"member": {"host": [], "hostgroup": []}}
+        tgt_dn = self.ipa.DN(self.ipa.member_dn("hostgroup", tgt_hostgroup))
+        checker = self.plugin.DenyIneligibleMembers(ldap, tgt_dn, cands, rejects)
+        searches = ldap.searches
+        entries = checker.search_candidates(checker.parse_candidates(), ['userclass'])
+        return entries, ldap.searches - searches
+
+    def test_0_chunks(self):
+        """N candidates of a container take ceil(N/USERCLASS_BATCH_SIZE) searches"""
+        if TEST_CANDIDATE_BATCHING and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            entries, searches = self.search_candidates(self.ipa.ldap)
+            self.assertEqual(searches, math.ceil(len(self.hosts) / self.batch) +
+                                       math.ceil(len(self.hostgroups) / self.batch))
+            self.assertEqual(len(entries), len(self.hosts) + len(self.hostgroups))
+
+    def test_1_failed_chunk_fallback(self):
+        """A failing chunk search is retried with one search per candidate of that chunk only"""
+        if TEST_CANDIDATE_BATCHING and True:
+            logging.info(f"\n=== {sys._getframe(0).f_code.co_name}()")
+            failing_host = self.hosts[self.batch] # first host of the second chunk
+            ldap = self.ipa.ldap
+
+            class FailingChunkLDAP(type(ldap)):
+                def get_entries(self, base_dn, scope=None, filter=None, **kwargs):
+                    if filter and filter.startswith("(|") and failing_host in filter:
+                        self.searches += 1
+                        raise RuntimeError("Administrative limit exceeded")
+                    return super().get_entries(base_dn, scope=scope, filter=filter, **kwargs)
+
+            failing = FailingChunkLDAP()
+            failing.containers = ldap.containers
+            entries, searches = self.search_candidates(failing)
+            chunks = math.ceil(len(self.hosts) / self.batch) + math.ceil(len(self.hostgroups) / self.batch)
+            self.assertEqual(searches, chunks + self.batch)
+            self.assertEqual(len(entries), len(self.hosts) + len(self.hostgroups))
+
+class CountingLDAP(object):
+    """ldap2 stand-in that finds nothing and counts searches"""
+
+    MATCH_ALL = "&"
+    MATCH_ANY = "|"
+
+    def __init__(self):
+        self.searches = 0
+
+    def make_filter_from_attr(self, attr, value, rules="|"):
+        values = value if isinstance(value, (list, tuple)) else [value]
+        return "(%s%s)" % (rules, "".join(f"({attr}={v})" for v in values))
+
+    def get_entries(self, base_dn, scope=None, filter=None, attrs_list=None, **kwargs):
+        from ipalib.errors import NotFound
+        self.searches += 1
+        raise NotFound(reason="no such entry")
+
 class IPATestUtil(object):
 
+    def __init__(self, backend=TEST_BACKEND):
+        self.backend = InProcessIPA() if backend == "inprocess" else None
+
     def add_host(self, host, ns="", silent_fail=False):
         if ns:
             cmd =f"ipa host-add {host} --class {ns} --force"
@@ -313,6 +1692,11 @@ class IPATestUtil(object):
     def execute(self, command, silent_fail=False, verbose=False):
         if verbose:
             logging.info(f"execute> {command}")
+        if self.backend is not None:
+            success, content = self.backend.execute(command)
+            if not success and not silent_fail:
+                logging.warning(f"{command} - {content}")
+            return (success, content)
         response = subprocess.run(command.split(),
                               stdout=subprocess.PIPE, #subprocess.DEVNULL,
                               stderr=subprocess.PIPE, #subprocess.DEVNULL,
@@ -325,5 +1709,233 @@ class IPATestUtil(object):
             logging.warning(f"{command} - {content}")
         return (success, content)
 
+class InProcessIPA(object):
+    """
+    Runs the ipa commands used by these tests against a stub directory
+    (FakeLDAP2 from bench_hostmgmt_callbacks) and calls the callbacks that
+    hostmgmt_callbacks registered on the IPA commands, the way
+    LDAPAddMember/LDAPDelete would. Each instance gets its own directory
+    suffix, so the plugin's process-wide caches never mix entries of test
+    classes running in parallel.
+    """
+
+    instances = itertools.count()
+    lock = threading.Lock()
+
+    def __init__(self):
+        from ipapython.dn import DN
+        from ipaserver.plugins.host import host_del
+        from ipaserver.plugins.hostgroup import hostgroup_add_member, hostgroup_remove_member, hostgroup_del
+        from ipaserver.plugins.hbacrule import hbacrule_add_host
+        from ipaserver.plugins.sudorule import sudorule_add_host
+        from bench_hostmgmt_callbacks import FakeLDAP2
+        import hostmgmt_callbacks
+        with InProcessIPA.lock:
+            # deterministic plugin settings: built-in policy defaults (unless a
+            # test class installed its own file), no shared cache file
+            if hostmgmt_callbacks.policy_registry.path == hostmgmt_callbacks.HOSTMGMT_CONFIG:
+                hostmgmt_callbacks.policy_registry.path = os.devnull
+            hostmgmt_callbacks.shared_cache.enabled = False
+            suffix = f"dc=inprocess{next(InProcessIPA.instances)}-idm,dc=jpl,dc=nasa,dc=gov"
+        self.DN = DN
+        self.ldap = FakeLDAP2()
+        self.containers = {
+            "host": f"cn=computers,cn=accounts,{suffix}",
+            "hostgroup": f"cn=hostgroups,cn=accounts,{suffix}",
+            "hbacrule": f"cn=hbac,{suffix}",
+            "sudorule": f"cn=sudorules,cn=sudo,{suffix}",
+        }
+        self.add_member_cmds = {
+            "hostgroup-add-member": ("hostgroup", "member", hostgroup_add_member),
+            "hbacrule-add-host": ("hbacrule", "memberhost", hbacrule_add_host),
+            "sudorule-add-host": ("sudorule", "memberhost", sudorule_add_host),
+        }
+        self.remove_member_cmds = {"hostgroup-remove-member": ("hostgroup", hostgroup_remove_member)}
+        self.del_cmds = {"host": host_del, "hostgroup": hostgroup_del}
+        self.members = {} # target DN -> set of member DNs (lower case)
+        self.failed = None # failed members of the last add-member command: member type -> DNs
+
+    def member_dn(self, obj_type, name):
+        rdn_attr, rdn_value = self.rdn(obj_type, name)
+        return f"{rdn_attr}={rdn_value},{self.containers[obj_type]}"
+
+    def target_members(self, tgt_type, tgt_name):
+        """Member DNs (lower case) of a hostgroup/rule in the stub directory"""
+        return self.members.get(self.member_dn(tgt_type, tgt_name).lower(), set())
+
+    def execute(self, command):
+        args = command.split()
+        assert args[0] == "ipa"
+        verb, name = (args[1], args[2])
+        options = dict(arg[2:].split("=", 1) if "=" in arg else (arg[2:], True)
+                       for arg in args[3:] if arg.startswith("--"))
+        if "--class" in args:
+            options["class"] = args[args.index("--class") + 1]
+        if verb in self.add_member_cmds:
+            return self.add_member(verb, name, options)
+        if verb in self.remove_member_cmds:
+            return self.remove_member(verb, name, options)
+        if verb == "hostmgmt-check-members":
+            return self.check_members(name, args[3], options)
+        obj_type, sep, action = verb.rpartition("-")
+        if action == "add":
+            return self.add_entry(obj_type, name, options)
+        if action == "del":
+            return self.del_entry(obj_type, name)
+        return (False, f"ipa: ERROR: {verb} not supported by the in-process backend")
+
+    def rdn(self, obj_type, name):
+        """Returns (RDN attribute, RDN value) of an object in the stub directory."""
+        if obj_type == "host":
+            return ("fqdn", name)
+        if obj_type == "hostgroup":
+            return ("cn", name)
+        for rdn_value, (dn, attrs) in self.ldap.containers.get(self.containers[obj_type].lower(), {}).items():
+            if attrs["cn"][0].lower() == name.lower(): # IPA matches rule names case-insensitively
+                return ("ipaUniqueID", attrs["ipaUniqueID"][0])
+        return ("ipaUniqueID", None)
+
+    def add_entry(self, obj_type, name, options):
+        rdn_attr, rdn_value = self.rdn(obj_type, name)
+        if rdn_value is not None and self.ldap.find(self.containers[obj_type], rdn_value):
+            return (True, f"ipa: ERROR: {obj_type} with name \"{name}\" already exists")
+        attrs = {"cn": [name]}
+        if obj_type == "host":
+            attrs = {"fqdn": [name]}
+            if options.get("class"):
+                attrs["userclass"] = [options["class"]]
+        elif obj_type in ("hbacrule", "sudorule"):
+            rdn_value = str(uuid.uuid4())
+            attrs["ipaUniqueID"] = [rdn_value]
+        self.ldap.add(self.containers[obj_type], rdn_attr, rdn_value, attrs)
+        return (True, f"Added {obj_type} \"{name}\"")
+
+    def del_entry(self, obj_type, name):
+        rdn_attr, rdn_value = self.rdn(obj_type, name)
+        record = self.ldap.remove(self.containers[obj_type], rdn_value) if rdn_value else None
+        if record is None:
+            return (False, f"ipa: ERROR: {name}: {obj_type} not found")
+        dn = self.DN(record[0])
+        self.members.pop(str(dn).lower(), None)
+        for members in self.members.values(): # referential integrity
+            members.discard(str(dn).lower())
+        self.update_memberof()
+        if obj_type in self.del_cmds:
+            cmd = self.del_cmds[obj_type]
+            for callback in self.registered_callbacks(cmd, "post"):
+                callback(None, self.ldap, dn, name)
+        return (True, f"Deleted {obj_type} \"{name}\"")
+
+    def add_member(self, verb, tgt_name, options):
+        tgt_type, member_attr, cmd = self.add_member_cmds[verb]
+        rdn_attr, rdn_value = self.rdn(tgt_type, tgt_name)
+        record = self.ldap.find(self.containers[tgt_type], rdn_value) if rdn_value else None
+        if record is None:
+            return (False, f"ipa: ERROR: {tgt_name}: {tgt_type} not found")
+        tgt_dn = self.DN(record[0])
+        candidates = {member_attr: self.member_dns(options)}
+        failed = {member_attr: {"host": [], "hostgroup": []}}
+        for callback in self.registered_callbacks(cmd, "pre"):
+            tgt_dn = callback(None, self.ldap, tgt_dn, candidates, failed, tgt_name)
+        self.failed = dict((member_type, [str(dn) for dn in dns]) for member_type, dns in failed[member_attr].items())
+        members = self.members.setdefault(str(tgt_dn).lower(), set())
+        added = 0
+        for member_type, dns in candidates[member_attr].items():
+            for dn in dns:
+                key = str(dn).lower()
+                member_rdn_value = str(dn).split(",", 1)[0].split("=", 1)[1]
+                if key not in members and self.ldap.find(self.containers[member_type], member_rdn_value):
+                    members.add(key)
+                    added += 1
+        self.update_memberof()
+        for callback in self.registered_callbacks(cmd, "post"):
+            added, tgt_dn = callback(None, self.ldap, added, failed, tgt_dn, {}, tgt_name)
+        return (True, f"-------------------------\nNumber of members added {added}\n-------------------------")
+
+    def remove_member(self, verb, tgt_name, options):
+        tgt_type, cmd = self.remove_member_cmds[verb]
+        rdn_attr, rdn_value = self.rdn(tgt_type, tgt_name)
+        tgt_dn = self.DN(f"{rdn_attr}={rdn_value},{self.containers[tgt_type]}")
+        members = self.members.get(str(tgt_dn).lower(), set())
+        removed = 0
+        for dns in self.member_dns(options).values():
+            for dn in dns:
+                if str(dn).lower() in members:
+                    members.discard(str(dn).lower())
+                    removed += 1
+        self.update_memberof()
+        for callback in self.registered_callbacks(cmd, "post"):
+            removed, tgt_dn = callback(None, self.ldap, removed, {}, tgt_dn, {}, tgt_name)
+        return (True, f"-------------------------\nNumber of members removed {removed}\n-------------------------")
+
+    def member_dns(self, options):
+        dns = {"host": [], "hostgroup": []}
+        for member_type, option in (("host", "hosts"), ("hostgroup", "hostgroups")):
+            for member_name in options.get(option, "").split(","):
+                if member_name:
+                    member_rdn = self.rdn(member_type, member_name)
+                    dns[member_type].append(self.DN(f"{member_rdn[0]}={member_rdn[1]},{self.containers[member_type]}"))
+        return dns
+
+    def update_memberof(self):
+        """Recomputes memberof (direct and nested hostgroups) the way the 389-ds memberOf plugin would."""
+        hostgroups = self.containers["hostgroup"].lower()
+        parents = {} # member key -> hostgroup keys it is a direct member of
+        for tgt_key, members in self.members.items():
+            if tgt_key.endswith(hostgroups):
+                for member_key in members:
+                    parents.setdefault(member_key, set()).add(tgt_key)
+        for obj_type in ("host", "hostgroup"):
+            for dn, attrs in self.ldap.containers.get(self.containers[obj_type].lower(), {}).values():
+                memberof, todo = set(), list(parents.get(dn.lower(), ()))
+                while todo:
+                    key = todo.pop()
+                    if key not in memberof:
+                        memberof.add(key)
+                        todo.extend(parents.get(key, ()))
+                attrs["memberof"] = sorted(memberof)
+
+    def check_members(self, target_type, target, options):
+        from hostmgmt_callbacks import hostmgmt_check_members
+        from ipalib.errors import NotFound
+        ipa = self
+
+        class ObjectStub(object):
+            def __init__(self, obj_type):
+                self.obj_type = obj_type
+
+            def get_dn(self, name):
+                rdn_attr, rdn_value = ipa.rdn(self.obj_type, name)
+                if rdn_value is None:
+                    raise NotFound(reason=f"{name}: {self.obj_type} not found")
+                return ipa.DN(f"{rdn_attr}={rdn_value},{ipa.containers[self.obj_type]}")
+
+        class APIStub(object):
+            Backend = type("Backend", (object,), {"ldap2": self.ldap})
+            Object = dict((obj_type, ObjectStub(obj_type)) for obj_type in self.containers)
+
+        class TextUIStub(list):
+            def print_plain(self, line):
+                self.append(line)
+
+            def print_summary(self, line):
+                self.append(line)
+
+        cmd = hostmgmt_check_members(APIStub())
+        kwargs = dict((option[:-1], options[option].split(","))
+                      for option in ("hosts", "hostgroups") if options.get(option))
+        try:
+            output = cmd.execute(target_type, target, **kwargs)
+        except NotFound as err:
+            return (False, f"ipa: ERROR: {err}")
+        textui = TextUIStub()
+        cmd.output_for_cli(textui, output)
+        return (True, "\n".join(textui))
+
+    def registered_callbacks(self, cmd, callback_type):
+        """Callbacks registered on cmd, without the command's own default callback."""
+        default = getattr(cmd, f"{callback_type}_callback", None)
+        return [callback for callback in cmd.get_callbacks(callback_type) if callback != default]
+
 if __name__ == "__main__":
     unittest.main()